@@ -0,0 +1,46 @@
+"""
+Time phrase beam search (lang_model.beam_search_phrases) at several beam widths.
+
+Reports time per search and per iteration, and how many distinct n-gram
+contexts the search visited (each is advanced and scored only once).
+
+Usage: python scripts/benchmark_beam_search.py [model_name] [repeats] [start words...]
+"""
+import sys
+import timeit
+
+from textrec import lang_model
+
+BEAM_WIDTHS = [10, 50, 200]
+LENGTH_AFTER_FIRST = 20
+
+
+def main():
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "yelp_train-balanced"
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    start_words = sys.argv[3:] or ["<s>", "the"]
+    model = lang_model.Model.get_or_load_model(model_name)
+    # Build the n-gram tables outside the timing.
+    model.ngram_tables
+    print(f"{model_name}: {start_words}, length_after_first={LENGTH_AFTER_FIRST}")
+    print(f"{'width':>6} {'ms/search':>10} {'ms/iter':>8} {'contexts':>9}")
+    for beam_width in BEAM_WIDTHS:
+        kw = dict(beam_width=beam_width, length_after_first=LENGTH_AFTER_FIRST)
+        seconds = timeit.timeit(
+            lambda: lang_model.beam_search_phrases(model, start_words, **kw),
+            number=repeats,
+        )
+        beam = lang_model.beam_search_phrases_init(model, start_words)
+        for iteration_num in range(LENGTH_AFTER_FIRST):
+            beam = lang_model.beam_search_phrases_extend(
+                model, beam, iteration_num=iteration_num, **kw
+            )
+        per_search = seconds / repeats * 1000
+        print(
+            f"{beam_width:6d} {per_search:10.2f} "
+            f"{per_search / LENGTH_AFTER_FIRST:8.3f} {len(beam.states):9d}"
+        )
+
+
+if __name__ == "__main__":
+    main()
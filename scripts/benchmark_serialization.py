@@ -0,0 +1,50 @@
+"""
+Compare the JSON libraries textrec.serialization can use, on real log lines.
+
+Times parsing each line, and serializing each entry the way Participant.log
+and send_json do, for every available backend.
+
+Usage: python scripts/benchmark_serialization.py [log glob] [max lines]
+"""
+import glob
+import sys
+import time
+
+from textrec import serialization
+
+
+def main():
+    pattern = sys.argv[1] if len(sys.argv) > 1 else "logs/*.jsonl"
+    max_lines = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    lines = []
+    for logfile in sorted(glob.glob(pattern)):
+        with open(logfile, encoding="utf-8") as f:
+            lines.extend(line.rstrip("\n") for line in f)
+        if len(lines) >= max_lines:
+            break
+    lines = lines[:max_lines]
+    total_bytes = sum(len(line.encode("utf-8")) for line in lines)
+    print(
+        f"{len(lines)} lines, {total_bytes / 2 ** 20:.1f}MB; using {serialization.BACKEND}"
+    )
+
+    entries = [serialization.loads(line) for line in lines]
+    print(f"{'backend':>8} {'loads (us/line)':>16} {'dumps (us/line)':>16}")
+    for name, dumps, loads in serialization.get_backends():
+        start = time.perf_counter()
+        for line in lines:
+            loads(line)
+        loads_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for entry in entries:
+            dumps(entry)
+        dumps_time = time.perf_counter() - start
+        print(
+            f"{name:>8} {loads_time / len(lines) * 1e6:16.2f} "
+            f"{dumps_time / len(lines) * 1e6:16.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Time prefix-constrained top-k on real ONMT logits: the old full-vocab mask vs.
+VocabIndex.
+
+Usage: python scripts/benchmark_top_k.py [model_name] [repeats] [in_text]
+(coco_cap needs an image id as in_text.)
+"""
+import sys
+import timeit
+
+import torch
+
+from textrec import onmt_model_2
+from textrec.onmt_model_2 import get_top_k, logsumexp
+
+PREFIXES = [None, "", "a", "th", "the", "wom", "sitt", "xq"]
+
+
+def get_top_k_full_mask(logits, vocab, k, prefix=None):
+    """get_top_k as it was before VocabIndex, for comparison."""
+    if prefix is not None:
+        offset = torch.FloatTensor([1000.0 * (not x.startswith(prefix)) for x in vocab])
+        logits = logits - offset
+        logits -= logsumexp(logits)
+    result = []
+    for idx in logits.topk(k * 2)[1]:
+        word = vocab[idx]
+        if word[0] == "<" or word[0] == ".":
+            continue
+        logit = logits[idx]
+        if logit > -100.0:
+            result.append((word, logit))
+        else:
+            break
+        if len(result) == k:
+            break
+    return result
+
+
+def main():
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "coco_lm"
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    wrapper = onmt_model_2.models[model_name]
+    in_text = sys.argv[3] if len(sys.argv) > 3 else ""
+    logits, vocab = wrapper.generate_completions(in_text, ["a", "man"])
+    print(f"{model_name}: vocab size {len(vocab)}, {repeats} calls per prefix")
+    print(f"{'prefix':>8} {'before (us)':>12} {'after (us)':>12}  speedup")
+    for prefix in PREFIXES:
+        before = timeit.timeit(
+            lambda: get_top_k_full_mask(logits, vocab, 3, prefix=prefix),
+            number=repeats,
+        )
+        after = timeit.timeit(
+            lambda: get_top_k(logits, wrapper.vocab_index, 3, prefix=prefix),
+            number=repeats,
+        )
+        print(
+            f"{prefix!r:>8} {before / repeats * 1e6:12.1f} "
+            f"{after / repeats * 1e6:12.1f}  {before / after:6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Convert a cue model's joblib parts into a bundle (see textrec.model_bundle).
+
+Usage: python scripts/build_cue_bundle.py yelp_128 [wiki-book_128 ...]
+"""
+import logging
+import sys
+import time
+
+import joblib
+
+from textrec import cueing, model_bundle
+from textrec.paths import paths
+
+
+def joblib_parts(model_name):
+    prefix = f"cue_{model_name}_"
+    return {
+        filename.stem[len(prefix) :]: filename
+        for filename in sorted(paths.cue_models.glob(f"{prefix}*.joblib"))
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    for model_name in sys.argv[1:]:
+        parts = {
+            part: joblib.load(filename)
+            for part, filename in joblib_parts(model_name).items()
+        }
+        if not parts:
+            print(f"{model_name}: no joblib parts found")
+            continue
+        path = cueing.bundle_path(model_name)
+        model_bundle.write_bundle(path, parts)
+
+        start = time.perf_counter()
+        bundle = model_bundle.ModelBundle(path)
+        bundle.warm_up()
+        print(
+            f"{model_name}: {len(parts)} parts to {path}; "
+            f"loading them all takes {time.perf_counter() - start:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
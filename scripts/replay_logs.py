@@ -1,24 +1,270 @@
-import json
+"""
+Replay logged rpc requests through rec_generator, without a server.
+
+Streams rpc entries from participant logs, runs each through
+handle_request_async with a real process pool (as the server does), and
+reports per-method latency and whether each result matches the reply that was
+logged with the request (logs from before replies were logged can only be
+timed). With --baseline, compares against an earlier report and exits nonzero
+on mismatches or latency regressions, so it can gate changes to the rec path.
+
+Methods that pick cues at random (RANDOM_METHODS) can't match their logged
+replies exactly, so for those a reply only has to have the same shape (keys,
+types, and list lengths), and the gate compares their mismatch rate with the
+baseline's rather than failing on any mismatch.
+
+Usage:
+    python scripts/replay_logs.py --batch study4 --method get_cue --sample .1 \\
+        --report replay.json --baseline replay-main.json
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
 import glob
-from textrec import rec_generator
-import tqdm
+import random
+import sys
+import time
+import traceback
+from collections import Counter, defaultdict
 
-# Use the full image data because we've changed what images to use several times.
+import numpy as np
+
+from textrec import rec_generator, serialization
 from textrec.paths import paths
-paths.imgdata_h5 = paths.top_level / 'models-aside' / 'feats_by_imgid.h5'
 
-lines = (json.loads(line.strip()) for logfile in glob.glob('logs/*.jsonl') for line in open(logfile))
-requests = [line for line in lines if line['type'] == 'rpc']
 
-print(len(requests), 'requests')
+def iter_rpc_entries(pattern, batches=None, methods=None):
+    """Yield (participant_id, batch, log entry) for logged rpc requests."""
+    for logfile in sorted(glob.glob(pattern)):
+        batch = None
+        with open(logfile, encoding="utf-8") as f:
+            for line in f:
+                entry = serialization.loads(line)
+                if entry.get("type") == "login":
+                    batch = entry.get("batch")
+                if entry.get("type") != "rpc" or "request" not in entry:
+                    continue
+                if batches and batch not in batches:
+                    continue
+                if methods and entry["request"]["rpc"].get("method") not in methods:
+                    continue
+                yield entry.get("participant_id"), batch, entry
+
+
+def sample(entries, fraction, max_requests, seed):
+    rng = random.Random(seed)
+    n = 0
+    for entry in entries:
+        if max_requests is not None and n >= max_requests:
+            return
+        if fraction < 1 and rng.random() >= fraction:
+            continue
+        n += 1
+        yield entry
+
+
+# Methods whose replies are sampled with np.random or pandas' sample.
+RANDOM_METHODS = {"get_cue"}
+
+
+def normalize(result):
+    # Compare as JSON, so numpy values and tuples match what was logged.
+    return serialization.loads(serialization.dumps(result))
+
+
+def shape(value):
+    """The structure of a JSON value: keys, types, and list lengths."""
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shape(item) for item in value]
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return "number"
+    return type(value).__name__
+
+
+def matches(method, result, logged):
+    result = normalize(result)
+    if method in RANDOM_METHODS:
+        return shape(result) == shape(logged)
+    return result == logged
+
+
+async def replay(entries, executor, concurrency):
+    """Run the requests, `concurrency` at a time; return a record for each."""
+    records = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(participant_id, batch, entry):
+        rpc = entry["request"]["rpc"]
+        record = dict(
+            participant_id=participant_id,
+            batch=batch,
+            method=rpc.get("method"),
+            timestamp=entry["request"].get("timestamp"),
+            logged_dur=entry.get("dur"),
+        )
+        start = time.perf_counter()
+        try:
+            result = await rec_generator.handle_request_async(
+                executor, rpc, session=participant_id
+            )
+        except Exception:
+            record["outcome"] = "error"
+            record["error"] = traceback.format_exc(limit=3)
+        else:
+            if "reply" not in entry:
+                record["outcome"] = "unlogged"
+            elif matches(record["method"], result, entry["reply"]):
+                record["outcome"] = "match"
+            else:
+                record["outcome"] = "mismatch"
+        record["latency"] = time.perf_counter() - start
+        records.append(record)
+        semaphore.release()
+
+    tasks = []
+    for item in entries:
+        await semaphore.acquire()
+        tasks.append(asyncio.ensure_future(run_one(*item)))
+    await asyncio.gather(*tasks)
+    return records
+
+
+def summarize(records):
+    by_method = defaultdict(list)
+    for record in records:
+        by_method[record["method"]].append(record)
+    summary = {}
+    for method, method_records in sorted(by_method.items()):
+        latencies = np.array([record["latency"] for record in method_records]) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary[method] = dict(
+            count=len(method_records),
+            outcomes=dict(Counter(record["outcome"] for record in method_records)),
+            latency_ms=dict(
+                p50=p50, p95=p95, p99=p99, mean=latencies.mean(), max=latencies.max()
+            ),
+        )
+    return summary
+
+
+def mismatch_rate(stats):
+    return stats["outcomes"].get("mismatch", 0) / stats["count"]
+
+
+def compare_to_baseline(summary, baseline, max_slowdown, max_mismatch_increase):
+    """Problems with this run, relative to a baseline report."""
+    problems = []
+    for method, stats in summary.items():
+        if method not in RANDOM_METHODS and stats["outcomes"].get("mismatch"):
+            problems.append(f"{method}: {stats['outcomes']['mismatch']} mismatches")
+        if method not in baseline:
+            continue
+        if method in RANDOM_METHODS:
+            before, after = mismatch_rate(baseline[method]), mismatch_rate(stats)
+            if after > before + max_mismatch_increase:
+                problems.append(f"{method}: mismatch rate {before:.1%} -> {after:.1%}")
+        errors_before = baseline[method]["outcomes"].get("error", 0)
+        if stats["outcomes"].get("error", 0) > errors_before:
+            problems.append(
+                f"{method}: {stats['outcomes']['error']} errors, was {errors_before}"
+            )
+        for quantile in ["p50", "p95"]:
+            before = baseline[method]["latency_ms"][quantile]
+            after = stats["latency_ms"][quantile]
+            if after > before * max_slowdown:
+                problems.append(f"{method}: {quantile} {before:.1f}ms -> {after:.1f}ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--logs", default="logs/*.jsonl", help="glob of logs")
+    parser.add_argument("--batch", action="append", help="only these batches")
+    parser.add_argument("--method", action="append", help="only these rpc methods")
+    parser.add_argument("--sample", type=float, default=1.0, help="fraction to run")
+    parser.add_argument("--max-requests", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=2, help="process pool size")
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="requests in flight at once"
+    )
+    parser.add_argument(
+        "--preload", action="store_true", help="load cue models before forking"
+    )
+    parser.add_argument(
+        "--full-imgdata",
+        action="store_true",
+        help="use models-aside/feats_by_imgid.h5, which has every image we've used",
+    )
+    parser.add_argument("--report", help="write a JSON report here")
+    parser.add_argument("--baseline", help="a report to check this run against")
+    parser.add_argument(
+        "--max-slowdown",
+        type=float,
+        default=1.2,
+        help="fail if a method's p50 or p95 is this many times the baseline's",
+    )
+    parser.add_argument(
+        "--max-mismatch-increase",
+        type=float,
+        default=0.01,
+        help=f"fail if the mismatch rate of {sorted(RANDOM_METHODS)} rises this much",
+    )
+    opts = parser.parse_args()
+
+    if opts.full_imgdata:
+        paths.imgdata_h5 = paths.top_level / "models-aside" / "feats_by_imgid.h5"
+    if opts.preload:
+        from textrec import cueing
+
+        cueing.preload_models(rec_generator.PRELOAD_MODELS, rec_generator.PARTS_NEEDED)
+
+    entries = sample(
+        iter_rpc_entries(opts.logs, opts.batch, opts.method),
+        opts.sample,
+        opts.max_requests,
+        opts.seed,
+    )
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=opts.workers)
+    start = time.perf_counter()
+    records = asyncio.get_event_loop().run_until_complete(
+        replay(entries, executor, opts.concurrency)
+    )
+    duration = time.perf_counter() - start
+    executor.shutdown()
+
+    summary = summarize(records)
+    print(f"{len(records)} requests in {duration:.1f}s")
+    for method, stats in summary.items():
+        latency = stats["latency_ms"]
+        print(
+            f"  {method:<14} n={stats['count']:<6} p50={latency['p50']:.1f}ms "
+            f"p95={latency['p95']:.1f}ms p99={latency['p99']:.1f}ms {stats['outcomes']}"
+        )
+
+    if opts.report:
+        report = dict(
+            config=vars(opts), duration=duration, methods=summary, requests=records
+        )
+        with open(opts.report, "w", encoding="utf-8") as f:
+            f.write(serialization.dumps(report))
 
-filtered_requests = [
-    request for request in requests
-    if request['request']['rpc'].get('stimulus') is not None
-    and isinstance(request['request']['rpc']['stimulus'], dict)]
+    if opts.baseline:
+        with open(opts.baseline, encoding="utf-8") as f:
+            baseline = serialization.loads(f.read())["methods"]
+        problems = compare_to_baseline(
+            summary, baseline, opts.max_slowdown, opts.max_mismatch_increase
+        )
+        for problem in problems:
+            print("REGRESSION:", problem)
+        if problems:
+            sys.exit(1)
 
-print(len(filtered_requests), 'filtered')
 
-for request in tqdm.tqdm(filtered_requests):
-    rpc = request['request']['rpc']
-    rec_generator.handle_request_async(rpc)
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import joblib
 
+from textrec import model_bundle
 from textrec.cueing import (
+    bundle_path,
     cached_topic_data,
     train_topic_w2v,
     get_labels_for_clusters,
@@ -39,6 +41,10 @@ if __name__ == "__main__":
     print("Train w2v")
     model["topic_w2v"] = train_topic_w2v(model["sentences"], opts.w2v_embedding_size)
 
+    model_name = f"{opts.dataset_name}_{opts.n_clusters}"
     for k, v in model.items():
-        filename = model_filename(f"{opts.dataset_name}_{opts.n_clusters}", k)
+        filename = model_filename(model_name, k)
         joblib.dump(v, filename)
+
+    print("Write bundle")
+    model_bundle.write_bundle(bundle_path(model_name), model)
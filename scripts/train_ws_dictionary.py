@@ -0,0 +1,49 @@
+"""
+Build the preset dictionary for "zlib-dict" websocket compression from logs.
+
+Log entries are what backlogs are made of, and rpc entries hold the requests
+clients send, so they're a good sample of what goes over the websocket.
+
+Usage: python scripts/train_ws_dictionary.py [log glob] [max lines]
+"""
+import glob
+import json
+import random
+import sys
+import zlib
+
+from textrec import ws_compression
+
+
+def main():
+    pattern = sys.argv[1] if len(sys.argv) > 1 else "logs/*.jsonl"
+    max_lines = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    lines = [line.strip() for logfile in glob.glob(pattern) for line in open(logfile)]
+    random.Random(0).shuffle(lines)
+    lines = lines[:max_lines]
+    split = len(lines) * 9 // 10
+    train, test = lines[:split], lines[split:]
+    messages = []
+    for line in train:
+        messages.append(line)
+        entry = json.loads(line)
+        if entry.get("type") == "rpc" and "request" in entry:
+            messages.append(json.dumps(entry["request"]))
+
+    dictionary = ws_compression.train_dictionary(messages)
+    ws_compression.DICTIONARY_FILE.write_bytes(dictionary)
+    print(f"Wrote {len(dictionary)} bytes to {ws_compression.DICTIONARY_FILE}")
+
+    # How well does it do on a backlog-sized message, as the first on a stream?
+    backlog = json.dumps(
+        dict(type="backlog", body=[json.loads(line) for line in test[:200]])
+    )
+    for name, kw in [("no dictionary", {}), ("dictionary", dict(zdict=dictionary))]:
+        deflater = zlib.compressobj(**kw)
+        size = len(deflater.compress(backlog.encode("utf-8")))
+        size += len(deflater.flush(zlib.Z_SYNC_FLUSH))
+        print(f"{name}: {len(backlog)} -> {size} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,45 @@
 import pako from "pako";
 
+// Compression modes: see textrec/ws_compression.py. We use "zlib-dict" if the
+// server has a dictionary for us, else "zlib-text".
+// The server closes a zlib-dict connection with this code if our dictionary
+// isn't the one it has now (e.g., it restarted with a retrained one).
+const STALE_DICTIONARY_CODE = 4001;
+
+let dictionaryPromise = null;
+function getDictionary() {
+  if (dictionaryPromise === null) {
+    dictionaryPromise = fetch("/ws_dictionary", { cache: "no-store" })
+      .then(async response =>
+        response.ok
+          ? {
+              version: response.headers.get("X-Dictionary-Version"),
+              bytes: new Uint8Array(await response.arrayBuffer()),
+            }
+          : null
+      )
+      .catch(() => null);
+  }
+  return dictionaryPromise;
+}
+
 export default function WSClient(path) {
   var self = this;
   self.attempts = 0;
   self.waitingToReconnect = false;
   self.helloMsgs = [];
+  self.dictionary = null;
 
-  self.connect = () => {
+  self.connect = async () => {
     self.attempts++;
     self.waitingToReconnect = false;
-    self.ws = new WebSocket(path);
+    self.dictionary = await getDictionary();
+    let sep = path.indexOf("?") === -1 ? "?" : "&";
+    let args = self.dictionary
+      ? `compression=zlib-dict&dictionary=${self.dictionary.version}`
+      : "compression=zlib-text";
+    self.ws = new WebSocket(`${path}${sep}${args}`);
+    self.ws.binaryType = "arraybuffer";
     self.ws.onopen = onopen;
     self.ws.onclose = onclose;
     self.ws.onerror = onerror;
@@ -24,7 +54,7 @@ export default function WSClient(path) {
   }
 
   setInterval(function() {
-    if (self.ws.readyState === WebSocket.OPEN) {
+    if (self.isOpen()) {
       self.send({ type: "ping" });
     }
   }, 10000);
@@ -32,8 +62,17 @@ export default function WSClient(path) {
   function onopen() {
     self.attempts = 0;
     console.log("ws open", self.ws.readyState, self.queue);
-    self.deflater = new pako.Deflate({ to: "string" });
-    self.inflater = new pako.Inflate({ to: "string" });
+    if (self.dictionary) {
+      // Binary frames.
+      self.deflater = new pako.Deflate({ dictionary: self.dictionary.bytes });
+      self.inflater = new pako.Inflate({
+        to: "string",
+        dictionary: self.dictionary.bytes,
+      });
+    } else {
+      self.deflater = new pako.Deflate({ to: "string" });
+      self.inflater = new pako.Inflate({ to: "string" });
+    }
     for (var i = 0; i < self.helloMsgs.length; i++) {
       _send(self.helloMsgs[i]);
     }
@@ -52,8 +91,12 @@ export default function WSClient(path) {
     );
   }
 
-  function onclose() {
-    console.log("websocket closed");
+  function onclose(event) {
+    console.log("websocket closed", event.code);
+    if (event.code === STALE_DICTIONARY_CODE) {
+      // Get the server's current dictionary when we reconnect.
+      dictionaryPromise = null;
+    }
     self.stateChanged && self.stateChanged("closed");
     backoffReconnect();
   }
@@ -64,14 +107,16 @@ export default function WSClient(path) {
   }
 
   function onmessage(message) {
-    self.inflater.push(message.data, pako.Z_SYNC_FLUSH);
+    let frame = message.data;
+    if (frame instanceof ArrayBuffer) frame = new Uint8Array(frame);
+    self.inflater.push(frame, pako.Z_SYNC_FLUSH);
     var data = JSON.parse(self.inflater.result);
     self.onmessage(data);
   }
 
   self.send = function(msg) {
     msg = { timestamp: +new Date(), ...msg };
-    if (self.ws.readyState === WebSocket.OPEN) {
+    if (self.isOpen()) {
       _send(msg);
     } else {
       self.queue.push(msg);
@@ -80,7 +125,8 @@ export default function WSClient(path) {
   };
 
   self.isOpen = function() {
-    return self.ws.readyState === WebSocket.OPEN;
+    // No socket yet while we're fetching the dictionary.
+    return !!self.ws && self.ws.readyState === WebSocket.OPEN;
   };
 
   self.setHello = function(msgs) {
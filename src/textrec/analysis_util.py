@@ -1,10 +1,8 @@
 import hashlib
-import json
 import os
 import subprocess
 
-import ujson
-
+from . import serialization
 from .paths import paths
 from .util import mem
 
@@ -29,9 +27,9 @@ def get_rev(logpath):
     Technically each reload of the frontend could theoretically be a different revision.
     For simplicity, we take just the first one.
     """
-    with open(logpath) as logfile:
+    with open(logpath, encoding="utf-8") as logfile:
         for line in logfile:
-            line = json.loads(line)
+            line = serialization.loads(line)
             # This would be a good use of assignment expressions, once they're released.
             if line.get("kind") == "meta" and line.get("type") == "init":
                 request = line.get("request", {})
@@ -52,9 +50,9 @@ def get_log_analysis(participant):
 def get_final_data(participant):
     logpath = paths.logdir / (participant + ".jsonl")
     final_data = None
-    with open(logpath) as logfile:
+    with open(logpath, encoding="utf-8") as logfile:
         for line in logfile:
-            entry = json.loads(line)
+            entry = serialization.loads(line)
             if entry["type"] == "finalData":
                 assert final_data is None
                 final_data = entry["finalData"]
@@ -66,14 +64,13 @@ def get_final_data(participant):
 def get_trial_lengths(participant):
     # HACK.
     from textrec.paths import paths
-    import json
 
     result = []
     logpath = paths.logdir / (participant + ".jsonl")
     last_logged_cue = None
-    with open(logpath) as logfile:
+    with open(logpath, encoding="utf-8") as logfile:
         for line in logfile:
-            entry = json.loads(line)
+            entry = serialization.loads(line)
             if entry["type"] == "logCue":
                 last_logged_cue = entry.copy()
                 del entry["type"]
@@ -121,7 +118,7 @@ def get_log_analysis_many(participants, analyzer):
             revisions_needed.add((git_rev, real_git_rev))
         else:
             # Result was cached.
-            analyzed = ujson.loads(analysis_raw)
+            analyzed = serialization.loads(analysis_raw)
             analyzed["git_rev"] = git_rev
             analyses[participant] = analyzed
 
@@ -140,10 +137,10 @@ def get_log_analysis_many(participants, analyzer):
         for line in completion.stdout.split(b"\n"):
             if len(line) == 0:
                 continue
-            line = json.loads(line.decode("utf-8"))
+            line = serialization.loads(line)
             if "error" in line:
                 print(f"Error processing {line['filename']}")
-                error = json.loads(line["error"])
+                error = serialization.loads(line["error"])
                 print(error["message"])
                 print(error["stack"])
                 print()
@@ -153,7 +150,7 @@ def get_log_analysis_many(participants, analyzer):
                 print(f"Got result for {participant_id}")
                 analyses[participant_id] = result
                 # Store results as JSON because it's faster than pickle.
-                cheating_analysis_results[participant_id] = json.dumps(result)
+                cheating_analysis_results[participant_id] = serialization.dumps(result)
 
         for participant, logpath, logfile_size, git_rev, real_git_rev in todo:
             # Store the analysis result.
@@ -1,14 +1,16 @@
-import io
-import json
+import asyncio
+import collections
+import functools
 import logging
+import multiprocessing
 import os
 import random
 import re
 import subprocess
+import sys
 import time
 import traceback
 import platform
-import zlib
 from concurrent.futures import ProcessPoolExecutor
 
 import tornado.autoreload
@@ -18,7 +20,8 @@ import tornado.web
 import tornado.websocket
 from tornado.options import define, options
 
-from . import counterbalancing, rec_generator
+from . import counterbalancing, metrics, rec_generator, serialization, ws_compression
+from .log_writer import FSYNC_POLICIES, LogWriter
 from .paths import paths
 
 logger = logging.getLogger(__name__)
@@ -33,6 +36,93 @@ def get_git_commit():
 MY_HOSTNAME = platform.node()
 
 define("port", default=5000, help="run on the given port", type=int)
+define(
+    "workers",
+    default=0,
+    help="number of worker processes for recommendations (0: one per core)",
+    type=int,
+)
+define(
+    "preload_lms",
+    default=[],
+    multiple=True,
+    help="kenlm models to load before starting workers, so workers share them",
+    type=str,
+)
+define(
+    "preload_onmt",
+    default=False,
+    help="load the ONMT models before starting workers, so workers share them",
+    type=bool,
+)
+define(
+    "preload_cue_models",
+    default=False,
+    help="load the cue models (rec_generator.PRELOAD_MODELS) at startup",
+    type=bool,
+)
+define(
+    "onmt_workers",
+    default=0,
+    help="with --preload_onmt, worker processes for ONMT recs, each serving a fixed "
+    "share of participants so its decoder state cache hits (0: same as --workers)",
+    type=int,
+)
+define(
+    "memory_report_interval",
+    default=0,
+    help="seconds between logging the memory use of each worker (0: only at startup)",
+    type=int,
+)
+define(
+    "rec_batch_window_ms",
+    default=3.0,
+    help="how long to wait for other get_recs requests to batch with",
+    type=float,
+)
+define(
+    "rec_batch_size",
+    default=64,
+    help="maximum number of get_recs requests to decode together",
+    type=int,
+)
+define(
+    "rpc_threads",
+    default=4,
+    help="threads for RPC methods that run on the thread pool (e.g., get_cue)",
+    type=int,
+)
+define(
+    "rpc_config",
+    default="",
+    help="JSON overrides for rec_generator.RPC_METHODS, "
+    'e.g., {"analyze_doc": {"timeout": 10}}',
+    type=str,
+)
+define(
+    "log_fsync",
+    default="batch",
+    help=f"when to fsync participant logs: one of {FSYNC_POLICIES}",
+    type=str,
+)
+define(
+    "log_fsync_interval",
+    default=1.0,
+    help="seconds between fsyncs of participant logs when --log_fsync=interval",
+    type=float,
+)
+define(
+    "log_writer_report_interval",
+    default=60,
+    help="seconds between logging log writer queue depth and latency (0: never)",
+    type=int,
+)
+define(
+    "participant_idle_timeout",
+    default=3600,
+    help="seconds after which to close the log of a participant with no connections",
+    type=int,
+)
 
 settings = dict(template_path=paths.ui, static_path=paths.ui / "static", debug=True)
 
@@ -43,57 +133,355 @@ if not os.path.isdir(paths.logdir):
     os.makedirs(paths.logdir)
 
 
-process_pool = ProcessPoolExecutor()
+# Created in main(), after preloading models, so that the forked workers share
+# the parent's copy of the models instead of each loading their own.
+process_pool = None
+# Reported by each worker process as it starts; see make_process_pool.
+worker_pids = []
 
 
-tornado.autoreload.add_reload_hook(process_pool.shutdown)
+def preload_models():
+    """Load models in the parent process, before any workers are forked."""
+    if options.preload_lms:
+        from . import lang_model
+
+        for name in options.preload_lms:
+            lang_model.Model.get_or_load_model(name)
+            # Build (or map) the batch-scoring tables now too.
+            lang_model.Model.get_model(name).ngram_tables
+    if options.preload_onmt:
+        from . import onmt_model_2
+
+        onmt_model_2.prewarm_encoder_caches()
+    if options.preload_cue_models:
+        from . import cueing
+
+        cueing.preload_models(rec_generator.PRELOAD_MODELS, rec_generator.PARTS_NEEDED)
+
+
+def _worker_started(delay):
+    # Give the other workers a chance to get started too.
+    time.sleep(delay)
+    return os.getpid()
+
+
+def make_process_pool(n_workers):
+    n_workers = n_workers or os.cpu_count()
+    # Workers must be forked, so they share the preloaded models.
+    if sys.version_info >= (3, 7):
+        pool = ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("fork")
+        )
+    else:
+        # Can't pass a context, but 3.6 forks by default on Linux and macOS.
+        pool = ProcessPoolExecutor(max_workers=n_workers)
+    # Fork all the workers now, while the parent has only the preloaded state.
+    pids = set(pool.map(_worker_started, [0.1] * n_workers, chunksize=1, timeout=60))
+    worker_pids.extend(sorted(pids))
+    logger.info(f"Started {len(pids)} of {n_workers} workers")
+    return pool
+
+
+def get_process_memory(pid):
+    """Resident (RSS) and proportional (PSS) memory of a process, in bytes.
+
+    PSS splits shared pages among the processes sharing them, so summing PSS
+    over the workers gives their true total.
+    """
+    result = {}
+    for filename, fields in [("status", ["VmRSS"]), ("smaps_rollup", ["Pss"])]:
+        try:
+            with open(f"/proc/{pid}/{filename}") as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    if key in fields:
+                        result[key.lower()] = int(value.split()[0]) * 1024
+        except OSError:
+            # Not Linux, or the process went away.
+            pass
+    return result
+
+
+def log_worker_memory():
+    pids = [os.getpid()] + worker_pids
+    total_pss = 0
+    for i, pid in enumerate(pids):
+        memory = get_process_memory(pid)
+        total_pss += memory.get("pss", 0)
+        logger.info(
+            "Memory of {} {}: rss={:.1f}MB pss={:.1f}MB".format(
+                "server" if i == 0 else "worker",
+                pid,
+                memory.get("vmrss", 0) / 2 ** 20,
+                memory.get("pss", 0) / 2 ** 20,
+            )
+        )
+    logger.info(f"Total PSS: {total_pss / 2 ** 20:.1f}MB")
+
+
+def log_log_writer_stats():
+    logger.info(f"Log writer: {log_writer.get_stats()}")
 
 
 known_participants = {}
 
+# Writes the participant logs; configured in main().
+log_writer = LogWriter()
+
 
 def get_log_file_name(participant_id):
     return os.path.join(paths.logdir, participant_id + ".jsonl")
 
 
+class ParticipantIdAllocator:
+    """Hands out random participant ids that don't have a log yet.
+
+    The ids in use are listed from the log directory once, then tracked here,
+    so allocating doesn't touch the filesystem.
+    """
+
+    ALPHABET = "23456789cfghjmpqrvwx"
+    LENGTH = 6
+
+    def __init__(self, logdir):
+        self.used = {
+            name[: -len(".jsonl")]
+            for name in os.listdir(logdir)
+            if name.endswith(".jsonl")
+        }
+
+    def add(self, participant_id):
+        self.used.add(participant_id)
+
+    def allocate(self):
+        while True:
+            participant_id = "".join(random.choices(self.ALPHABET, k=self.LENGTH))
+            if participant_id not in self.used:
+                self.used.add(participant_id)
+                return participant_id
+
+
+participant_ids = ParticipantIdAllocator(paths.logdir)
+
+
+async def logs_written():
+    """Wait, without blocking the IOLoop, for what's been logged to be in the files."""
+    await asyncio.wrap_future(log_writer.barrier())
+
+
+def index_log_file(log_file_name):
+    """The size of a log file, and the offsets of its entries of each non-meta kind."""
+    offsets = {}
+    offset = 0
+    if os.path.exists(log_file_name):
+        with open(log_file_name, "rb") as f:
+            for line in f:
+                try:
+                    kind = serialization.loads(line)["kind"]
+                except ValueError:
+                    # What's left of a line that failed partway through writing.
+                    logger.warning(f"Skipping a damaged line in {log_file_name}")
+                    kind = "meta"
+                if kind != "meta":
+                    offsets.setdefault(kind, []).append(offset)
+                offset += len(line)
+    return offset, offsets
+
+
+def get_backlog_from_entries(entries, message_count):
+    """The non-meta entries of each kind after the first message_count[kind]."""
+    backlog = []
+    cur_msg_idx = {}
+    for entry in entries:
+        kind = entry["kind"]
+        if kind == "meta":
+            continue
+        idx = cur_msg_idx.get(kind, 0)
+        if idx >= message_count.get(kind, 0):
+            backlog.append(entry)
+        cur_msg_idx[kind] = idx + 1
+    return backlog
+
+
 class Participant:
     @classmethod
     def get_participant(cls, participant_id):
         if participant_id in known_participants:
-            return known_participants[participant_id]
-        participant = cls(participant_id)
-        known_participants[participant_id] = participant
+            participant = known_participants[participant_id]
+        else:
+            participant = cls(participant_id)
+            known_participants[participant_id] = participant
+        participant.last_active = time.time()
         return participant
 
+    @classmethod
+    def evict_idle(cls, max_idle):
+        """Forget participants with no connections that have been idle a while.
+
+        Closes their log files. They're reloaded if they come back.
+        """
+        now = time.time()
+        idle = [
+            participant
+            for participant in known_participants.values()
+            if not participant.connections and now - participant.last_active > max_idle
+        ]
+        if not idle:
+            return
+        for participant in idle:
+            del known_participants[participant.participant_id]
+        files = [participant.log_file for participant in idle]
+
+        def close_files():
+            for file in files:
+                file.close()
+
+        # The writer might still have lines for these files, so it closes them.
+        log_writer.barrier(then=close_files)
+        logger.info(
+            f"Evicted {len(idle)} idle participants; {len(known_participants)} remain"
+        )
+
     def __init__(self, participant_id):
         self.participant_id = participant_id
         self.connections = []
+        self.last_active = time.time()
 
         self.log_file_name = get_log_file_name(self.participant_id)
-        self.log_file = open(self.log_file_name, "a+")
-        self.log_file.seek(0, io.SEEK_END)
+        self.log_file = open(self.log_file_name, "a", encoding="utf-8")
+        self.log_size, self.log_offsets = index_log_file(self.log_file_name)
+        # While the index is being rebuilt: (kind, size) of each line logged since.
+        self.unindexed = None
+        self.reindex_again = False
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        participant_ids.add(participant_id)
 
     def log(self, event):
+        """Log an event. For finalData, returns a Future for when it's on disk."""
         assert self.log_file is not None
-        print(
-            json.dumps(
-                dict(event, pyTimestamp=time.time(), participant_id=self.participant_id)
-            ),
-            file=self.log_file,
-            flush=True,
+        self.last_active = time.time()
+        line = serialization.dumps(
+            dict(event, pyTimestamp=time.time(), participant_id=self.participant_id)
+        )
+        # Lines are written in the order they're logged, so we know where this
+        # one will go even before the writer gets to it (unless a write fails).
+        kind = event.get("kind")
+        size = len(line.encode("utf-8")) + 1
+        if self.unindexed is not None:
+            self.unindexed.append((kind, size))
+        else:
+            self._add_to_index(self.log_offsets, self.log_size, kind)
+            self.log_size += size
+        return log_writer.write(
+            self.log_file,
+            line,
+            # finalData is what participants get paid for, so make sure it's kept.
+            durable=event.get("type") == "finalData",
+            on_error=self._write_failed,
         )
 
-    def get_log_entries(self):
-        self.log_file.seek(0)
-        log_entries = [json.loads(line) for line in self.log_file]
-        self.log_file.seek(0, io.SEEK_END)
-        return log_entries
+    @staticmethod
+    def _add_to_index(offsets, offset, kind):
+        if kind != "meta":
+            offsets.setdefault(kind, []).append(offset)
+
+    def _write_failed(self, error):
+        # Called in the log writer thread. Lines after the failed one aren't
+        # where log() expected, so rebuild the index from the file.
+        self.io_loop.add_callback(self._reindex)
+
+    def _reindex(self):
+        if self.unindexed is not None:
+            # Already rebuilding; that may have read the file before this failure.
+            self.reindex_again = True
+            return
+        self.unindexed = []
+        # Indexed in the writer thread once the lines logged so far are written,
+        # and before any later ones are.
+        reindexed = log_writer.barrier(
+            then=functools.partial(index_log_file, self.log_file_name)
+        )
+        self.io_loop.add_future(reindexed, self._reindexed)
+
+    def _reindexed(self, future):
+        try:
+            size, offsets = future.result()
+        except Exception:
+            logger.exception(f"Failed to reindex the log for {self.participant_id}")
+            size, offsets = self.log_size, self.log_offsets
+        for kind, line_size in self.unindexed:
+            self._add_to_index(offsets, size, kind)
+            size += line_size
+        self.log_size, self.log_offsets = size, offsets
+        self.unindexed = None
+        if self.reindex_again:
+            self.reindex_again = False
+            self._reindex()
+
+    async def get_log_entries(self):
+        await logs_written()
+        with open(self.log_file_name, encoding="utf-8") as f:
+            return [serialization.loads(line) for line in f]
+
+    async def get_backlog(self, message_count):
+        """The non-meta entries of each kind after the first message_count[kind].
+
+        Only reads and parses those entries, using the offsets in log_offsets.
+        """
+        offsets = []
+        for kind, kind_offsets in self.log_offsets.items():
+            offsets.extend(kind_offsets[message_count.get(kind, 0) :])
+        if not offsets:
+            return []
+        offsets.sort()
+        await logs_written()
+        return self._read_entries(offsets)
+
+    def _read_entries(self, offsets):
+        """The entries at `offsets`, which must be written already (logs_written)."""
+        entries = []
+        with open(self.log_file_name, "rb") as f:
+            for offset in offsets:
+                f.seek(offset)
+                entries.append(serialization.loads(f.readline()))
+        return entries
+
+    async def get_log_page(self, start, limit, kinds=None):
+        """Non-meta entries [start, start + limit) (of the given kinds, if any).
+
+        Returns the total number of such entries too.
+        """
+        offsets = []
+        for kind, kind_offsets in self.log_offsets.items():
+            if kinds is None or kind in kinds:
+                offsets.extend(kind_offsets)
+        offsets.sort()
+        await logs_written()
+        return len(offsets), self._read_entries(offsets[start : start + limit])
+
+    def get_summary(self):
+        """What a panopticon snapshot shows about this participant.
+
+        Await logs_written() first, so its last entry is in the file.
+        """
+        offsets = [offsets[-1] for offsets in self.log_offsets.values() if offsets]
+        return dict(
+            participant_id=self.participant_id,
+            connections=[
+                dict(kind=client.kind, **client.get_byte_counts())
+                for client in self.connections
+            ],
+            message_count={
+                kind: len(offsets) for kind, offsets in self.log_offsets.items()
+            },
+            last_entry=self._read_entries([max(offsets)])[0] if offsets else None,
+        )
 
     def broadcast(self, msg, exclude_conn):
         for conn in self.connections:
             if conn is not exclude_conn:
                 conn.send_json(**msg)
-        Panopticon.spy(msg)
+        Panopticon.spy(msg, participant_id=self.participant_id)
 
     def connected(self, client):
         self.connections.append(client)
@@ -102,6 +490,7 @@ class Participant:
 
     def disconnected(self, client):
         self.connections.remove(client)
+        self.last_active = time.time()
         logger.info(f"Connection closed: {self.participant_id}-{client.kind}")
 
 
@@ -125,6 +514,9 @@ class DemoParticipant:
             )
         ]
 
+    async def get_backlog(self, message_count):
+        return get_backlog_from_entries(self.get_log_entries(), message_count)
+
     def log(self, event):
         logger.info(f"Demo event: {event['type']}")
 
@@ -138,22 +530,136 @@ class DemoParticipant:
         return
 
 
+# Counts of get_rec requests and how many were superseded, across connections.
+rec_stats = collections.Counter()
+
+
+class PanopticonSubscription:
+    """
+    What one panopticon connection is watching, and what it's owed.
+
+    Matching events are buffered and sent as one "panoptDelta" message at most
+    every `delta_interval` seconds; if more than `max_buffered` pile up, the
+    oldest are dropped (and counted). Snapshots of the watched participants
+    are sent at most every `snapshot_interval` seconds, however often they're
+    asked for.
+    """
+
+    def __init__(
+        self,
+        client,
+        participant_ids=None,
+        event_types=None,
+        delta_interval=0.5,
+        snapshot_interval=5.0,
+        max_buffered=1000,
+    ):
+        self.client = client
+        self.participant_ids = None if participant_ids is None else set(participant_ids)
+        self.event_types = None if event_types is None else set(event_types)
+        self.delta_interval = delta_interval
+        self.snapshot_interval = snapshot_interval
+        self.buffer = collections.deque(maxlen=max_buffered)
+        self.dropped = 0
+        self.last_sent = dict(delta=0.0, snapshot=0.0)
+        self.timeouts = {}
+
+    def matches(self, participant_id, event):
+        return (
+            self.participant_ids is None or participant_id in self.participant_ids
+        ) and (self.event_types is None or event.get("type") in self.event_types)
+
+    def add(self, participant_id, event):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(dict(participant_id=participant_id, event=event))
+        self._schedule("delta", self.delta_interval, self.send_delta)
+
+    def request_snapshot(self):
+        self._schedule("snapshot", self.snapshot_interval, self.send_snapshot)
+
+    def _schedule(self, name, interval, send):
+        """Call `send` as soon as `interval` has passed since it was last sent."""
+        if name in self.timeouts:
+            return
+        io_loop = tornado.ioloop.IOLoop.current()
+
+        def fire():
+            del self.timeouts[name]
+            self.last_sent[name] = io_loop.time()
+            # The IOLoop runs it, if it's a coroutine.
+            return send()
+
+        delay = max(0.0, self.last_sent[name] + interval - io_loop.time())
+        self.timeouts[name] = io_loop.call_later(delay, fire)
+
+    def send_delta(self):
+        self.client.send_json(
+            type="panoptDelta", events=list(self.buffer), dropped=self.dropped
+        )
+        self.buffer.clear()
+        self.dropped = 0
+
+    async def send_snapshot(self):
+        if self.participant_ids is None:
+            participants = list(known_participants.values())
+        else:
+            participants = [
+                Participant.get_participant(participant_id)
+                for participant_id in sorted(self.participant_ids)
+                if participant_id in known_participants
+                or os.path.exists(get_log_file_name(participant_id))
+            ]
+        await logs_written()
+        self.client.send_json(
+            type="panoptSnapshot",
+            participants=[participant.get_summary() for participant in participants],
+        )
+
+    def close(self):
+        io_loop = tornado.ioloop.IOLoop.current()
+        for timeout in self.timeouts.values():
+            io_loop.remove_timeout(timeout)
+        self.timeouts.clear()
+
+
 class Panopticon:
     is_panopticon = True
     participant_id = "panopt"
     connections = []
+    # Connection -> PanopticonSubscription. Unsubscribed connections get nothing.
+    subscriptions = {}
 
     @classmethod
-    def spy(cls, msg):
-        for conn in cls.connections:
-            conn.send_json(**msg)
+    def spy(cls, msg, participant_id):
+        event = msg.get("event", msg)
+        for subscription in cls.subscriptions.values():
+            if subscription.matches(participant_id, event):
+                subscription.add(participant_id, event)
 
-    def get_log_entries(self):
+    @classmethod
+    def subscribe(cls, client, **kw):
+        cls.unsubscribe(client)
+        subscription = cls.subscriptions[client] = PanopticonSubscription(client, **kw)
+        subscription.request_snapshot()
+
+    @classmethod
+    def unsubscribe(cls, client):
+        subscription = cls.subscriptions.pop(client, None)
+        if subscription is not None:
+            subscription.close()
+
+    async def get_log_entries(self):
         entries = []
-        for participant in known_participants.values():
-            entries.extend(participant.get_log_entries())
+        for participant in list(known_participants.values()):
+            entries.extend(await participant.get_log_entries())
         return entries
 
+    async def get_backlog(self, message_count):
+        # Monitors subscribe and page through history instead of getting
+        # everyone's entire log on connect.
+        return []
+
     def log(self, event):
         return
 
@@ -165,6 +671,13 @@ class Panopticon:
 
     def disconnected(self, client):
         Panopticon.connections.remove(client)
+        Panopticon.unsubscribe(client)
+
+
+MAX_LOG_PAGE_SIZE = 5000
+# Seconds to wait for finalData to reach the disk before going on without it.
+DURABLE_LOG_TIMEOUT = 10
+MIN_PANOPTICON_DELTA_INTERVAL = 0.1
 
 
 def validate_participant_id(participant_id):
@@ -173,75 +686,137 @@ def validate_participant_id(participant_id):
 
 class WebsocketHandler(tornado.websocket.WebSocketHandler):
     def get_compression_options(self):
-        # Non-None enables compression with default options.
-        # Note: we're keeping compression off because we're compressing on our own (see
-        # send_json and on_message). In the future we probably want to let the protocol
-        # do that. We're logging extensions supported by clients to see if any don't
-        # support the necessary extension.
+        # Non-None enables permessage-deflate with default options. Other modes
+        # compress on our own (see ws_compression), so compressing again is waste.
+        if self.get_argument("compression", None) == "permessage-deflate":
+            return {}
         return None
 
     def on_close(self):
         if self.participant is not None:
             self.participant.disconnected(self)
+        self.supersede_pending_rec()
+        if self.rec_stats:
+            logger.info(f"Connection {self.connection_id} recs: {dict(self.rec_stats)}")
+        logger.info(f"Connection {self.connection_id} bytes: {self.get_byte_counts()}")
 
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
         self.participant = None
         self.keyRects = {}
         self.wire_bytes_in = self.wire_bytes_out = 0
-        self.message_bytes_in = self.msg_bytes_out = 0
+        self.message_bytes_in = self.message_bytes_out = 0
+        self.compression = self.codec = None
         self.connection_id = str(time.time())
+        # The get_rec request being worked on, if any; see do_rpc.
+        self.pending_rec = None
+        self.rec_stats = collections.Counter()
         # There will also be a 'kind', which gets set only when the client connects.
 
     def log(self, event):
-        if event.get("type") == "finalData":
-            participant_id = self.participant.participant_id
-            counterbalancing.mark_completed(participant_id)
-            logger.info(f"Participant completed: {participant_id}")
-        self.participant.log(dict(event))
+        return self.participant.log(dict(event))
 
     def open(self):
         extensions = self.request.headers.get("Sec-WebSocket-Extensions", "")
-        logger.info(f"Websocket opened (extensions={extensions!r})")
-        self.inflater = zlib.decompressobj()
-        self.deflater = zlib.compressobj()
+        self.compression = self.get_argument("compression", ws_compression.DEFAULT_MODE)
+        logger.info(
+            "Websocket opened "
+            f"(extensions={extensions!r}, compression={self.compression})"
+        )
+        try:
+            self.codec = ws_compression.CODECS[self.compression]()
+        except (KeyError, OSError):
+            logger.exception(f"Can't use compression {self.compression!r}")
+            self.close()
+            return
+        if self.compression == "zlib-dict":
+            version = self.get_argument("dictionary", None)
+            if version != ws_compression.get_dictionary_version():
+                logger.info(f"Client has dictionary version {version!r}; closing")
+                self.codec = None
+                self.close(ws_compression.STALE_DICTIONARY_CODE, "stale dictionary")
+
+    def get_byte_counts(self):
+        """Bytes of JSON and bytes of frames (before any permessage-deflate)."""
+        counts = dict(
+            compression=self.compression,
+            message_bytes_in=self.message_bytes_in,
+            message_bytes_out=self.message_bytes_out,
+            wire_bytes_in=self.wire_bytes_in,
+            wire_bytes_out=self.wire_bytes_out,
+        )
+        if self.compression == "permessage-deflate" and self.ws_connection:
+            # The websocket protocol counts what the extension actually sent.
+            for name in ["wire_bytes_in", "wire_bytes_out"]:
+                counts[name] = getattr(self.ws_connection, "_" + name, counts[name])
+        return counts
 
     def send_json(self, **kw):
-        message = json.dumps(kw)
-        self.msg_bytes_out += len(message)
-        message = self.deflater.compress(message.encode("utf-8"))
-        message += self.deflater.flush(zlib.Z_SYNC_FLUSH)
-        self.wire_bytes_out += len(message)
-        self.write_message(message.decode("latin1"))
+        start = time.perf_counter()
+        message = serialization.dumps(kw)
+        self.message_bytes_out += len(message)
+        frame = self.codec.encode(message)
+        self.wire_bytes_out += len(frame)
+        encoded = time.perf_counter()
+        self.write_message(frame, binary=self.codec.binary)
+        message_type = kw.get("type", "")
+        metrics.SERIALIZE_SECONDS.observe(encoded - start, type=message_type)
+        metrics.WS_WRITE_SECONDS.observe(
+            time.perf_counter() - encoded, type=message_type
+        )
 
     async def on_message(self, message):
+        if self.codec is None:
+            # We're closing the connection; see open().
+            return
         # Decompress incoming message
         self.wire_bytes_in += len(message)
-        message = self.inflater.decompress(message.encode("latin1"))
-        message += self.inflater.flush()
-        message = message.decode("utf-8")
+        message = self.codec.decode(message)
         self.message_bytes_in += len(message)
 
         try:
-            request = json.loads(message)
+            request = serialization.loads(message)
+
+            if request["type"] == "rpc" and request["rpc"].get("method") == "get_rec":
+                # Only the latest keystroke's recs matter, so don't make the
+                # next keystroke wait for these, and drop these when it comes.
+                self.supersede_pending_rec()
+                self.rec_stats["requested"] += 1
+                rec_stats["requested"] += 1
+                self.pending_rec = asyncio.ensure_future(self.do_rpc(request))
 
-            if request["type"] == "rpc":
+            elif request["type"] == "rpc":
                 await self.do_rpc(request)
 
             elif request["type"] == "keyRects":
                 self.keyRects[request["layer"]] = request["keyRects"]
 
             elif request["type"] == "init":
-                self.do_init(request)
+                await self.do_init(request)
 
             elif request["type"] == "get_logs":
-                self.do_get_logs(request)
+                await self.do_get_logs(request)
 
             elif request["type"] == "get_analyzed":
                 self.do_get_analyzed(request)
 
+            elif request["type"] == "get_log_page":
+                await self.do_get_log_page(request)
+
+            elif request["type"] == "subscribe":
+                self.do_subscribe(request)
+
+            elif request["type"] == "unsubscribe":
+                assert self.participant.is_panopticon
+                Panopticon.unsubscribe(self)
+
+            elif request["type"] == "get_snapshot":
+                assert self.participant.is_panopticon
+                if self in Panopticon.subscriptions:
+                    Panopticon.subscriptions[self].request_snapshot()
+
             elif request["type"] == "log":
-                self.do_log(request)
+                await self.do_log(request)
 
             elif request["type"] == "ping":
                 pass
@@ -250,26 +825,60 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler):
                 print("Unknown request type:", request["type"])
             # print(', '.join('{}={}'.format(name, getattr(self.ws_connection, '_'+name)) for name in 'message_bytes_in message_bytes_out wire_bytes_in wire_bytes_out'.split()))
             # print('wire i={wire_bytes_in} o={wire_bytes_out}, msg i={message_bytes_in} o={msg_bytes_out}'.format(**self.__dict__))
+        except asyncio.CancelledError:
+            # On Python < 3.8, this is an Exception.
+            raise
         except Exception:
             traceback.print_exc()
 
+    def supersede_pending_rec(self):
+        """Cancel the get_rec we're working on, if it hasn't replied yet.
+
+        If it's still waiting to be batched (or queued on the pool), its work is
+        never done; if it's already computing, its result is dropped.
+        """
+        if self.pending_rec is not None and not self.pending_rec.done():
+            self.pending_rec.cancel()
+            self.rec_stats["superseded"] += 1
+            rec_stats["superseded"] += 1
+        self.pending_rec = None
+
     async def do_rpc(self, request):
         start = time.time()
+        method = request["rpc"].get("method", "")
         result = dict(type="reply", timestamp=request["timestamp"])
         try:
             result["result"] = await rec_generator.handle_request_async(
-                process_pool, request["rpc"]
+                process_pool, request["rpc"], session=self.participant.participant_id
             )
+            outcome = "degraded" if "degraded" in (result["result"] or {}) else "ok"
+        except asyncio.CancelledError:
+            metrics.RPC_TOTAL.inc(method=method, outcome="superseded")
+            self.log(dict(type="rpc", kind="meta", request=request, superseded=True))
+            return
         except Exception:
+            outcome = "error"
             traceback.print_exc()
-            request_as_string = json.dumps(request)
+            request_as_string = serialization.dumps(request)
             logger.error(f"Request failed: {request_as_string}", exc_info=1)
             print("Failing request:", request_as_string)
             result["result"] = None
         dur = time.time() - start
         result["dur"] = dur
         self.send_json(**result)
-        self.log(dict(type="rpc", kind="meta", request=request))
+        metrics.RPC_SECONDS.observe(time.time() - start, method=method)
+        metrics.RPC_TOTAL.inc(method=method, outcome=outcome)
+        # Log the reply too, so scripts/replay_logs.py can check that changes to the
+        # rec path don't change what it returns.
+        self.log(
+            dict(
+                type="rpc",
+                kind="meta",
+                request=request,
+                reply=result["result"],
+                dur=dur,
+            )
+        )
         logger.info(
             "Request complete: {participant_id} {type} in {dur:.2f}".format(
                 participant_id=getattr(self.participant, "participant_id"),
@@ -278,7 +887,7 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler):
             )
         )
 
-    def do_init(self, request):
+    async def do_init(self, request):
         participant_id = request["participantId"]
         self.kind = request["kind"]
         if participant_id.startswith("demo") or participant_id.startswith("test"):
@@ -294,19 +903,10 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler):
         logger.info(
             f"Client {participant_id}-{self.kind} connecting with messages {messageCount}"
         )
-        backlog = []
-        cur_msg_idx = {}
-        for entry in self.participant.get_log_entries():
-            kind = entry["kind"]
-            if kind == "meta":
-                continue
-            idx = cur_msg_idx.get(kind, 0)
-            if idx >= messageCount.get(kind, 0):
-                backlog.append(entry)
-            cur_msg_idx[kind] = idx + 1
+        backlog = await self.participant.get_backlog(messageCount)
         self.send_json(type="backlog", body=backlog)
 
-    def do_get_logs(self, request):
+    async def do_get_logs(self, request):
         assert self.participant.is_panopticon
         participant_id = request["participantId"]
         validate_participant_id(participant_id)
@@ -314,7 +914,37 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler):
         self.send_json(
             type="logs",
             participant_id=participant_id,
-            logs=participant.get_log_entries(),
+            logs=await participant.get_log_entries(),
+        )
+
+    async def do_get_log_page(self, request):
+        assert self.participant.is_panopticon
+        participant_id = request["participantId"]
+        validate_participant_id(participant_id)
+        participant = Participant.get_participant(participant_id)
+        start = request.get("start", 0)
+        limit = min(request.get("limit", 500), MAX_LOG_PAGE_SIZE)
+        total, entries = await participant.get_log_page(
+            start, limit, request.get("kinds")
+        )
+        self.send_json(
+            type="logPage",
+            participant_id=participant_id,
+            start=start,
+            total=total,
+            entries=entries,
+        )
+
+    def do_subscribe(self, request):
+        """Watch events of some participants and types (by default, all of them)."""
+        assert self.participant.is_panopticon
+        Panopticon.subscribe(
+            self,
+            participant_ids=request.get("participantIds"),
+            event_types=request.get("eventTypes"),
+            delta_interval=max(
+                request.get("deltaInterval", 0.5), MIN_PANOPTICON_DELTA_INTERVAL
+            ),
         )
 
     def do_get_analyzed(self, request):
@@ -328,18 +958,55 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler):
             type="analyzed", participant_id=participant_id, analysis=analysis
         )
 
-    def do_log(self, request):
+    async def do_log(self, request):
         event = request["event"]
-        self.log(event)
+        durable = self.log(event)
+        if event.get("type") == "finalData":
+            await self.completed(durable)
         self.participant.broadcast(
             dict(type="otherEvent", event=event), exclude_conn=self
         )
 
+    async def completed(self, durable):
+        """Mark the participant completed once their finalData is on disk."""
+        participant_id = self.participant.participant_id
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(durable)), DURABLE_LOG_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"finalData for {participant_id} not yet on disk; marking completed"
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f"Failed to save finalData for {participant_id}")
+            return
+        counterbalancing.mark_completed(participant_id)
+        logger.info(f"Participant completed: {participant_id}")
+
     def check_origin(self, origin):
         """Allow any CORS access."""
         return True
 
 
+class WSDictionaryHandler(tornado.web.RequestHandler):
+    """The preset dictionary for "zlib-dict" websocket compression."""
+
+    def get(self):
+        try:
+            dictionary = ws_compression.get_dictionary()
+        except OSError:
+            raise tornado.web.HTTPError(404)
+        self.set_header("Content-Type", "application/octet-stream")
+        self.set_header(
+            ws_compression.DICTIONARY_VERSION_HEADER,
+            ws_compression.get_dictionary_version(),
+        )
+        self.write(dictionary)
+
+
 class WSPingHandler(tornado.websocket.WebSocketHandler):
     def open(self):
         extensions = self.request.headers.get("Sec-WebSocket-Extensions", "")
@@ -363,7 +1030,7 @@ class MainHandler(tornado.web.RequestHandler):
 
 class LoginHandler(tornado.web.RequestHandler):
     def post(self):
-        data = json.loads(self.request.body.decode("utf-8"))
+        data = serialization.loads(self.request.body.decode("utf-8"))
         params = dict(data["params"])
 
         # Allocate a condition.
@@ -377,13 +1044,14 @@ class LoginHandler(tornado.web.RequestHandler):
             counterbalancing_flags = dict(counterbalancing_flags, assignment=assignment)
 
         # Allocate a participant id.
-        while True:
-            participant_id = "".join(random.choices("23456789cfghjmpqrvwx", k=6))
-            if not os.path.exists(get_log_file_name(participant_id)):
-                logger.info(
-                    f"Allocated {participant_id}, flags: {json.dumps(counterbalancing_flags)}"
-                )
-                break
+        participant_id = participant_ids.allocate()
+        logger.info(
+            f"Allocated {participant_id}, flags: {serialization.dumps(counterbalancing_flags)}"
+        )
+
+        counterbalancing.record_login(
+            participant_id, batch, counterbalancing_flags["assignment"]
+        )
 
         # Login that participant.
         participant = Participant.get_participant(participant_id)
@@ -399,16 +1067,60 @@ class LoginHandler(tornado.web.RequestHandler):
 
         # Return participant id.
         self.set_header("Content-Type", "application/json")
-        self.write(json.dumps(dict(participant_id=participant_id)))
+        self.write(serialization.dumps(dict(participant_id=participant_id)))
 
 
 class ApiHandler(tornado.web.RequestHandler):
     async def post(self):
-        rpc = json.loads(self.request.body.decode("utf-8"))
+        rpc = serialization.loads(self.request.body.decode("utf-8"))
         result = await rec_generator.handle_request_async(
             process_pool, rpc
         )
-        self.write(json.dumps(result))
+        self.write(serialization.dumps(result))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.render())
+
+
+def collect_server_stats():
+    """rec_stats and log writer stats, for /metrics."""
+    writer_stats = log_writer.get_stats()
+    return [
+        (
+            "textrec_recs_total",
+            "counter",
+            "get_rec requests, and those superseded by a newer keystroke.",
+            [(dict(event=event), count) for event, count in sorted(rec_stats.items())],
+        ),
+        (
+            "textrec_log_writer_queue_depth",
+            "gauge",
+            "Log lines waiting to be written.",
+            [({}, writer_stats["queue_depth"])],
+        ),
+        (
+            "textrec_log_writer_latency_seconds",
+            "gauge",
+            "Recent time from logging a line to its being written.",
+            [
+                (dict(quantile=quantile), writer_stats[f"latency_{name}"])
+                for quantile, name in [("0.5", "p50"), ("0.99", "p99"), ("1", "max")]
+                if f"latency_{name}" in writer_stats
+            ],
+        ),
+        (
+            "textrec_known_participants",
+            "gauge",
+            "Participants with open logs.",
+            [({}, len(known_participants))],
+        ),
+    ]
+
+
+metrics.register_collector(collect_server_stats)
 
 
 class Application(tornado.web.Application):
@@ -419,13 +1131,50 @@ class Application(tornado.web.Application):
             (r"/login", LoginHandler),
             (r"/api", ApiHandler),
             (r"/ping", WSPingHandler),
+            (r"/ws_dictionary", WSDictionaryHandler),
+            (r"/metrics", MetricsHandler),
             (r"/(style\.css)", tornado.web.StaticFileHandler, dict(path=paths.ui)),
         ]
         tornado.web.Application.__init__(self, handlers, **settings)
 
 
 def main():
+    global process_pool
     tornado.options.parse_command_line()
+    assert options.log_fsync in FSYNC_POLICIES, options.log_fsync
+    log_writer.fsync = options.log_fsync
+    log_writer.fsync_interval = options.log_fsync_interval
+    preload_models()
+    rec_generator.rec_batcher.window = options.rec_batch_window_ms / 1000
+    rec_generator.rec_batcher.max_batch_size = options.rec_batch_size
+    rec_generator.configure_rpc(
+        serialization.loads(options.rpc_config or "{}"), n_threads=options.rpc_threads
+    )
+    process_pool = make_process_pool(options.workers)
+    tornado.autoreload.add_reload_hook(process_pool.shutdown)
+    if options.preload_onmt:
+        rec_generator.rec_batcher.executors = [
+            make_process_pool(1)
+            for i in range(options.onmt_workers or options.workers or os.cpu_count())
+        ]
+        for executor in rec_generator.rec_batcher.executors:
+            tornado.autoreload.add_reload_hook(executor.shutdown)
+    # Autoreload exec()s without running atexit handlers.
+    tornado.autoreload.add_reload_hook(log_writer.sync)
+    log_worker_memory()
+    if options.memory_report_interval:
+        tornado.ioloop.PeriodicCallback(
+            log_worker_memory, options.memory_report_interval * 1000
+        ).start()
+    if options.participant_idle_timeout:
+        tornado.ioloop.PeriodicCallback(
+            lambda: Participant.evict_idle(options.participant_idle_timeout),
+            60 * 1000,
+        ).start()
+    if options.log_writer_report_interval:
+        tornado.ioloop.PeriodicCallback(
+            log_log_writer_stats, options.log_writer_report_interval * 1000
+        ).start()
     app = Application()
     print("serving on", options.port)
     logger.info(f"Serving on port {options.port}")
@@ -0,0 +1,234 @@
+"""
+Beam search and sequence scoring over many per-cluster language models at once.
+
+cueing.cached_lms_per_cluster trains one KenLM model per topic cluster (up to
+128). Loading them all in one process, and looping over them for each query,
+is too slow and too big to do interactively. A ClusterLMPool instead splits
+the models into shards, one per worker process, so each worker loads only its
+own shard, and runs a query on every shard at once.
+
+    pool = ClusterLMPool(cluster_lm_names("yelp", 128), n_workers=8)
+    result = pool.beam_search(["<s>", "the"], beam_width=20, length_after_first=15)
+    result.ranked[:10]  # best phrases over all clusters, with their cluster
+
+From a coroutine, use beam_search_async and score_seqs_async instead, so the
+event loop isn't blocked while the workers run.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from . import lang_model
+from .paths import paths
+
+logger = logging.getLogger(__name__)
+
+RankedPhrase = namedtuple("RankedPhrase", "score, cluster, words, done")
+
+# ranked: RankedPhrase for every cluster's phrases, best first.
+# by_cluster: {cluster: [RankedPhrase, ...]} (or an array of scores, for score_seqs)
+# seconds_by_cluster: compute time for each cluster's model.
+# wall_seconds: time for the whole query.
+FanoutResult = namedtuple(
+    "FanoutResult", "ranked, by_cluster, seconds_by_cluster, wall_seconds"
+)
+
+
+def cluster_lm_names(dataset_name, n_clusters):
+    """{cluster: model name} for the per-cluster models that have been built."""
+    model_basename = f"{dataset_name}_{n_clusters}"
+    names = {}
+    for cluster_idx in range(n_clusters):
+        name = f"{model_basename}_{cluster_idx}"
+        if (paths.models / f"{name}.kenlm").exists():
+            names[cluster_idx] = name
+    return names
+
+
+# In each worker: {cluster: Model} for its shard, and their BeamSessions.
+_shard_models = {}
+_beam_cache = None
+
+
+def _load_shard(model_names, max_sessions, max_bytes):
+    global _beam_cache
+    # Every query makes a BeamSession for each model in the shard.
+    _beam_cache = lang_model.BeamCache(
+        max_sessions=len(model_names) * max_sessions, max_bytes=max_bytes
+    )
+    for cluster_idx, name in model_names.items():
+        model = lang_model.Model.get_or_load_model(name)
+        # Beam search needs these; don't make the first query wait for them.
+        model.ngram_tables
+        _shard_models[cluster_idx] = model
+
+
+def _beam_search_shard(clusters, start_words, top_k, kw):
+    results = {}
+    for cluster_idx in clusters:
+        start = time.perf_counter()
+        entries = lang_model.beam_search_phrases(
+            _shard_models[cluster_idx], start_words, cache=_beam_cache, **kw
+        )
+        results[cluster_idx] = (
+            [
+                RankedPhrase(entry.score, cluster_idx, entry.words, entry.done)
+                for entry in entries[:top_k]
+            ],
+            time.perf_counter() - start,
+        )
+    return results
+
+
+def _score_seqs_shard(clusters, seqs):
+    results = {}
+    for cluster_idx in clusters:
+        start = time.perf_counter()
+        model = _shard_models[cluster_idx]
+        scores = np.array([model.score_seq(model.bos_state, seq)[0] for seq in seqs])
+        results[cluster_idx] = scores, time.perf_counter() - start
+    return results
+
+
+class ClusterLMPool:
+    """
+    Worker processes that each hold a fixed shard of the cluster models.
+
+    A ProcessPoolExecutor hands tasks to whichever worker is free, so each
+    shard gets a single-worker executor of its own; that keeps every query for
+    a cluster on the worker that has its model loaded. Each worker keeps the
+    beam search sessions (see lang_model.BeamCache) of the last `max_sessions`
+    sessions for each of its models, in its share of `max_bytes`.
+    """
+
+    def __init__(
+        self, model_names, n_workers=4, max_sessions=16, max_bytes=512 * 2**20
+    ):
+        clusters = sorted(model_names)
+        n_workers = max(1, min(n_workers, len(clusters)))
+        self.shards = [clusters[i::n_workers] for i in range(n_workers)]
+        self.executors = [
+            concurrent.futures.ProcessPoolExecutor(max_workers=1)
+            for shard in self.shards
+        ]
+        # Start loading now. A worker runs its tasks in order, so queries wait
+        # for the load.
+        self.loads = [
+            executor.submit(
+                _load_shard,
+                {c: model_names[c] for c in shard},
+                max_sessions,
+                max_bytes // n_workers,
+            )
+            for shard, executor in zip(self.shards, self.executors)
+        ]
+
+    def _submit(self, func, *args):
+        return [
+            executor.submit(func, shard, *args)
+            for shard, executor in zip(self.shards, self.executors)
+        ]
+
+    @staticmethod
+    def _merge(shard_results):
+        results = {}
+        for shard_result in shard_results:
+            results.update(shard_result)
+        return results
+
+    def _fan_out(self, func, *args):
+        start = time.perf_counter()
+        for load in self.loads:
+            # Raises if a shard failed to load.
+            load.result()
+        futures = self._submit(func, *args)
+        results = self._merge(future.result() for future in futures)
+        return results, time.perf_counter() - start
+
+    async def _fan_out_async(self, func, *args):
+        start = time.perf_counter()
+        await asyncio.gather(*[asyncio.wrap_future(load) for load in self.loads])
+        futures = self._submit(func, *args)
+        results = self._merge(
+            await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+        )
+        return results, time.perf_counter() - start
+
+    def beam_search(self, start_words, top_k=10, **kw):
+        """Each cluster model's `top_k` phrases (see lang_model.beam_search_phrases).
+
+        Passing a `session` reuses each worker's beam cache between calls.
+        """
+        return self._beam_search_result(
+            *self._fan_out(_beam_search_shard, start_words, top_k, kw)
+        )
+
+    async def beam_search_async(self, start_words, top_k=10, **kw):
+        """beam_search, from a coroutine."""
+        return self._beam_search_result(
+            *await self._fan_out_async(_beam_search_shard, start_words, top_k, kw)
+        )
+
+    @staticmethod
+    def _beam_search_result(results, wall_seconds):
+        by_cluster = {c: phrases for c, (phrases, _) in results.items()}
+        ranked = sorted(
+            (phrase for phrases in by_cluster.values() for phrase in phrases),
+            key=lambda phrase: -phrase.score,
+        )
+        return FanoutResult(
+            ranked=ranked,
+            by_cluster=by_cluster,
+            seconds_by_cluster={c: seconds for c, (_, seconds) in results.items()},
+            wall_seconds=wall_seconds,
+        )
+
+    def score_seqs(self, seqs):
+        """Log-likelihood of each sequence of words (after <s>) under each model.
+
+        `ranked` gives, for each sequence, the clusters from most to least
+        likely.
+        """
+        return self._score_seqs_result(seqs, *self._fan_out(_score_seqs_shard, seqs))
+
+    async def score_seqs_async(self, seqs):
+        """score_seqs, from a coroutine."""
+        return self._score_seqs_result(
+            seqs, *await self._fan_out_async(_score_seqs_shard, seqs)
+        )
+
+    @staticmethod
+    def _score_seqs_result(seqs, results, wall_seconds):
+        clusters = sorted(results)
+        scores = np.array([results[c][0] for c in clusters]).reshape(
+            len(clusters), len(seqs)
+        )
+        return FanoutResult(
+            ranked=np.array(clusters)[np.argsort(-scores, axis=0, kind="stable")].T,
+            by_cluster={c: results[c][0] for c in clusters},
+            seconds_by_cluster={c: results[c][1] for c in clusters},
+            wall_seconds=wall_seconds,
+        )
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown()
+
+
+_pools = {}
+
+
+def get_pool(dataset_name, n_clusters, n_workers=4):
+    """A pool for a dataset's cluster models, started the first time it's needed."""
+    key = (dataset_name, n_clusters)
+    if key not in _pools:
+        model_names = cluster_lm_names(dataset_name, n_clusters)
+        logger.info(
+            f"Starting {n_workers} workers for {len(model_names)} models of {key}"
+        )
+        _pools[key] = ClusterLMPool(model_names, n_workers=n_workers)
+    return _pools[key]
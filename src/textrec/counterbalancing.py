@@ -1,4 +1,6 @@
+import collections
 import json
+import os
 import time
 import numpy as np
 from textrec.paths import paths
@@ -47,7 +49,7 @@ SECS_PER_HOUR = 60 * 60
 
 
 def get_login_event(log_file):
-    with open(log_file) as f:
+    with open(log_file, encoding="utf-8") as f:
         return json.loads(next(f))
 
 
@@ -56,6 +58,15 @@ def completed_fname(participant_id, logdir):
 
 
 def get_completion_data(batch, logdir=paths.logdir):
+    return [
+        completion
+        for completion in get_all_completion_data(logdir)
+        if completion["batch"] == batch
+    ]
+
+
+def get_all_completion_data(logdir=paths.logdir):
+    """Logins and completions of every batch, by reading all the logs."""
     results = []
     for log_file in logdir.glob("*.jsonl"):
         try:
@@ -69,7 +80,8 @@ def get_completion_data(batch, logdir=paths.logdir):
         if login_event.get("type") != "login":
             logger.warning(f"bad logfile {log_file}")
             continue
-        if login_event.get("batch") != batch:
+        if "assignment" not in login_event:
+            # Not from a counterbalanced batch.
             continue
         participant_id = login_event["participant_id"]
         if participant_id in invalid:
@@ -77,6 +89,7 @@ def get_completion_data(batch, logdir=paths.logdir):
         results.append(
             dict(
                 participant_id=participant_id,
+                batch=login_event.get("batch"),
                 login_timestamp=login_event["pyTimestamp"],
                 assignment=login_event["assignment"],
                 completed=completed_fname(participant_id, logdir).exists(),
@@ -87,6 +100,8 @@ def get_completion_data(batch, logdir=paths.logdir):
 
 def mark_completed(participant_id, logdir=paths.logdir):
     completed_fname(participant_id, logdir).touch()
+    if logdir == paths.logdir:
+        get_ledger().record_completion(participant_id)
 
 
 def get_expected_completions(
@@ -110,12 +125,194 @@ def get_expected_completions(
     return expected_completions
 
 
+class Ledger:
+    """
+    Logins and completions, for counterbalancing without reading every log.
+
+    Events are appended to a JSON-lines file as they happen (it's not named
+    .jsonl so it doesn't look like a participant log), and replayed into
+    per-batch counts at startup. Like get_expected_completions, a batch's
+    expected completions for a condition are the number completed plus half the
+    number started within `timeout` that haven't completed yet; `pending` holds
+    the latter in login order, so expiring them is cheap.
+
+    If the file is replaced (e.g., by `rebuild` while the server is running),
+    the next event reloads it, so nothing is appended to the old file.
+    """
+
+    def __init__(self, filename, timeout=3 * SECS_PER_HOUR):
+        self.filename = filename
+        self.timeout = timeout
+        self._load()
+
+    def _load(self):
+        self.participants = {}
+        self.completed = collections.defaultdict(collections.Counter)
+        self.pending = collections.defaultdict(collections.Counter)
+        self.pending_logins = collections.defaultdict(collections.deque)
+        if os.path.exists(self.filename):
+            with open(self.filename, encoding="utf-8") as f:
+                for line in f:
+                    self._apply(json.loads(line))
+        self.file = open(self.filename, "a", encoding="utf-8")
+        self.inode = os.fstat(self.file.fileno()).st_ino
+
+    def _reload_if_replaced(self):
+        try:
+            replaced = os.stat(self.filename).st_ino != self.inode
+        except FileNotFoundError:
+            self.rebuild(self.filename)
+            replaced = True
+        if replaced:
+            logger.info(f"{self.filename} was replaced; reloading it")
+            self.file.close()
+            self._load()
+
+    def _apply(self, event):
+        participant_id = event["participant_id"]
+        if participant_id in invalid:
+            return
+        if event["type"] == "login":
+            batch = event["batch"]
+            self.participants[participant_id] = dict(
+                batch=batch,
+                assignment=event["assignment"],
+                login_timestamp=event["timestamp"],
+                completed=False,
+                pending=True,
+            )
+            self.pending[batch][event["assignment"]] += 1
+            self.pending_logins[batch].append(participant_id)
+        elif event["type"] == "completed":
+            participant = self.participants.get(participant_id)
+            if participant is None or participant["completed"]:
+                return
+            participant["completed"] = True
+            batch = participant["batch"]
+            self.completed[batch][participant["assignment"]] += 1
+            self._unpend(participant)
+
+    def _unpend(self, participant):
+        if participant["pending"]:
+            participant["pending"] = False
+            self.pending[participant["batch"]][participant["assignment"]] -= 1
+
+    def _append(self, event):
+        self._reload_if_replaced()
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._apply(event)
+
+    def record_login(self, participant_id, batch, assignment):
+        self._append(
+            dict(
+                type="login",
+                participant_id=participant_id,
+                batch=batch,
+                assignment=assignment,
+                timestamp=time.time(),
+            )
+        )
+
+    def record_completion(self, participant_id):
+        self._append(
+            dict(type="completed", participant_id=participant_id, timestamp=time.time())
+        )
+
+    def get_expected_completions(self, batch, n_groups):
+        self._reload_if_replaced()
+        now = time.time()
+        logins = self.pending_logins[batch]
+        while logins:
+            participant = self.participants[logins[0]]
+            if participant["pending"] and (
+                now - participant["login_timestamp"] < self.timeout
+            ):
+                break
+            self._unpend(participant)
+            logins.popleft()
+        expected_completions = np.zeros(n_groups)
+        for assignment, count in self.completed[batch].items():
+            expected_completions[assignment] += count
+        for assignment, count in self.pending[batch].items():
+            expected_completions[assignment] += 0.5 * count
+        return expected_completions
+
+    @classmethod
+    def rebuild(cls, filename, logdir=paths.logdir):
+        """Write a ledger from the logs and .completed files."""
+        completions = sorted(
+            get_all_completion_data(logdir), key=lambda c: c["login_timestamp"]
+        )
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "w", encoding="utf-8") as f:
+            for completion in completions:
+                participant_id = completion["participant_id"]
+                event = dict(
+                    type="login",
+                    participant_id=participant_id,
+                    batch=completion["batch"],
+                    assignment=completion["assignment"],
+                    timestamp=completion["login_timestamp"],
+                )
+                f.write(json.dumps(event) + "\n")
+                if completion["completed"]:
+                    completed_time = os.path.getmtime(
+                        completed_fname(participant_id, logdir)
+                    )
+                    event = dict(
+                        type="completed",
+                        participant_id=participant_id,
+                        timestamp=completed_time,
+                    )
+                    f.write(json.dumps(event) + "\n")
+        os.replace(tmp_filename, filename)
+        return len(completions)
+
+
+LEDGER_FILE = paths.logdir / "counterbalancing.ledger"
+_ledger = None
+
+
+def get_ledger():
+    global _ledger
+    if _ledger is None:
+        if not LEDGER_FILE.exists():
+            logger.info(f"Building {LEDGER_FILE} from logs")
+            Ledger.rebuild(LEDGER_FILE)
+        _ledger = Ledger(LEDGER_FILE)
+    return _ledger
+
+
 def get_conditions_for_new_participant(batch):
     batch_data = BATCH_DATA[batch]
-    completion_data = get_completion_data(batch)
-    expected_completions = get_expected_completions(
-        batch_data["n_groups"], completion_data
+    expected_completions = get_ledger().get_expected_completions(
+        batch, batch_data["n_groups"]
     )
     # print(expected_completions)
     assignment = int(np.argmin(expected_completions))
     return dict(batch_data, assignment=assignment)
+
+
+def record_login(participant_id, batch, assignment):
+    get_ledger().record_login(participant_id, batch, assignment)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the counterbalancing ledger.")
+    parser.add_argument("command", choices=["rebuild", "show"])
+    parser.add_argument("--batch", help="batch to show expected completions for")
+    opts = parser.parse_args()
+    if opts.command == "rebuild":
+        n_logins = Ledger.rebuild(LEDGER_FILE)
+        print(f"Rebuilt {LEDGER_FILE} from {n_logins} logins")
+    else:
+        ledger = get_ledger()
+        batches = [opts.batch] if opts.batch else list(BATCH_DATA)
+        for batch in batches:
+            if batch in ledger.pending_logins or batch in ledger.completed:
+                n_groups = BATCH_DATA[batch]["n_groups"]
+                print(batch, ledger.get_expected_completions(batch, n_groups))
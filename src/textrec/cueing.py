@@ -1,5 +1,6 @@
 import logging
 import re
+import time
 from functools import lru_cache
 
 import joblib
@@ -12,7 +13,7 @@ from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 from sklearn.utils import check_random_state
 from tqdm import tqdm
 
-from . import datasets, lang_model, numberbatch_vecs
+from . import datasets, lang_model, model_bundle, numberbatch_vecs
 from .paths import paths
 from .util import VecPile, dump_kenlm, mem
 
@@ -667,12 +668,140 @@ def model_filename(model_name, part):
     return paths.cue_models / f"cue_{model_name}_{part}.joblib"
 
 
+def bundle_path(model_name):
+    return paths.cue_models / f"cue_{model_name}.bundle"
+
+
+_bundles = {}
+
+
+def get_bundle(model_name):
+    """The model's bundle (see model_bundle), or None if it has only joblib parts.
+
+    Not finding one isn't cached, so a bundle written later is picked up.
+    """
+    if model_name not in _bundles:
+        bundle = model_bundle.open_bundle(bundle_path(model_name))
+        if bundle is None:
+            return None
+        _bundles[model_name] = bundle
+    return _bundles[model_name]
+
+
 @lru_cache(maxsize=None)
 def get_model(model_name, part):
+    bundle = get_bundle(model_name)
+    if bundle is not None and part in bundle:
+        return bundle.get(part)
     return joblib.load(model_filename(model_name, part))
 
 
+class TextArray:
+    """A list of strings, stored as one string and the offsets between them."""
+
+    def __init__(self, strings):
+        self.text = "".join(strings)
+        self.offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in strings], out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.text[self.offsets[idx] : self.offsets[idx + 1]]
+
+
+class CueIndex:
+    """
+    The candidate cue sentences of each cluster, laid out for O(1) sampling.
+
+    Cluster c's example sentences (those close to its center) are
+    examples[example_offsets[c] : example_offsets[c + 1]], in their original
+    order; its highlighted sentences (from labels_and_sents) and their label
+    spans are laid out the same way.
+    """
+
+    def __init__(
+        self, example_offsets, examples, highlighted_offsets, highlighted, spans
+    ):
+        self.example_offsets = example_offsets
+        self.examples = examples
+        self.highlighted_offsets = highlighted_offsets
+        self.highlighted = highlighted
+        self.spans = spans
+
+    @classmethod
+    def build(cls, model_name):
+        sentences = get_model(model_name, "sentences")
+        is_close = np.asarray(get_model(model_name, "is_close"), dtype=bool)
+        labels_and_sents = get_model(model_name, "labels_and_sents")
+        n_clusters = len(get_model(model_name, "labels"))
+
+        topics = sentences.topic.to_numpy()[is_close]
+        raw_sents = sentences.raw_sent.to_numpy()[is_close]
+        n_clusters = max([n_clusters, topics.max() + 1 if len(topics) else 0])
+        by_topic = np.argsort(topics, kind="stable")
+        example_offsets = np.searchsorted(topics[by_topic], np.arange(n_clusters + 1))
+
+        highlighted_counts = np.zeros(n_clusters, dtype=np.int64)
+        highlighted = []
+        spans = []
+        for cluster_idx in range(n_clusters):
+            if cluster_idx not in labels_and_sents:
+                continue
+            label, candidates = labels_and_sents[cluster_idx]
+            highlighted_counts[cluster_idx] = len(candidates)
+            for sentence, span in candidates:
+                highlighted.append(sentence)
+                spans.append(span)
+        highlighted_offsets = np.zeros(n_clusters + 1, dtype=np.int64)
+        np.cumsum(highlighted_counts, out=highlighted_offsets[1:])
+
+        return cls(
+            example_offsets=example_offsets.astype(np.int64),
+            examples=TextArray(raw_sents[by_topic].tolist()),
+            highlighted_offsets=highlighted_offsets,
+            highlighted=TextArray(highlighted),
+            spans=np.array(spans, dtype=np.int32).reshape(-1, 2),
+        )
+
+    def _count(self, offsets, cluster_idx):
+        if not 0 <= cluster_idx < len(offsets) - 1:
+            return 0
+        return int(offsets[cluster_idx + 1] - offsets[cluster_idx])
+
+    def n_examples(self, cluster_idx):
+        return self._count(self.example_offsets, cluster_idx)
+
+    def example(self, cluster_idx, idx):
+        return self.examples[self.example_offsets[cluster_idx] + idx]
+
+    def n_highlighted(self, cluster_idx):
+        return self._count(self.highlighted_offsets, cluster_idx)
+
+    def highlighted_example(self, cluster_idx, idx):
+        """A sentence and the (start, end) of the cluster's label in it."""
+        pos = self.highlighted_offsets[cluster_idx] + idx
+        return self.highlighted[pos], self.spans[pos].tolist()
+
+
+@lru_cache(maxsize=None)
+def get_cue_index(model_name):
+    return CueIndex.build(model_name)
+
+
 def preload_models(model_names, parts):
     for name in model_names:
+        start = time.perf_counter()
+        bundle = get_bundle(name)
+        if bundle is not None:
+            bundle.warm_up(parts)
         for part in parts:
             get_model(name, part)
+        if "sentences" in parts:
+            # Build these now rather than on the first cue request.
+            get_cue_index(name)
+        source = "bundle" if bundle is not None else "joblib"
+        logger.info(
+            f"Loaded cue model {name} from {source} in {time.perf_counter() - start:.1f}s"
+        )
@@ -0,0 +1,91 @@
+"""
+Image features for the captioning models, indexed by COCO id.
+
+The features come in an HDF5 file with one (objects x feature_dim) float64
+dataset per image. Opening that file on every encoder cache miss put HDF5 on the
+request path, so we convert it once into a sidecar (see sidecar.py) holding a
+sorted array of COCO ids and a float32 (images x objects x feature_dim) array,
+which every process memory-maps.
+
+The study uses a fixed set of stimulus images (paths.imgdata_h5 is the subset
+file made for them), so the store's ids double as the list of stimuli whose
+encodings are worth computing ahead of time.
+"""
+import logging
+import os
+
+import numpy as np
+
+from .paths import paths
+from .sidecar import Sidecar, SidecarMissing
+
+logger = logging.getLogger(__name__)
+
+
+class ImageFeatureStore:
+    def __init__(self, coco_ids, features):
+        self.coco_ids = coco_ids
+        self.features = features
+
+    @classmethod
+    def from_h5(cls, filename):
+        import h5py
+
+        with h5py.File(str(filename), "r") as f:
+            coco_ids = np.array(sorted(int(key) for key in f.keys()), dtype=np.int64)
+            if len(coco_ids):
+                shape = f[str(coco_ids[0])].shape
+            else:
+                shape = (0, 0)
+            features = np.empty((len(coco_ids),) + shape, dtype=np.float32)
+            for i, coco_id in enumerate(coco_ids):
+                features[i] = f[str(coco_id)][:]
+        return cls(coco_ids, features)
+
+    @classmethod
+    def load(cls, filename):
+        """Load the store for an HDF5 file, converting it if needed."""
+        sidecar = Sidecar(os.path.splitext(str(filename))[0], [filename])
+        try:
+            arrays = sidecar.read_arrays(["coco_ids", "features"])
+            return cls(arrays["coco_ids"], arrays["features"])
+        except SidecarMissing:
+            pass
+        logger.info(f"Converting image features from {filename}")
+        store = cls.from_h5(filename)
+        try:
+            sidecar.write(
+                arrays=dict(coco_ids=store.coco_ids, features=store.features)
+            )
+        except OSError:
+            logger.exception(f"Couldn't save image features to {sidecar.path}")
+        return store
+
+    def __len__(self):
+        return len(self.coco_ids)
+
+    def __contains__(self, coco_id):
+        pos = np.searchsorted(self.coco_ids, coco_id)
+        return pos < len(self.coco_ids) and self.coco_ids[pos] == coco_id
+
+    def rows(self, coco_ids):
+        coco_ids = np.asarray(coco_ids, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.coco_ids, coco_ids), len(self) - 1)
+        missing = self.coco_ids[rows] != coco_ids
+        if np.any(missing):
+            raise KeyError(f"No image features for {coco_ids[missing].tolist()}")
+        return rows
+
+    def get(self, coco_ids):
+        """Features of some images, as an (images x objects x feature_dim) array."""
+        return self.features[self.rows(coco_ids)]
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = ImageFeatureStore.load(paths.imgdata_h5)
+    return _store
@@ -1,19 +1,22 @@
-import heapq
 import itertools
 import os
 import string
 import subprocess
 import sys
-from collections import defaultdict, namedtuple
+import time
+from collections import OrderedDict, namedtuple
 
 import nltk
 import numpy as np
+
 # from scipy.misc import logsumexp
 
 import datrie
 import kenlm
 
+from .ngram_tables import BigramIndex, NgramTables
 from .paths import paths
+from .sidecar import Sidecar, SidecarMissing
 
 LOG10 = np.log(10)
 
@@ -32,41 +35,32 @@ def get_arpa_data(filename):
             parts = line.split("\t")
             unigram_probs.append(float(parts[0]))
             vocab.append(parts[1])
+        unigram_probs = np.array(unigram_probs) * LOG10
 
+        # Word ids are positions in the unigram list; Model._load checks that
+        # these match KenLM's.
+        word2id = {word: i for i, word in enumerate(vocab)}
         while not f.readline().startswith("\\2-grams:"):
             continue
-        bigrams = defaultdict(list)
+        prev_ids = []
+        next_ids = []
+        probs = []
         for line in f:
             line = line.strip()
             if not line:
                 break  # end of 2-grams
             parts = line.split("\t")
-            prob = float(parts[0])
             a, b = parts[1].split(" ")
-            bigrams[a].append((prob, b))
-
-        return vocab, np.array(unigram_probs) * LOG10, bigrams
-
-
-def encode_bigrams(bigrams, model):
-    encoded_bigrams = {}
-    for prev, nexts in bigrams.items():
-        prev_id = model.vocab_index(prev)
-        next_ids = []
-        for prob, b in nexts:
-            next_id = model.vocab_index(b)
-            next_ids.append((prob, next_id))
-        encoded_bigrams[prev_id] = next_ids
-
-    def pull_2nd(lst):
-        return [x[1] for x in lst]
-
-    unfiltered_bigrams = {a: pull_2nd(nexts) for a, nexts in encoded_bigrams.items()}
-    # Most common bigrams (sorted by probability)
-    filtered_bigrams = {
-        a: pull_2nd(heapq.nlargest(100, nexts)) for a, nexts in encoded_bigrams.items()
-    }
-    return unfiltered_bigrams, filtered_bigrams
+            prev_ids.append(word2id[a])
+            next_ids.append(word2id[b])
+            probs.append(float(parts[0]))
+
+        bigrams = (
+            np.array(prev_ids, dtype=np.int32),
+            np.array(next_ids, dtype=np.int32),
+            np.array(probs, dtype=np.float32) * np.float32(LOG10),
+        )
+        return vocab, unigram_probs, bigrams
 
 
 class Model:
@@ -107,6 +101,30 @@ class Model:
         print("Loading model", self.name, "...", file=sys.stderr, end="")
         self.model = kenlm.LanguageModel(self.model_file)
 
+        # Everything we derive from the ARPA file is cached in a sidecar.
+        self.sidecar = Sidecar(
+            os.path.splitext(self.model_file)[0], [self.arpa_file, self.model_file]
+        )
+        try:
+            self._load_from_sidecar()
+        except SidecarMissing:
+            self._load_from_arpa()
+            try:
+                self._save_sidecar()
+            except OSError as e:
+                print(f" (couldn't save sidecar: {e})", file=sys.stderr, end="")
+
+        # Since we give rare-word bonuses, count special words as super-common.
+        self.unigram_probs_wordsonly = np.array(self.unigram_probs)
+        self.unigram_probs_wordsonly[self.is_special] = 0
+        # Most common bigrams (sorted by probability)
+        self.filtered_bigrams = self.unfiltered_bigrams.top(100)
+
+        self.eos_idx = self.model.vocab_index("</S>")
+        self.eop_idx = self.model.vocab_index("</s>")
+        print("Loaded.", file=sys.stderr)
+
+    def _load_from_arpa(self):
         print(" reading raw ARPA data ... ", file=sys.stderr, end="")
         self.id2str, self.unigram_probs, bigrams = get_arpa_data(self.arpa_file)
         self.is_special = np.zeros(len(self.id2str), dtype=bool)
@@ -114,17 +132,12 @@ class Model:
             assert self.model.vocab_index(word) == i, i
             if word[0] not in string.ascii_lowercase:
                 self.is_special[i] = True
-        # Since we give rare-word bonuses, count special words as super-common.
-        self.unigram_probs_wordsonly = self.unigram_probs.copy()
-        self.unigram_probs_wordsonly[self.is_special] = 0
-        # ... but for finding the most common fallback words, count special words as impossible.
+        # For finding the most common fallback words, count special words as impossible.
         unigram_probs_wordsonly_2 = self.unigram_probs.copy()
         unigram_probs_wordsonly_2[self.is_special] = -np.inf
         self.most_common_words_by_idx = np.argsort(unigram_probs_wordsonly_2)[-500:]
         print(" Encoding bigrams to indices... ", file=sys.stderr, end="")
-        self.unfiltered_bigrams, self.filtered_bigrams = encode_bigrams(
-            bigrams, self.model
-        )
+        self.unfiltered_bigrams = BigramIndex.from_pairs(*bigrams, len(self.id2str))
 
         # Vocab trie
         self.vocab_trie = datrie.BaseTrie(
@@ -133,23 +146,33 @@ class Model:
         for i, s in enumerate(self.id2str):
             self.vocab_trie[s] = i
 
-        self.eos_idx = self.model.vocab_index("</S>")
-        self.eop_idx = self.model.vocab_index("</s>")
-        print("Loaded.", file=sys.stderr)
+    def _load_from_sidecar(self):
+        sidecar = self.sidecar
+        self.id2str = sidecar.read_lines("vocab")
+        self.unigram_probs = sidecar.read_array("unigram_probs")
+        self.is_special = sidecar.read_array("is_special")
+        self.most_common_words_by_idx = sidecar.read_array("most_common_words_by_idx")
+        self.unfiltered_bigrams = BigramIndex.from_arrays(
+            sidecar.read_arrays(BigramIndex.ARRAYS_SAVED)
+        )
+        self.vocab_trie = sidecar.read_with("vocab.trie", datrie.BaseTrie.load)
+        print(" (from sidecar) ", file=sys.stderr, end="")
+
+    def _save_sidecar(self):
+        self.sidecar.write(
+            arrays=dict(
+                unigram_probs=self.unigram_probs,
+                is_special=self.is_special,
+                most_common_words_by_idx=self.most_common_words_by_idx,
+                **self.unfiltered_bigrams.arrays(),
+            ),
+            lines=dict(vocab=self.id2str),
+            savers={"vocab.trie": self.vocab_trie.write},
+        )
 
     def prune_bigrams(self):
         # Filter bigrams to only include words that actually follow
-        bigrams = self.unfiltered_bigrams
-        while True:
-            new_bigrams = {
-                k: [tok for tok in v if len(bigrams.get(tok, [])) > 0]
-                for k, v in bigrams.items()
-            }
-            new_bigrams_trim = {k: v for k, v in new_bigrams.items() if len(v) > 0}
-            if len(new_bigrams) == len(new_bigrams_trim):
-                break
-            bigrams = new_bigrams_trim
-        self.unfiltered_bigrams = bigrams
+        self.unfiltered_bigrams = self.unfiltered_bigrams.pruned()
 
     def _compute_pos(self):
         print("Computing pos tags")
@@ -180,6 +203,37 @@ class Model:
             )
         return self._word_lengths
 
+    @property
+    def phrase_word_ok(self):
+        """Which words can go in a phrase: not sentence ends or punctuation."""
+        if not hasattr(self, "_phrase_word_ok"):
+            ok = np.array([not w or w[0] not in ".?!" for w in self.id2str])
+            ok[[self.eos_idx, self.eop_idx]] = False
+            self._phrase_word_ok = ok
+        return self._phrase_word_ok
+
+    @property
+    def ngram_tables(self):
+        if not hasattr(self, "_ngram_tables"):
+            self._ngram_tables = self._load_ngram_tables()
+        return self._ngram_tables
+
+    def _load_ngram_tables(self):
+        try:
+            order = len(self.sidecar.read_array("ngram_counts"))
+            arrays = self.sidecar.read_arrays(
+                ["ngram_counts"] + NgramTables.array_names(order)
+            )
+            return NgramTables.from_arrays(self.id2str, arrays)
+        except SidecarMissing:
+            pass
+        tables = NgramTables.from_arpa(self.arpa_file)
+        try:
+            self.sidecar.write(arrays=tables.arrays())
+        except OSError as e:
+            print(f"Couldn't save n-gram tables to sidecar: {e}", file=sys.stderr)
+        return tables
+
     @property
     def bos_state(self):
         state = kenlm.State()
@@ -200,6 +254,15 @@ class Model:
         score, state = self.score_seq(state, words)
         return state, score
 
+    def get_context(self, words, bos=False):
+        """Like get_state, but returns a context for the array-backed scorer."""
+        tables = self.ngram_tables
+        context = (self.model.vocab_index("<s>"),) if bos else ()
+        score, context = tables.score_seq(
+            tables.trim_context(context), [self.model.vocab_index(w) for w in words]
+        )
+        return context, score
+
     def score_seq(self, state, words):
         score = 0.0
         for word in words:
@@ -243,11 +306,11 @@ class Model:
                     next_words.append(word_idx)
                     prior_logprobs.append(logprob)
         else:
-            next_words = bigrams.get(self.model.vocab_index(prev_word), [])
+            next_words = bigrams[self.model.vocab_index(prev_word)]
             if len(next_words) == 0:
-                next_words = bigrams.get(self.model.vocab_index("<S>"), [])
-            next_words = [
-                w for w in next_words if w != self.eos_idx and w != self.eop_idx
+                next_words = bigrams[self.model.vocab_index("<S>")]
+            next_words = next_words[
+                (next_words != self.eos_idx) & (next_words != self.eop_idx)
             ]
         if len(next_words) == 0:
             return [], np.zeros(0)
@@ -266,6 +329,17 @@ class Model:
         logprobs *= LOG10
         return logprobs
 
+    def eval_logprobs_for_words_batch(self, context, next_words):
+        """Vectorized eval_logprobs_for_words, given a context from get_context."""
+        return self.ngram_tables.score(context, next_words)
+
+    def eval_logprobs_for_words_multi(self, contexts, next_words):
+        """Logprobs of the same next words after each context, e.g., a whole beam.
+
+        Returns a (len(contexts) x len(next_words)) array.
+        """
+        return self.ngram_tables.score_multi(contexts, next_words)
+
 
 def dump_kenlm(model_name, tokenized_sentences, **model_args):
     # Dump tokenized sents / docs, one per line,
@@ -304,13 +378,236 @@ BeamEntry = namedtuple(
 )
 
 
-def beam_search_phrases_init(model, start_words, **kw):
+# Rough size of a dict entry with a small tuple key, for BeamStates.nbytes.
+_ENTRY_BYTES = 200
+
+
+class BeamStates:
+    """
+    The n-gram contexts a beam search has visited, interned as integer ids.
+
+    Hypotheses that end the same way share a context, so memoizing by id means
+    each distinct context is advanced, and its candidate next words scored,
+    only once per search rather than once per hypothesis per iteration. A
+    BeamSession keeps one across searches, so typing on reuses all of that.
+
+    `nbytes` estimates the memory it holds, for BeamCache's budget.
+    """
+
+    def __init__(self, model, max_starts=1024):
+        self.model = model
+        self.tables = model.ngram_tables
+        self.contexts = []
+        self.ids = {}
+        # Each context's rows in the n-gram tables; see NgramTables.score_batch.
+        self._rows = []
+        self._row_matrix = np.zeros((0, self.tables.order - 1), dtype=np.int64)
+        self._advanced = {}
+        self._candidates = {}
+        # Start words -> state, most recently used last.
+        self._starts = OrderedDict()
+        self.max_starts = max_starts
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.contexts)
+
+    def start_state(self, start_words):
+        """The context after <s> and start_words, like Model.get_context.
+
+        Advances from the longest prefix of start_words seen before, so when the
+        typist has added a word, only that word needs scoring.
+        """
+        start_words = tuple(start_words)
+        for length in range(len(start_words), -1, -1):
+            state = self._starts.get(start_words[:length])
+            if state is not None:
+                break
+        else:
+            length = 0
+            bos = (self.model.model.vocab_index("<s>"),)
+            state = self.intern(self.tables.trim_context(bos))
+        for word in start_words[length:]:
+            state = self.advance(
+                np.array([state]), np.array([self.model.model.vocab_index(word)])
+            )[0]
+            length += 1
+            self._starts[start_words[:length]] = state
+        self._starts[start_words] = state
+        self._starts.move_to_end(start_words)
+        while len(self._starts) > self.max_starts:
+            self._starts.popitem(last=False)
+        return int(state)
+
+    def intern(self, context, rows=None):
+        state = self.ids.get(context)
+        if state is None:
+            if rows is None:
+                rows = self.tables.context_row_matrix([context])[0]
+            state = self.ids[context] = len(self.contexts)
+            self.contexts.append(context)
+            self._rows.append(rows)
+            # The rows are also copied into _row_matrix.
+            self.nbytes += 2 * rows.nbytes + 3 * _ENTRY_BYTES
+        return state
+
+    @property
+    def rows(self):
+        if len(self._row_matrix) < len(self._rows):
+            self._row_matrix = np.concatenate(
+                [self._row_matrix, np.array(self._rows[len(self._row_matrix) :])]
+            )
+        return self._row_matrix
+
+    def advance(self, state_ids, words):
+        """The context after each context state_ids[i] and word words[i]."""
+        keys = list(zip(state_ids.tolist(), words.tolist()))
+        missing = [key for key in dict.fromkeys(keys) if key not in self._advanced]
+        if missing:
+            new_rows = self.tables.advance_rows(
+                self.rows[[state for state, _ in missing]],
+                [word_idx for _, word_idx in missing],
+            )
+            lengths = (new_rows >= 0).sum(axis=1).tolist()
+            for (state, word_idx), rows, length in zip(missing, new_rows, lengths):
+                context = self.contexts[state] + (word_idx,)
+                context = context[len(context) - length :]
+                self._advanced[state, word_idx] = self.intern(context, rows)
+            self.nbytes += len(missing) * _ENTRY_BYTES
+        return np.array([self._advanced[key] for key in keys], dtype=np.int64)
+
+    def score(self, state_ids, words):
+        """Scores of words[i] after context state_ids[i]."""
+        return self.tables.score_batch(self.rows[state_ids], words)
+
+    def candidates(self, state_ids, last_words, first):
+        """Candidate next words after each context, and their logprobs.
+
+        Scores all the ones not seen before in one batch.
+        """
+        keys = [
+            (state, last_word_idx, first)
+            for state, last_word_idx in zip(state_ids.tolist(), last_words.tolist())
+        ]
+        missing = [key for key in dict.fromkeys(keys) if key not in self._candidates]
+        if missing:
+            word_lists = []
+            for state, last_word_idx, first in missing:
+                words = phrase_candidates(self.model, last_word_idx, first)
+                word_lists.append(words[self.model.phrase_word_ok[words]])
+            counts = [len(words) for words in word_lists]
+            scores = self.score(
+                np.repeat([state for state, _, _ in missing], counts),
+                np.concatenate(word_lists),
+            )
+            for key, words, key_scores in zip(
+                missing, word_lists, np.split(scores, np.cumsum(counts)[:-1])
+            ):
+                self._candidates[key] = words, key_scores
+                self.nbytes += words.nbytes + key_scores.nbytes + _ENTRY_BYTES
+        return [self._candidates[key] for key in keys]
+
+
+def phrase_candidates(model, last_word_idx, first):
+    """Word ids worth considering after `last_word_idx` in a phrase."""
+    bigrams = model.unfiltered_bigrams if first else model.filtered_bigrams
+    next_words = bigrams.get(last_word_idx, [])
+    if len(next_words) < 10:
+        if first:
+            # Fall back to all common words.
+            next_words = model.most_common_words_by_idx
+        else:
+            # Use the larger set of possible next words
+            next_words = model.unfiltered_bigrams.get(last_word_idx, [])
+            if len(next_words) < 10:
+                next_words = model.most_common_words_by_idx
+    return np.asarray(next_words, dtype=np.int32)
+
+
+class Beam:
+    """
+    The hypotheses of a phrase beam search, as parallel arrays.
+
+    Hypothesis i has total score `scores[i]`, ends with word `last_words[i]`,
+    and, if not done, is in context `state_ids[i]` (an id from `states`). Its
+    words are found by following back-pointers from node `nodes[i]`. Nodes are
+    shared by all the beams of one search, so extending never copies word lists.
+    """
+
+    def __init__(
+        self,
+        states,
+        scores,
+        done,
+        last_words,
+        num_chars,
+        state_ids,
+        nodes,
+        node_table,
+        iteration=0,
+    ):
+        self.states = states
+        self.scores = scores
+        self.done = done
+        self.last_words = last_words
+        self.num_chars = num_chars
+        self.state_ids = state_ids
+        self.nodes = nodes
+        # Lists of each node's parent node, word, and the context before the word.
+        self.node_table = node_table
+        # How many times it's been extended; the next iteration_num.
+        self.iteration = iteration
+
+    def __len__(self):
+        return len(self.scores)
+
+    def word_ids(self, i):
+        node_parents, node_words, _ = self.node_table
+        words = []
+        node = self.nodes[i]
+        while node >= 0:
+            words.append(node_words[node])
+            node = node_parents[node]
+        return words[::-1]
+
+    def words(self, i):
+        id2str = self.states.model.id2str
+        return [id2str[word_idx] for word_idx in self.word_ids(i)]
+
+    def entries(self):
+        """The hypotheses as BeamEntry tuples, best first."""
+        _, _, node_prev_states = self.node_table
+        contexts = self.states.contexts + [None]
+        return [
+            BeamEntry(
+                float(self.scores[i]),
+                self.words(i),
+                bool(self.done[i]),
+                # The context the last word was scored in, like a KenLM State.
+                contexts[node_prev_states[self.nodes[i]] if self.nodes[i] >= 0 else -1],
+                int(self.last_words[i]),
+                int(self.num_chars[i]),
+                None,
+            )
+            for i in np.argsort(-self.scores, kind="stable")
+        ]
+
+
+def beam_search_phrases_init(model, start_words, states=None, **kw):
     if isinstance(model, str):
         model = Model.get_model(model)
-    start_state, start_score = model.get_state(start_words, bos=True)
-    return [
-        (0.0, [], False, start_state, model.model.vocab_index(start_words[-1]), 0, None)
-    ]
+    if states is None:
+        states = BeamStates(model)
+    return Beam(
+        states,
+        scores=np.zeros(1),
+        done=np.zeros(1, dtype=bool),
+        last_words=np.array([model.model.vocab_index(start_words[-1])], dtype=np.int32),
+        num_chars=np.zeros(1, dtype=np.int64),
+        state_ids=np.array([states.start_state(start_words)], dtype=np.int64),
+        nodes=np.array([-1], dtype=np.int64),
+        node_table=([], [], []),
+    )
 
 
 def beam_search_phrases_extend(
@@ -323,101 +620,139 @@ def beam_search_phrases_extend(
     prefix_logprobs=None,
     bonus_words={},
 ):
+    """
+    Extend each unfinished hypothesis by one word, keeping the best `beam_width`.
+
+    All candidates of all hypotheses are scored into one array and the best are
+    picked with argpartition; finished hypotheses compete with them as they are.
+    """
     if isinstance(model, str):
         model = Model.get_model(model)
-
-    bigrams = model.unfiltered_bigrams if iteration_num == 0 else model.filtered_bigrams
-    DONE = 2
-    new_beam = [ent for ent in beam if ent[DONE]]
-    new_beam_size = len(new_beam)
-    for entry in beam:
-        score, words, done, penultimate_state, last_word_idx, num_chars, _ = entry
-        if done:
-            continue
-        else:
-            if iteration_num > 0:
-                last_state = kenlm.State()
-                model.model.base_score_from_idx(
-                    penultimate_state, last_word_idx, last_state
-                )
-            else:
-                last_state = penultimate_state
-
-            # Get candidate words to evaluate.
-            probs = None
-            if iteration_num == 0 and prefix_logprobs is not None:
-                next_words = []
-                probs = []
-                for prob, prefix in prefix_logprobs:
-                    for word, word_idx in model.vocab_trie.items(prefix):
-                        next_words.append(word_idx)
-                        probs.append(prob)
-            else:
-                # print(id2str[last_word])
-                next_words = bigrams.get(last_word_idx, [])
-                if len(next_words) < 10:
-                    if iteration_num == 0:
-                        # Fall back to all common words.
-                        next_words = model.most_common_words_by_idx
-                    else:
-                        # Use the larger set of possible next words
-                        next_words = model.unfiltered_bigrams.get(last_word_idx, [])
-                        if len(next_words) < 10:
-                            next_words = model.most_common_words_by_idx
-
-            # Evaluate candidate words.
-            new_state = kenlm.State()
-            for next_idx, word_idx in enumerate(next_words):
-                # Never end sentences.
-                if word_idx == model.eos_idx or word_idx == model.eop_idx:
-                    continue
-                if probs is not None:
-                    prob = probs[next_idx]
-                else:
-                    prob = 0.0
-                word = model.id2str[word_idx]
-                if word[0] in ".?!":
-                    continue
-                if word in words:
-                    # Don't double-bonus.
-                    bonus = 0.0
-                else:
-                    bonus = bonus_words.get(word, 0.0)
-
-                main_model_score = LOG10 * model.model.base_score_from_idx(
-                    last_state, word_idx, new_state
-                )
-                new_score = score + prob + main_model_score + bonus
-                new_words = words + [word]
-                new_num_chars = num_chars + 1 + len(word) if iteration_num else 0
-                done = new_num_chars >= length_after_first
-
-                # Add this new entry to the beam.
-                new_entry = (
-                    new_score,
-                    new_words,
-                    done,
-                    last_state,
-                    word_idx,
-                    new_num_chars,
-                    None,
-                )
-                if new_beam_size == beam_width:
-                    heapq.heappushpop(new_beam, new_entry)
-                    # Beam size unchanged.
-                else:
-                    new_beam.append(new_entry)
-                    new_beam_size += 1
-                    if new_beam_size == beam_width:
-                        heapq.heapify(new_beam)
-                # assert len(new_beam) <= beam_width
-    return new_beam
-
-
-def beam_search_phrases_loop(
-    model, beam, *, length_after_first, prefix_logprobs=None, start_idx=0, **kw
+    states = beam.states
+    first = iteration_num == 0
+    live = np.flatnonzero(~beam.done)
+    finished = np.flatnonzero(beam.done)
+
+    # Candidate next words of each live hypothesis, concatenated.
+    if first and prefix_logprobs is not None:
+        prefix_words = []
+        prefix_probs = []
+        for prob, prefix in prefix_logprobs:
+            for word, word_idx in model.vocab_trie.items(prefix):
+                prefix_words.append(word_idx)
+                prefix_probs.append(prob)
+        prefix_words = np.array(prefix_words, dtype=np.int32)
+        prefix_probs = np.array(prefix_probs)
+        ok = model.phrase_word_ok[prefix_words]
+        prefix_words, prefix_probs = prefix_words[ok], prefix_probs[ok]
+        word_lists = [prefix_words] * len(live)
+        scores = states.score(
+            np.repeat(beam.state_ids[live], len(prefix_words)),
+            np.tile(prefix_words, len(live)),
+        )
+        score_lists = (
+            [prefix_probs + live_scores for live_scores in np.split(scores, len(live))]
+            if len(live)
+            else []
+        )
+    else:
+        candidates = states.candidates(
+            beam.state_ids[live], beam.last_words[live], first
+        )
+        word_lists = [words for words, _ in candidates]
+        score_lists = [scores for _, scores in candidates]
+    counts = [len(words) for words in word_lists]
+    parents = np.repeat(live, counts)
+    words = np.concatenate(word_lists) if word_lists else np.zeros(0, dtype=np.int32)
+    scores = beam.scores[parents]
+    if counts:
+        scores = scores + np.concatenate(score_lists)
+
+    if bonus_words:
+        bonus = np.zeros(len(model.id2str))
+        for word, value in bonus_words.items():
+            word_idx = model.model.vocab_index(word)
+            if model.id2str[word_idx] == word:
+                bonus[word_idx] = value
+        candidate_bonus = bonus[words]
+        # Don't double-bonus a word that's already in the phrase.
+        word_sets = {}
+        for j in np.flatnonzero(candidate_bonus):
+            parent = parents[j]
+            if parent not in word_sets:
+                word_sets[parent] = set(beam.word_ids(parent))
+            if words[j] in word_sets[parent]:
+                candidate_bonus[j] = 0.0
+        scores += candidate_bonus
+
+    # Pick the best of the finished hypotheses and the new candidates.
+    all_scores = np.concatenate([beam.scores[finished], scores])
+    if len(all_scores) > beam_width:
+        keep = np.argpartition(-all_scores, beam_width - 1)[:beam_width]
+    else:
+        keep = np.arange(len(all_scores))
+    keep_finished = finished[keep[keep < len(finished)]]
+    keep_new = keep[keep >= len(finished)] - len(finished)
+
+    new_parents = parents[keep_new]
+    new_words = words[keep_new]
+    if first:
+        new_num_chars = np.zeros(len(keep_new), dtype=np.int64)
+    else:
+        new_num_chars = beam.num_chars[new_parents] + 1 + model.word_lengths[new_words]
+    new_done = new_num_chars >= length_after_first
+
+    node_parents, node_words, node_prev_states = beam.node_table
+    new_nodes = np.arange(len(node_parents), len(node_parents) + len(keep_new))
+    node_parents.extend(beam.nodes[new_parents].tolist())
+    node_words.extend(new_words.tolist())
+    node_prev_states.extend(beam.state_ids[new_parents].tolist())
+    new_state_ids = np.full(len(keep_new), -1, dtype=np.int64)
+    new_state_ids[~new_done] = states.advance(
+        beam.state_ids[new_parents[~new_done]], new_words[~new_done]
+    )
+
+    return Beam(
+        states,
+        scores=np.concatenate([beam.scores[keep_finished], scores[keep_new]]),
+        done=np.concatenate([beam.done[keep_finished], new_done]),
+        last_words=np.concatenate([beam.last_words[keep_finished], new_words]),
+        num_chars=np.concatenate([beam.num_chars[keep_finished], new_num_chars]),
+        state_ids=np.concatenate([beam.state_ids[keep_finished], new_state_ids]),
+        nodes=np.concatenate([beam.nodes[keep_finished], new_nodes]),
+        node_table=beam.node_table,
+        iteration=iteration_num + 1,
+    )
+
+
+def beam_search_phrases_run(
+    model,
+    beam,
+    *,
+    length_after_first,
+    prefix_logprobs=None,
+    start_idx=None,
+    time_budget=None,
+    **kw,
 ):
+    """
+    Extend `beam` from iteration `start_idx` (default: where it left off) until
+    its phrases are long enough, and return the final beam.
+
+    With a `time_budget` (seconds), stops early once that's used up, after at
+    least one iteration; running it again on the returned beam picks up there.
+    """
+    if start_idx is None:
+        start_idx = beam.iteration
+    if time_budget is not None:
+        deadline = time.perf_counter() + time_budget
     for iteration_num in range(start_idx, length_after_first):
+        if (
+            time_budget is not None
+            and iteration_num > start_idx
+            and time.perf_counter() > deadline
+        ):
+            break
         beam = beam_search_phrases_extend(
             model,
             beam,
@@ -427,11 +762,113 @@ def beam_search_phrases_loop(
             **kw,
         )
         prefix_logprobs = None
-    return [BeamEntry(*ent) for ent in sorted(beam, reverse=True)]
+    return beam
+
+
+def beam_search_phrases_loop(model, beam, **kw):
+    return beam_search_phrases_run(model, beam, **kw).entries()
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class BeamSession:
+    """
+    Phrase beam searches for one typist on one model, kept between calls.
+
+    Keeps a BeamStates, so contexts and candidate scores carry over from one
+    search to the next, and the last few beams, so a search cut short by its
+    time budget resumes where it stopped when asked again. Once the states
+    take more than `max_bytes`, it starts over.
+    """
+
+    def __init__(self, model, max_beams=16, max_bytes=128 * 2**20):
+        self.model = model
+        self.max_beams = max_beams
+        self.max_bytes = max_bytes
+        self.reset()
 
+    def reset(self):
+        self.states = BeamStates(self.model)
+        self.beams = OrderedDict()
 
-def beam_search_phrases(model, start_words, **kw):
-    beam = beam_search_phrases_init(model, start_words, **kw)
-    beam = beam_search_phrases_loop(model, beam, **kw)
-    beam.sort(reverse=True)
-    return [BeamEntry(*ent) for ent in beam]
+    @property
+    def nbytes(self):
+        return self.states.nbytes
+
+    def search(self, start_words, *, time_budget=None, **kw):
+        if self.nbytes > self.max_bytes:
+            self.reset()
+        key = (tuple(start_words), _freeze(kw))
+        beam = self.beams.pop(key, None)
+        if beam is None:
+            beam = beam_search_phrases_init(self.model, start_words, states=self.states)
+        beam = beam_search_phrases_run(self.model, beam, time_budget=time_budget, **kw)
+        self.beams[key] = beam
+        while len(self.beams) > self.max_beams:
+            self.beams.popitem(last=False)
+        return beam.entries()
+
+
+class BeamCache:
+    """
+    The BeamSessions of the most recent `max_sessions` (session, model) pairs.
+
+    Their memory, together, is kept under `max_bytes` by dropping the least
+    recently used sessions after each search.
+    """
+
+    def __init__(self, max_sessions=64, max_bytes=512 * 2**20):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sessions = OrderedDict()
+
+    def get(self, session, model):
+        key = (session, model.name)
+        beam_session = self.sessions.pop(key, None)
+        if beam_session is None:
+            beam_session = BeamSession(model)
+        self.sessions[key] = beam_session
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return beam_session
+
+    @property
+    def nbytes(self):
+        return sum(beam_session.nbytes for beam_session in self.sessions.values())
+
+    def search(self, session, model, start_words, **kw):
+        """BeamSession.search, in the session's BeamSession."""
+        entries = self.get(session, model).search(start_words, **kw)
+        total = self.nbytes
+        while total > self.max_bytes and len(self.sessions) > 1:
+            _, evicted = self.sessions.popitem(last=False)
+            total -= evicted.nbytes
+        if total > self.max_bytes:
+            # Just this search's session, and it's too big on its own.
+            next(iter(self.sessions.values())).reset()
+        return entries
+
+
+beam_cache = BeamCache()
+
+
+def beam_search_phrases(model, start_words, session=None, cache=None, **kw):
+    """
+    The best phrases to follow start_words, as BeamEntry tuples, best first.
+
+    Given a `session` (e.g., a participant id), reuses work from that session's
+    earlier searches, kept in `cache` (by default, beam_cache); see BeamSession.
+    """
+    if isinstance(model, str):
+        model = Model.get_model(model)
+    if session is not None:
+        cache = beam_cache if cache is None else cache
+        return cache.search(session, model, start_words, **kw)
+    beam = beam_search_phrases_init(model, start_words)
+    return beam_search_phrases_loop(model, beam, **kw)
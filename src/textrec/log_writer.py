@@ -0,0 +1,220 @@
+"""
+Background writer for the participant logs.
+
+Participant.log used to write and flush every event on the IOLoop thread, so a
+slow disk stalled every websocket. Here the IOLoop just queues the line; one
+thread per process takes everything queued so far, writes it, and flushes each
+file it touched once per batch (a group commit). Lines go through a single
+queue in the order they were logged, so each participant's log keeps its order.
+
+How hard we try to get lines onto the disk itself is the fsync policy:
+
+- "never": flush to the OS, and let it write back when it likes,
+- "batch": fsync each file a batch touched,
+- "interval": fsync files at most every `fsync_interval` seconds.
+
+A `durable` write (e.g., finalData, which is what we pay participants for) gets
+a Future that's resolved once its file has been flushed and fsynced, whatever
+the policy, or fails if the line couldn't be written.
+
+A line that can't be written is logged and skipped, and its writer's `on_error`
+callback is called (in the writer thread); the rest of its batch is still
+written.
+"""
+import atexit
+import collections
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ("never", "batch", "interval")
+
+
+class LogWriter:
+    def __init__(self, fsync="batch", fsync_interval=1.0, max_batch_size=1000):
+        assert fsync in FSYNC_POLICIES, fsync
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        # Files written since the last fsync, for the "interval" policy.
+        self.unsynced = set()
+        self.last_fsync = time.time()
+
+        self.stats = collections.Counter()
+        self.max_queue_depth = 0
+        self.recent_latencies = collections.deque(maxlen=1000)
+
+    def _ensure_started(self):
+        # Started lazily, so a process that forks before logging anything
+        # doesn't fork with a writer thread.
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="log-writer", daemon=True
+                )
+                self.thread.start()
+                atexit.register(self.sync)
+
+    def write(self, file, line, durable=False, on_error=None):
+        """Queue a line (without its newline) to be written to an open file.
+
+        If `durable`, returns a concurrent.futures.Future whose result is None
+        once the line is on disk, or the error if it couldn't be written.
+        If the line can't be written, calls on_error(error) in the writer thread.
+        """
+        self._ensure_started()
+        done = concurrent.futures.Future() if durable else None
+        self.queue.put((file, line, time.time(), done, on_error))
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        return done
+
+    def barrier(self, fsync=False, then=None):
+        """A Future resolved once everything queued so far has been written.
+
+        If `fsync`, it's fsynced too. If `then` is given, it's called in the
+        writer thread at that point, before any later lines are written, and
+        the Future's result is what it returns.
+        """
+        self._ensure_started()
+        done = concurrent.futures.Future()
+        # For a barrier, `line` says whether to fsync.
+        self.queue.put((None, fsync, time.time(), done, then))
+        return done
+
+    def sync(self, fsync=True):
+        """Block until everything queued so far has been written (and fsynced)."""
+        if self.thread is None:
+            return
+        self.barrier(fsync=fsync).result()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # A batch ends at a barrier, so its `then` sees only earlier lines.
+            while batch[-1][0] is not None and len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logger.exception("Failed to write log batch")
+                for file, line, enqueued, done, callback in batch:
+                    if done is not None and not done.done():
+                        done.set_exception(e)
+                    if file is not None and callback is not None:
+                        self._report(callback, e)
+
+    @staticmethod
+    def _report(on_error, error):
+        try:
+            on_error(error)
+        except Exception:
+            logger.exception("Error in a log write error callback")
+
+    def _failed(self, errors, key, error, what):
+        logger.error(f"Failed to {what} a participant log: {error!r}")
+        self.stats["write_errors"] += 1
+        errors.setdefault(key, error)
+
+    def _write_batch(self, batch):
+        start = time.time()
+        touched = []
+        must_sync = set()
+        # The first error for each failed line (by position) or file.
+        errors = {}
+        for i, (file, line, enqueued, done, callback) in enumerate(batch):
+            if file is None:
+                if line:
+                    # A sync() barrier: everything so far must reach the disk.
+                    must_sync.update(touched)
+                    must_sync.update(self.unsynced)
+                continue
+            try:
+                file.write(line + "\n")
+            except Exception as e:
+                self._failed(errors, i, e, "write to")
+                continue
+            if file not in touched:
+                touched.append(file)
+            if done is not None:
+                must_sync.add(file)
+        for file in touched:
+            try:
+                file.flush()
+            except Exception as e:
+                self._failed(errors, file, e, "flush")
+
+        if self.fsync == "batch":
+            must_sync.update(touched)
+        else:
+            self.unsynced.update(touched)
+            if self.fsync == "interval" and (
+                start - self.last_fsync >= self.fsync_interval
+            ):
+                must_sync.update(self.unsynced)
+                self.last_fsync = start
+        for file in must_sync:
+            if file.closed or file in errors:
+                continue
+            try:
+                os.fsync(file.fileno())
+            except Exception as e:
+                self._failed(errors, file, e, "fsync")
+            else:
+                self.stats["fsyncs"] += 1
+        self.unsynced.difference_update(must_sync)
+
+        for i, (file, line, enqueued, done, callback) in enumerate(batch):
+            if file is None:
+                # A barrier; it's last in its batch.
+                try:
+                    done.set_result(callback() if callback is not None else None)
+                except Exception as e:
+                    done.set_exception(e)
+                continue
+            error = errors.get(i) or errors.get(file)
+            if error is not None and callback is not None:
+                self._report(callback, error)
+            if done is None:
+                continue
+            if error is not None:
+                done.set_exception(error)
+            else:
+                done.set_result(None)
+
+        end = time.time()
+        self.stats["batches"] += 1
+        self.stats["lines"] += sum(1 for item in batch if item[0] is not None)
+        self.stats["write_seconds"] += end - start
+        self.recent_latencies.extend(end - item[2] for item in batch)
+
+    def get_stats(self):
+        """Queue depth and write latencies (seconds from log() to flushed)."""
+        latencies = np.array(self.recent_latencies)
+        stats = dict(
+            self.stats,
+            queue_depth=self.queue.qsize(),
+            max_queue_depth=self.max_queue_depth,
+        )
+        if len(latencies):
+            p50, p99 = np.percentile(latencies, [50, 99])
+            stats.update(
+                latency_p50=float(p50),
+                latency_p99=float(p99),
+                latency_max=float(latencies.max()),
+            )
+        return stats
@@ -0,0 +1,234 @@
+"""
+Latency histograms and counters for the server, served at /metrics in the
+Prometheus text format.
+
+Where the time for an RPC goes:
+
+- textrec_pool_queue_seconds: waiting for a thread or worker process to pick
+  the work up (see submit_timed)
+- textrec_compute_seconds: the model doing the work, by method and model
+- textrec_rpc_seconds: the whole RPC, as the client's reply sees it
+- textrec_serialize_seconds and textrec_ws_write_seconds: encoding and
+  compressing a reply, and handing it to the websocket
+
+Other modules can export their own stats at scrape time with
+register_collector.
+"""
+import concurrent.futures
+import threading
+import time
+
+# Seconds; spans a kenlm lookup to a slow spaCy parse.
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Histogram:
+    """Counts of observations by bucket, per combination of label values.
+
+    Observations come from pool threads as well as the IOLoop, hence the lock.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> (bucket counts, [sum, count])
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            if key not in self.series:
+                self.series[key] = ([0] * len(self.buckets), [0.0, 0])
+            counts, totals = self.series[key]
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+                    break
+            totals[0] += value
+            totals[1] += 1
+
+    def samples(self):
+        with self.lock:
+            series = [
+                (key, list(counts), list(totals))
+                for key, (counts, totals) in sorted(self.series.items())
+            ]
+        for key, counts, (total, count) in series:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for upper, n in zip(self.buckets, counts):
+                cumulative += n
+                yield "_bucket", labels + [("le", repr(upper))], cumulative
+            yield "_bucket", labels + [("le", "+Inf")], count
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            series = sorted(self.series.items())
+        for key, value in series:
+            yield "", list(zip(self.labelnames, key)), value
+
+
+REGISTRY = []
+_collectors = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def register_collector(collect):
+    """`collect()` returns [(name, type, help, [(labels dict, value)])] at scrape time."""
+    _collectors.append(collect)
+
+
+POOL_QUEUE_SECONDS = register(
+    Histogram(
+        "textrec_pool_queue_seconds",
+        "Time from submitting work to a pool until a worker started it.",
+        ["executor", "method"],
+    )
+)
+COMPUTE_SECONDS = register(
+    Histogram(
+        "textrec_compute_seconds",
+        "Time a pool worker spent computing.",
+        ["method", "model"],
+    )
+)
+RPC_SECONDS = register(
+    Histogram(
+        "textrec_rpc_seconds",
+        "Time from receiving an RPC to sending its reply.",
+        ["method"],
+    )
+)
+RPC_TOTAL = register(
+    Counter("textrec_rpc_total", "RPCs handled, by outcome.", ["method", "outcome"])
+)
+SERIALIZE_SECONDS = register(
+    Histogram(
+        "textrec_serialize_seconds",
+        "Time to encode and compress an outgoing websocket message.",
+        ["type"],
+    )
+)
+WS_WRITE_SECONDS = register(
+    Histogram(
+        "textrec_ws_write_seconds",
+        "Time to hand an encoded message to the websocket.",
+        ["type"],
+    )
+)
+
+
+def _run_timed(func, *args):
+    # Runs in the worker. time.time(), since the submitting process compares it
+    # with its own clock.
+    started = time.time()
+    start = time.perf_counter()
+    result = func(*args)
+    return result, started, time.perf_counter() - start
+
+
+class _TimedFuture(concurrent.futures.Future):
+    """What submit_timed returns.
+
+    Cancelling it cancels the executor's future, so (as with executor.submit)
+    work that hasn't started never runs, and work that has keeps it pending.
+    """
+
+    inner = None
+
+    def cancel(self):
+        return self.inner.cancel()
+
+
+def submit_timed(executor, executor_name, method, model, func, *args):
+    """Like executor.submit(func, *args), but record queue wait and compute time."""
+    submitted = time.time()
+    outer = _TimedFuture()
+
+    def done(inner):
+        if inner.cancelled():
+            concurrent.futures.Future.cancel(outer)
+            outer.set_running_or_notify_cancel()
+            return
+        try:
+            result, started, compute_seconds = inner.result()
+        except BaseException as e:
+            outer.set_exception(e)
+            return
+        POOL_QUEUE_SECONDS.observe(
+            max(0.0, started - submitted), executor=executor_name, method=method
+        )
+        COMPUTE_SECONDS.observe(compute_seconds, method=method, model=model)
+        outer.set_result(result)
+
+    outer.inner = executor.submit(_run_timed, func, *args)
+    outer.inner.add_done_callback(done)
+    return outer
+
+
+def render():
+    """All metrics, in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for suffix, labels, value in metric.samples():
+            lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {value}")
+    for collect in _collectors:
+        for name, type, help, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+    return "\n".join(lines) + "\n"
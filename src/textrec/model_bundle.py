@@ -0,0 +1,304 @@
+"""
+Versioned bundles of model parts, loaded lazily.
+
+A cue model used to be one joblib pickle per part, each fully unpickled
+(DataFrames, sklearn objects, and all) by whichever request first asked for it.
+A bundle is one directory per model instead:
+
+    cue_yelp_128.bundle/          (a symlink to the latest version; see write_bundle)
+        meta.json                 format version, and how each part is stored
+        projection_mat.npy        numeric arrays, memory-mapped when read
+        sentences.doc_id.npy      DataFrames: one file per column (and the index)
+        sentences.raw_sent.utf8   string columns: the UTF-8 strings, concatenated,
+        sentences.raw_sent.offsets.npy    and the byte offset of each one
+        clusterer.pkl             anything else, pickled with joblib
+
+Small JSON-able parts (e.g., labels) are stored in meta.json itself.
+
+Parts are read on first access. Call warm_up() at startup to read them all
+ahead of time and fault in the pages of the memory-mapped arrays, so no request
+waits on the disk.
+"""
+import glob
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+
+import joblib
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_VERSION = 1
+
+# Larger JSON-able parts get pickled rather than making meta.json slow to read.
+MAX_INLINE_JSON = 64 * 1024
+
+
+class BundleError(Exception):
+    """The bundle is missing, from another format version, or damaged."""
+
+
+class Strings:
+    """A read-only sequence of strings: one UTF-8 blob and the byte offsets into it."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @staticmethod
+    def encode(strings):
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return b"".join(encoded), offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+    def __iter__(self):
+        blob = bytes(self.blob)
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield blob[start:end].decode("utf-8")
+
+
+def _is_dataframe(value):
+    # Duck-typed, so reading a bundle doesn't need pandas unless it has frames.
+    return hasattr(value, "columns") and hasattr(value, "iloc")
+
+
+def _is_numeric(array):
+    return array.dtype.kind in "biuf"
+
+
+def _is_strings(values):
+    return all(isinstance(value, str) for value in values)
+
+
+def _json_value(value):
+    """`value` as JSON, if it survives the round trip unchanged and is small."""
+    try:
+        encoded = json.dumps(value)
+    except (TypeError, ValueError):
+        return None
+    if len(encoded) > MAX_INLINE_JSON or json.loads(encoded) != value:
+        return None
+    return encoded
+
+
+class _Writer:
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+
+    def save(self, filename, saver):
+        with open(os.path.join(self.path, filename), "wb") as f:
+            saver(f)
+        self.files[filename] = os.path.getsize(os.path.join(self.path, filename))
+        return filename
+
+    def array(self, name, array):
+        return self.save(f"{name}.npy", lambda f: np.save(f, array))
+
+    def strings(self, name, strings):
+        blob, offsets = Strings.encode(strings)
+        return dict(
+            blob=self.save(f"{name}.utf8", lambda f: f.write(blob)),
+            offsets=self.array(f"{name}.offsets", offsets),
+        )
+
+    def column(self, name, values):
+        values = np.asarray(values)
+        if _is_numeric(values):
+            return dict(kind="array", file=self.array(name, values))
+        return dict(kind="strings", **self.strings(name, values.tolist()))
+
+    def part(self, name, value):
+        if isinstance(value, np.ndarray) and _is_numeric(value):
+            return dict(kind="array", file=self.array(name, value))
+        if _is_dataframe(value) and self._frame_fits(value):
+            return self.dataframe(name, value)
+        if isinstance(value, (list, tuple)) and value and _is_strings(value):
+            return dict(kind="strings", **self.strings(name, value))
+        if _json_value(value) is not None:
+            return dict(kind="json", value=value)
+        return dict(
+            kind="pickle",
+            file=self.save(f"{name}.pkl", lambda f: joblib.dump(value, f)),
+        )
+
+    @staticmethod
+    def _frame_fits(df):
+        columns = [df.index] + [df[column] for column in df.columns]
+        return all(isinstance(column, str) for column in df.columns) and all(
+            _is_numeric(np.asarray(values)) or _is_strings(values) for values in columns
+        )
+
+    def dataframe(self, name, df):
+        return dict(
+            kind="dataframe",
+            index=dict(
+                name=df.index.name, **self.column(f"{name}.__index__", df.index)
+            ),
+            columns=[
+                dict(name=column, **self.column(f"{name}.{column}", df[column]))
+                for column in df.columns
+            ],
+        )
+
+
+def write_bundle(path, parts):
+    """Write {part name: value} as a bundle at `path`, replacing any old one.
+
+    `path` is a symlink to a directory for the current version (e.g.,
+    cue_yelp_128.bundle.v3k9x_2q). The new version is written in full, then
+    the symlink is replaced, so readers see either the old bundle or the new
+    one. The previous version is kept, since a running process may still be
+    loading parts from it; any older ones are removed.
+    """
+    path = str(path)
+    version_path = tempfile.mkdtemp(
+        prefix=os.path.basename(path) + ".v", dir=os.path.dirname(path) or "."
+    )
+    writer = _Writer(version_path)
+    meta = dict(version=BUNDLE_VERSION, parts={})
+    for name, value in parts.items():
+        meta["parts"][name] = writer.part(name, value)
+        logger.info(f"{path}: {name} as {meta['parts'][name]['kind']}")
+    meta["files"] = writer.files
+    with open(os.path.join(version_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    # mkdtemp makes the directory private.
+    os.chmod(version_path, 0o755)
+
+    previous = os.path.realpath(path) if os.path.islink(path) else None
+    if os.path.isdir(path) and not os.path.islink(path):
+        # A bundle written before bundles were symlinks; move it aside first.
+        previous = os.path.realpath(path + ".v0")
+        os.rename(path, previous)
+    tmp_link = f"{path}.{os.getpid()}.link"
+    os.symlink(os.path.basename(version_path), tmp_link)
+    os.replace(tmp_link, path)
+
+    keep = {os.path.realpath(version_path), previous}
+    for old_version in glob.glob(glob.escape(path) + ".v*"):
+        if os.path.realpath(old_version) not in keep and os.path.isdir(old_version):
+            shutil.rmtree(old_version)
+
+
+def _page_in(array):
+    """Read a byte from each page of a memory-mapped array."""
+    flat = np.ravel(array, order="K")
+    if flat.size:
+        flat.view(np.uint8)[:: mmap.PAGESIZE].sum()
+
+
+class ModelBundle:
+    def __init__(self, path):
+        # The version `path` links to now; later parts come from the same one.
+        self.path = os.path.realpath(str(path))
+        try:
+            with open(os.path.join(self.path, "meta.json")) as f:
+                self.meta = json.load(f)
+        except (OSError, ValueError) as e:
+            raise BundleError(f"Can't read {self.path}: {e}")
+        if self.meta.get("version") != BUNDLE_VERSION:
+            raise BundleError(f"{self.path}: version {self.meta.get('version')}")
+        # A truncated copy would otherwise fail deep inside some request.
+        for filename, size in self.meta["files"].items():
+            full_path = os.path.join(self.path, filename)
+            if not os.path.exists(full_path) or os.path.getsize(full_path) != size:
+                raise BundleError(f"{full_path} is missing or the wrong size")
+        self._loaded = {}
+
+    @property
+    def parts(self):
+        return list(self.meta["parts"])
+
+    def __contains__(self, part):
+        return part in self.meta["parts"]
+
+    def get(self, part):
+        if part not in self._loaded:
+            if part not in self:
+                raise KeyError(part)
+            self._loaded[part] = self._load(self.meta["parts"][part])
+        return self._loaded[part]
+
+    def _filename(self, filename):
+        return os.path.join(self.path, filename)
+
+    def _array(self, filename):
+        return np.load(self._filename(filename), mmap_mode="r")
+
+    def _strings(self, spec):
+        offsets = self._array(spec["offsets"])
+        if offsets[-1] == 0:
+            # mmap can't map an empty file.
+            return Strings(b"", offsets)
+        return Strings(
+            np.memmap(self._filename(spec["blob"]), dtype=np.uint8, mode="r"), offsets
+        )
+
+    def _column(self, spec):
+        # Copied into memory: pandas would anyway, on the first operation that
+        # touches the column.
+        if spec["kind"] == "array":
+            return np.array(self._array(spec["file"]))
+        return list(self._strings(spec))
+
+    def _load(self, spec):
+        kind = spec["kind"]
+        if kind == "array":
+            return self._array(spec["file"])
+        if kind == "strings":
+            return self._strings(spec)
+        if kind == "json":
+            return spec["value"]
+        if kind == "pickle":
+            return joblib.load(self._filename(spec["file"]))
+        if kind == "dataframe":
+            import pandas as pd
+
+            return pd.DataFrame(
+                {column["name"]: self._column(column) for column in spec["columns"]},
+                index=pd.Index(self._column(spec["index"]), name=spec["index"]["name"]),
+                columns=[column["name"] for column in spec["columns"]],
+            )
+        raise BundleError(f"{self.path}: unknown part kind {kind}")
+
+    def warm_up(self, parts=None):
+        """Load `parts` (default all), and page in any memory-mapped arrays."""
+        for part in self.parts if parts is None else parts:
+            if part not in self:
+                continue
+            value = self.get(part)
+            if isinstance(value, np.memmap):
+                _page_in(value)
+            elif isinstance(value, Strings):
+                _page_in(value.offsets)
+                if isinstance(value.blob, np.memmap):
+                    _page_in(value.blob)
+
+
+def open_bundle(path):
+    """The bundle at `path`, or None if there isn't a usable one."""
+    if not os.path.exists(os.path.join(str(path), "meta.json")):
+        return None
+    try:
+        return ModelBundle(path)
+    except BundleError as e:
+        logger.warning(f"Ignoring bundle: {e}")
+        return None
@@ -0,0 +1,414 @@
+"""
+Array-backed n-gram tables, for scoring many candidate words at once.
+
+KenLM's Python API scores one word per call, which is slow when we want the
+scores of thousands of candidate next words. Here we lay out the n-gram tables
+from the ARPA file as a trie in flat numpy arrays (much like KenLM's own trie
+format), so that backoff scoring of a whole candidate set is a handful of
+vectorized lookups.
+
+A "context" here plays the role of a KenLM State: it's a tuple of word ids
+(oldest first), trimmed to the longest suffix that actually occurs as an n-gram.
+Word ids match KenLM's vocab indices (see the assertion in `Model._load`).
+"""
+import numpy as np
+
+LOG10 = np.log(10)
+
+
+def read_arpa_counts(f):
+    """Read the \\data\\ header, returning the number of n-grams of each order."""
+    while not f.readline().startswith("\\data\\"):
+        continue
+    counts = []
+    for line in f:
+        line = line.strip()
+        if not line:
+            break
+        assert line.startswith("ngram "), line
+        order, count = line[len("ngram ") :].split("=")
+        assert int(order) == len(counts) + 1, line
+        counts.append(int(count))
+    return counts
+
+
+def read_arpa_section(f, order, count, word2id):
+    """Read the n-grams of one order.
+
+    Returns an (count x order) array of word ids and natural-log probs and backoffs.
+    If word2id is None, this must be the unigram section; its words are collected
+    in file order, which is also KenLM's vocab order.
+    """
+    header = f"\\{order}-grams:"
+    while not f.readline().startswith(header):
+        continue
+    vocab = [] if word2id is None else None
+    ids = np.empty((count, order), dtype=np.int32)
+    logprobs = np.empty(count, dtype=np.float32)
+    backoffs = np.zeros(count, dtype=np.float32)
+    for i in range(count):
+        parts = f.readline().rstrip("\n").split("\t")
+        logprobs[i] = float(parts[0])
+        if len(parts) > 2:
+            backoffs[i] = float(parts[2])
+        if vocab is not None:
+            vocab.append(parts[1])
+            ids[i, 0] = i
+        else:
+            ids[i] = [word2id[word] for word in parts[1].split(" ")]
+    logprobs *= LOG10
+    backoffs *= LOG10
+    return vocab, ids, logprobs, backoffs
+
+
+class NgramTables:
+    """
+    The n-grams of each order, stored as a trie.
+
+    Table 0 holds unigrams, indexed directly by word id. For k >= 1, the children
+    of row r of table k-1 are rows offsets[k][r] : offsets[k][r + 1] of table k,
+    whose last words (words[k]) are sorted so they can be binary-searched.
+    """
+
+    def __init__(self, id2str, logprobs, backoffs, words, offsets):
+        self.id2str = id2str
+        self.logprobs = logprobs
+        self.backoffs = backoffs
+        self.words = words
+        self.offsets = offsets
+
+    @property
+    def order(self):
+        return len(self.logprobs)
+
+    @property
+    def vocab_size(self):
+        return len(self.logprobs[0])
+
+    @classmethod
+    def from_arpa(cls, filename):
+        with open(filename) as f:
+            counts = read_arpa_counts(f)
+            id2str, _, unigram_logprobs, unigram_backoffs = read_arpa_section(
+                f, 1, counts[0], None
+            )
+            word2id = {word: i for i, word in enumerate(id2str)}
+            logprobs = [unigram_logprobs]
+            backoffs = [unigram_backoffs]
+            words = [np.arange(counts[0], dtype=np.int32)]
+            offsets = [None]
+            # Parent rows of each table, only needed while building.
+            parents = [np.zeros(counts[0], dtype=np.int64)]
+            for k in range(1, len(counts)):
+                _, ids, lp, bo = read_arpa_section(f, k + 1, counts[k], word2id)
+                parent = ids[:, 0].astype(np.int64)
+                for j in range(1, k):
+                    parent = cls._lookup_rows(
+                        parents[j], words[j], len(id2str), parent, ids[:, j]
+                    )
+                assert np.all(parent >= 0), f"{k + 1}-grams with unknown prefix"
+                last = ids[:, k]
+                by_parent = np.lexsort((last, parent))
+                parent = parent[by_parent]
+                words.append(last[by_parent])
+                logprobs.append(lp[by_parent])
+                backoffs.append(bo[by_parent])
+                parents.append(parent)
+                offsets.append(
+                    np.searchsorted(parent, np.arange(counts[k - 1] + 1)).astype(
+                        np.int64
+                    )
+                )
+        # The highest order never serves as a context.
+        backoffs[-1] = np.zeros(0, dtype=np.float32)
+        return cls(id2str, logprobs, backoffs, words, offsets)
+
+    def arrays(self):
+        """The tables as named arrays, for saving; see from_arrays."""
+        arrays = dict(ngram_counts=np.array([len(lp) for lp in self.logprobs]))
+        for k in range(self.order):
+            arrays[f"ngram_logprobs_{k}"] = self.logprobs[k]
+            arrays[f"ngram_backoffs_{k}"] = self.backoffs[k]
+            if k > 0:
+                arrays[f"ngram_words_{k}"] = self.words[k]
+                arrays[f"ngram_offsets_{k}"] = self.offsets[k]
+        return arrays
+
+    @staticmethod
+    def array_names(order):
+        names = []
+        for k in range(order):
+            names.extend([f"ngram_logprobs_{k}", f"ngram_backoffs_{k}"])
+            if k > 0:
+                names.extend([f"ngram_words_{k}", f"ngram_offsets_{k}"])
+        return names
+
+    @classmethod
+    def from_arrays(cls, id2str, arrays):
+        order = len(arrays["ngram_counts"])
+        return cls(
+            id2str,
+            logprobs=[arrays[f"ngram_logprobs_{k}"] for k in range(order)],
+            backoffs=[arrays[f"ngram_backoffs_{k}"] for k in range(order)],
+            words=[np.arange(len(id2str), dtype=np.int32)]
+            + [arrays[f"ngram_words_{k}"] for k in range(1, order)],
+            offsets=[None] + [arrays[f"ngram_offsets_{k}"] for k in range(1, order)],
+        )
+
+    @staticmethod
+    def _lookup_rows(table_parents, table_words, vocab_size, parents, words):
+        """Vectorized lookup of (parent row, word) pairs in a table; -1 if absent."""
+        table_keys = table_parents * vocab_size + table_words
+        keys = parents * vocab_size + words
+        pos = np.searchsorted(table_keys, keys)
+        pos_clipped = np.minimum(pos, len(table_keys) - 1)
+        found = (parents >= 0) & (table_keys[pos_clipped] == keys)
+        return np.where(found, pos_clipped, -1)
+
+    def child_row(self, k, row, word):
+        """Row in table k of the n-gram extending row `row` of table k-1 by `word`."""
+        lo, hi = self.offsets[k][row], self.offsets[k][row + 1]
+        pos = lo + np.searchsorted(self.words[k][lo:hi], word)
+        if pos < hi and self.words[k][pos] == word:
+            return pos
+        return -1
+
+    def find(self, ngram):
+        """Row of `ngram` (a sequence of word ids) in its table, or -1 if absent."""
+        row = ngram[0]
+        for k in range(1, len(ngram)):
+            row = self.child_row(k, row, ngram[k])
+            if row < 0:
+                break
+        return row
+
+    def context_rows(self, context):
+        """Rows of the suffixes of `context`, shortest first, stopping at a miss."""
+        rows = []
+        for length in range(1, len(context) + 1):
+            row = self.find(context[-length:])
+            if row < 0:
+                break
+            rows.append(row)
+        return rows
+
+    def _recent(self, context):
+        """The last (order - 1) words of a context; older words can't matter."""
+        return tuple(context[max(len(context) - (self.order - 1), 0) :])
+
+    def trim_context(self, context):
+        """Trim a context to the longest suffix that can condition a prediction."""
+        context = self._recent(context)
+        return context[len(context) - len(self.context_rows(context)) :]
+
+    def advance(self, context, word):
+        return self.trim_context(tuple(context) + (int(word),))
+
+    def score(self, context, words):
+        """Natural-log probabilities of each of `words` following `context`."""
+        words = np.asarray(words, dtype=np.int32)
+        scores = self.logprobs[0][words].astype(np.float64)
+        for k, row in enumerate(self.context_rows(self._recent(context))):
+            # Back off from the row's children to the shorter context.
+            scores += self.backoffs[k][row]
+            lo, hi = self.offsets[k + 1][row], self.offsets[k + 1][row + 1]
+            if lo == hi:
+                continue
+            children = self.words[k + 1][lo:hi]
+            pos = np.minimum(np.searchsorted(children, words), hi - lo - 1)
+            found = children[pos] == words
+            scores[found] = self.logprobs[k + 1][lo + pos[found]]
+        return scores
+
+    def context_row_matrix(self, contexts):
+        """Each context's context_rows, padded with -1: (len(contexts) x order-1)."""
+        matrix = np.full((len(contexts), self.order - 1), -1, dtype=np.int64)
+        for i, context in enumerate(contexts):
+            rows = self.context_rows(self._recent(context))
+            matrix[i, : len(rows)] = rows
+        return matrix
+
+    @staticmethod
+    def _search_segments(values, lo, hi, targets):
+        """Position of each target in sorted values[lo:hi] (per target), or -1."""
+        lo = lo.copy()
+        end = hi.copy()
+        last = len(values) - 1
+        while True:
+            active = lo < end
+            if not active.any():
+                break
+            mid = (lo + end) // 2
+            less = values[np.minimum(mid, last)] < targets
+            lo = np.where(active & less, mid + 1, lo)
+            end = np.where(active & ~less, mid, end)
+        found = (lo < hi) & (values[np.minimum(lo, last)] == targets)
+        return np.where(found, lo, -1)
+
+    def advance_rows(self, context_rows, words):
+        """The context_row_matrix of each context extended by words[i].
+
+        Vectorized `advance`, working from the contexts' rows: the suffix of
+        length k + 1 of the new context is a child of the old one's suffix of
+        length k.
+        """
+        words = np.asarray(words, dtype=np.int64)
+        new_rows = np.full_like(context_rows, -1)
+        if new_rows.shape[1] == 0:
+            return new_rows
+        new_rows[:, 0] = words
+        for k in range(1, new_rows.shape[1]):
+            extend = np.flatnonzero(
+                (new_rows[:, k - 1] >= 0) & (context_rows[:, k - 1] >= 0)
+            )
+            if len(extend) == 0:
+                break
+            parents = context_rows[extend, k - 1]
+            new_rows[extend, k] = self._search_segments(
+                self.words[k],
+                self.offsets[k][parents],
+                self.offsets[k][parents + 1],
+                words[extend],
+            )
+        return new_rows
+
+    def score_batch(self, context_rows, words):
+        """Scores of words[i] after the context with rows context_rows[i].
+
+        Like calling `score` for each (context, word) pair, but vectorized over
+        all pairs at once; context_rows come from context_row_matrix.
+        """
+        words = np.asarray(words, dtype=np.int32)
+        scores = self.logprobs[0][words].astype(np.float64)
+        for k in range(context_rows.shape[1]):
+            has_context = np.flatnonzero(context_rows[:, k] >= 0)
+            if len(has_context) == 0:
+                break
+            rows = context_rows[has_context, k]
+            scores[has_context] += self.backoffs[k][rows]
+            if len(self.words[k + 1]) == 0:
+                continue
+            pos = self._search_segments(
+                self.words[k + 1],
+                self.offsets[k + 1][rows],
+                self.offsets[k + 1][rows + 1],
+                words[has_context],
+            )
+            found = pos >= 0
+            scores[has_context[found]] = self.logprobs[k + 1][pos[found]]
+        return scores
+
+    def score_multi(self, contexts, words):
+        """Scores of the same candidate words after each of several contexts.
+
+        Returns a (len(contexts) x len(words)) array.
+        """
+        words = np.asarray(words, dtype=np.int32)
+        result = np.empty((len(contexts), len(words)))
+        for i, context in enumerate(contexts):
+            result[i] = self.score(context, words)
+        return result
+
+    def score_seq(self, context, words):
+        """Total score of a sequence of word ids, and the context after it."""
+        score = 0.0
+        for word in words:
+            score += self.score(context, [word])[0]
+            context = self.advance(context, word)
+        return score, context
+
+
+class BigramIndex:
+    """
+    The successors of each word, most probable first, in CSR layout.
+
+    The successors of word a are successors[offsets[a] : offsets[a + 1]], with
+    their logprobs alongside. `limit` caps how many of those we hand out, so the
+    "most common N successors" view is just a shorter slice of the same arrays.
+    """
+
+    ARRAYS = ["offsets", "successors", "logprobs"]
+    ARRAYS_SAVED = [f"bigram_{name}" for name in ARRAYS]
+
+    def __init__(self, offsets, successors, logprobs, limit=None):
+        self.offsets = offsets
+        self.successors = successors
+        self.logprobs = logprobs
+        self.limit = limit
+
+    @classmethod
+    def from_pairs(cls, prev_ids, next_ids, logprobs, vocab_size):
+        # Ties go to the higher word id, as heapq.nlargest used to do.
+        by_prob = np.lexsort((-next_ids, -logprobs, prev_ids))
+        offsets = np.searchsorted(prev_ids[by_prob], np.arange(vocab_size + 1))
+        return cls(
+            offsets.astype(np.int64),
+            next_ids[by_prob].astype(np.int32),
+            logprobs[by_prob].astype(np.float32),
+        )
+
+    def top(self, limit):
+        """A view that only gives the `limit` most probable successors."""
+        return BigramIndex(self.offsets, self.successors, self.logprobs, limit)
+
+    def _range(self, prev_id):
+        lo, hi = self.offsets[prev_id], self.offsets[prev_id + 1]
+        if self.limit is not None:
+            hi = min(hi, lo + self.limit)
+        return lo, hi
+
+    def get(self, prev_id, default=None):
+        lo, hi = self._range(prev_id)
+        if lo == hi:
+            return default
+        return self.successors[lo:hi]
+
+    def __getitem__(self, prev_id):
+        lo, hi = self._range(prev_id)
+        return self.successors[lo:hi]
+
+    def get_logprobs(self, prev_id):
+        lo, hi = self._range(prev_id)
+        return self.logprobs[lo:hi]
+
+    @property
+    def counts(self):
+        counts = np.diff(self.offsets)
+        if self.limit is not None:
+            counts = np.minimum(counts, self.limit)
+        return counts
+
+    def __len__(self):
+        """Number of words that have any successors."""
+        return int(np.count_nonzero(self.counts))
+
+    def pruned(self):
+        """Drop successors that are dead ends, repeatedly, until none are left.
+
+        Only meaningful without a limit, since it looks at all successors.
+        """
+        assert self.limit is None
+        row_ids = np.repeat(np.arange(len(self.offsets) - 1), self.counts)
+        has_successors = self.counts > 0
+        while True:
+            keep = has_successors[self.successors]
+            new_has_successors = (
+                np.bincount(row_ids[keep], minlength=len(has_successors)) > 0
+            )
+            if np.array_equal(new_has_successors, has_successors):
+                break
+            has_successors = new_has_successors
+        counts = np.bincount(row_ids[keep], minlength=len(has_successors))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return BigramIndex(offsets, self.successors[keep], self.logprobs[keep])
+
+    def arrays(self):
+        """The index as named arrays, for saving; see from_arrays."""
+        return {
+            saved: getattr(self, name)
+            for name, saved in zip(self.ARRAYS, self.ARRAYS_SAVED)
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(*[arrays[saved] for saved in cls.ARRAYS_SAVED])
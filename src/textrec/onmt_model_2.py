@@ -1,10 +1,13 @@
 from .paths import paths
+from . import image_features
 
 import argparse
+import bisect
 import codecs
 import torch
 import numpy as np
 import copy
+import os
 
 from torch.autograd import Variable
 import torch.nn.functional as F
@@ -16,6 +19,7 @@ import onmt.ModelConstructor
 import onmt.modules
 import onmt.opts as opts
 
+from collections import Counter, OrderedDict
 from functools import lru_cache
 
 # HACK - monkey-patch, because the model stores the wrong data here.
@@ -26,18 +30,14 @@ def fake_open_h5_file(self):
 
 def load_img_data(self, coco_ids):
     coco_ids = coco_ids.data.numpy().tolist()
-    import h5py
-    with h5py.File(str(paths.imgdata_h5), 'r') as f:
-        batch_size = len(coco_ids)
-        vecs = np.empty((batch_size, self.num_objs, self.feature_dim))
-        for i, idx in enumerate(coco_ids):
-            vecs[i] = f[str(idx)][:]
+    vecs = image_features.get_store().get(coco_ids)
+    assert vecs.shape[1:] == (self.num_objs, self.feature_dim)
 
-        # Features need to be first, since they're analogous to words.
-        vecs = vecs.transpose(1, 0, 2)
-        # vecs: objs x batch_size x feature_dim
+    # Features need to be first, since they're analogous to words.
+    vecs = vecs.transpose(1, 0, 2)
+    # vecs: objs x batch_size x feature_dim
 
-        return torch.FloatTensor(vecs)
+    return torch.from_numpy(np.ascontiguousarray(vecs))
 
 
 onmt.modules.VecsEncoder._open_h5_file = fake_open_h5_file
@@ -56,6 +56,138 @@ def tokenize_stimulus(stimulus):
     return ' '.join(tokenize(stimulus))
 
 
+class DecoderStateCache:
+    """
+    Decoder states for token prefixes, kept as a prefix trie per session.
+
+    Each session (e.g., a participant) gets its own trie, so one busy session
+    can't evict everyone else's states. Getting the state for a prefix that
+    extends a cached one takes one decoder step per new token. Memory is bounded
+    per session (in nodes) and overall (in bytes), evicting least recently used
+    nodes first. Lookups touch a path leaf-first, so a node is never older than
+    its descendants, and the LRU node is always a leaf.
+    """
+
+    class Node:
+        __slots__ = ['parent', 'key', 'children', 'value', 'nbytes']
+
+        def __init__(self, parent, key, value, nbytes):
+            self.parent = parent
+            self.key = key
+            self.children = {}
+            self.value = value
+            self.nbytes = nbytes
+
+    def __init__(self, *, sizeof, max_nodes_per_session=256, max_bytes=256 * 2**20):
+        self.sizeof = sizeof
+        self.max_nodes_per_session = max_nodes_per_session
+        self.max_bytes = max_bytes
+        # session -> (roots by key, LRU order of nodes)
+        self.sessions = OrderedDict()
+        self.total_bytes = 0
+        self.stats = Counter()
+
+    def lookup(self, session, root_key, tokens, make_root, extend):
+        """The value for `tokens` after root `root_key`, computing what's missing.
+
+        make_root() computes the value for the root (no tokens);
+        extend(value, token) computes a child's value from its parent's.
+        """
+        node, n_cached = self.find(session, root_key, tokens, make_root)
+        for token in tokens[n_cached:]:
+            node = self.add_child(session, node, token, extend(node.value, token))
+        value = node.value
+        self.touch(session, node)
+        return value
+
+    def find(self, session, root_key, tokens, make_root):
+        """The node of the longest cached prefix of `tokens`, and its length."""
+        if session not in self.sessions:
+            self.sessions[session] = ({}, OrderedDict())
+        roots, lru = self.sessions[session]
+        node = roots.get(root_key)
+        if node is None:
+            node = roots[root_key] = self._add(lru, None, root_key, make_root())
+        n_cached = 0
+        for token in tokens:
+            if token not in node.children:
+                break
+            node = node.children[token]
+            n_cached += 1
+        if n_cached == len(tokens):
+            self.stats['hits'] += 1
+        else:
+            self.stats['misses'] += 1
+        return node, n_cached
+
+    def add_child(self, session, node, token, value):
+        if token in node.children:
+            # Someone else computed it in the meantime.
+            return node.children[token]
+        lru = self.sessions[session][1]
+        child = node.children[token] = self._add(lru, node, token, value)
+        self.stats['decoder_steps'] += 1
+        return child
+
+    def touch(self, session, node):
+        """Mark a node and its ancestors as just used, then evict as needed."""
+        if session not in self.sessions:
+            # Evicted already.
+            return
+        self.sessions.move_to_end(session)
+        lru = self.sessions[session][1]
+        while node is not None:
+            if node in lru:
+                lru.move_to_end(node)
+            node = node.parent
+        self._evict(session)
+
+    def _add(self, lru, parent, key, value):
+        node = self.Node(parent, key, value, self.sizeof(value))
+        lru[node] = None
+        self.total_bytes += node.nbytes
+        return node
+
+    def _remove(self, session, node):
+        roots, lru = self.sessions[session]
+        for child in list(node.children.values()):
+            self._remove(session, child)
+        siblings = roots if node.parent is None else node.parent.children
+        del siblings[node.key]
+        del lru[node]
+        self.total_bytes -= node.nbytes
+        self.stats['evictions'] += 1
+
+    def _evict(self, session):
+        lru = self.sessions[session][1]
+        while len(lru) > self.max_nodes_per_session:
+            self._remove(session, next(iter(lru)))
+        while self.total_bytes > self.max_bytes and self.sessions:
+            oldest_session = next(iter(self.sessions))
+            oldest_lru = self.sessions[oldest_session][1]
+            self._remove(oldest_session, next(iter(oldest_lru)))
+            if not oldest_lru:
+                del self.sessions[oldest_session]
+
+    def get_stats(self):
+        return dict(
+            self.stats,
+            sessions=len(self.sessions),
+            nodes=sum(len(lru) for roots, lru in self.sessions.values()),
+            bytes=self.total_bytes,
+        )
+
+
+def variable_nbytes(var):
+    return var.data.numel() * var.data.element_size()
+
+
+def decoder_value_nbytes(value):
+    dec_out, dec_state = value
+    tensors = list(dec_state.hidden) + [dec_state.input_feed]
+    if dec_out is not None:
+        tensors.append(dec_out)
+    return sum(variable_nbytes(var) for var in tensors)
 
 
 class ONMTModelWrapper:
@@ -88,56 +220,85 @@ class ONMTModelWrapper:
             return encode_from_src(src)
 
 
-        @lru_cache(maxsize=32)
+        # Only images in the feature store can be encoded, and there's one per
+        # stimulus, so this stays small.
+        @lru_cache(maxsize=None)
         def encode_img(image_idx):
-            if isinstance(image_idx, str):
-                image_idx = int(image_idx)
             src = Variable(torch.IntTensor([image_idx]), volatile=True)
             return encode_from_src(src)
 
         def encode(inp):
             if model.encoder.__class__.__name__ == 'VecsEncoder':
-                return encode_img(inp)
+                # Requests give the id as a string; cache by int either way.
+                return encode_img(int(inp))
             else:
                 return encode_text(inp)
 
-        @lru_cache(maxsize=128)
-        def get_decoder_state(in_text, tokens_so_far):
-            encoder_out = encode(in_text)
-            enc_states = encoder_out['enc_states']
-            memory_bank = encoder_out['memory_bank']
-            src = encoder_out['src']
+        def prewarm_encoder_cache():
+            """Encode every image in the feature store, so requests never have to.
 
-            if len(tokens_so_far) == 0:
-                return None, translator.model.decoder.init_decoder_state(
-                    src, memory_bank, enc_states)
+            Call before forking workers so they share the results.
+            """
+            if model.encoder.__class__.__name__ != 'VecsEncoder':
+                return 0
+            coco_ids = image_features.get_store().coco_ids
+            for coco_id in coco_ids:
+                encode_img(int(coco_id))
+            return len(coco_ids)
 
-            prev_out, prev_state = get_decoder_state(in_text, tokens_so_far[:-1])
-
-            tgt_in = Variable(
-                torch.LongTensor([tgt_vocab.stoi[tokens_so_far[-1]]]),
-                volatile=True) # [tgt_len]
-            tgt_in = tgt_in.unsqueeze(1)  # [tgt_len x batch=1]
-            tgt_in = tgt_in.unsqueeze(1)  # [tgt_len x batch=1 x nfeats=1]
-
-            # Prepare to call the decoder. Unfortunately the decoder mutates the state passed in!
-            memory_bank = copy.deepcopy(memory_bank)
-            assert isinstance(prev_state.hidden, tuple)
-            prev_state.hidden = tuple(v.detach() for v in prev_state.hidden)
-            prev_state = copy.deepcopy(prev_state)
+        def init_decoder_state(in_text):
+            encoder_out = encode(in_text)
+            return None, translator.model.decoder.init_decoder_state(
+                encoder_out['src'], encoder_out['memory_bank'],
+                encoder_out['enc_states'])
 
-            assert memory_bank.size()[1] == 1
+        def decode_step_batch(steps):
+            """Run one decoder step for each (in_text, prev_value, token), as a batch."""
+            memory_bank, memory_lengths = pad_memory_banks(
+                [encode(in_text)['memory_bank'] for in_text, _, _ in steps])
+            prev_states = [prev_state for _, (_, prev_state), _ in steps]
 
+            tgt_in = Variable(
+                torch.LongTensor([tgt_vocab.stoi[token] for _, _, token in steps]),
+                volatile=True) # [batch]
+            tgt_in = tgt_in.unsqueeze(0)  # [tgt_len=1 x batch]
+            tgt_in = tgt_in.unsqueeze(2)  # [tgt_len=1 x batch x nfeats=1]
+
+            # The decoder updates the state passed in, but only by rebinding its
+            # attributes (see RNNDecoderState.update_state), so a shallow copy
+            # keeps the cached states intact without copying any tensors.
+            state = copy.copy(prev_states[0])
+            state.hidden = tuple(
+                torch.cat(layer_states, 1)
+                for layer_states in zip(*[s.hidden for s in prev_states]))
+            state.input_feed = torch.cat([s.input_feed for s in prev_states], 1)
             dec_out, dec_states, attn = translator.model.decoder(
-                tgt_in, memory_bank, prev_state)
-
+                tgt_in, memory_bank, state, memory_lengths=memory_lengths)
             assert dec_out.shape[0] == 1
-            return dec_out[0], dec_states
 
-        def generate_completions(in_text, tokens_so_far):
+            # Split the batch back up.
+            results = []
+            for i in range(len(steps)):
+                step_state = copy.copy(dec_states)
+                step_state.hidden = tuple(
+                    v[:, i:i + 1].detach() for v in dec_states.hidden)
+                step_state.input_feed = dec_states.input_feed[:, i:i + 1]
+                results.append((dec_out[0][i:i + 1], step_state))
+            return results
+
+        decoder_cache = DecoderStateCache(sizeof=decoder_value_nbytes)
+
+        def get_decoder_state(in_text, tokens_so_far, session=None):
+            return decoder_cache.lookup(
+                session, in_text, tokens_so_far,
+                make_root=lambda: init_decoder_state(in_text),
+                extend=lambda value, token: decode_step_batch(
+                    [(in_text, value, token)])[0])
+
+        def generate_completions(in_text, tokens_so_far, session=None):
             tokens_so_far = [onmt.io.BOS_WORD] + tokens_so_far
-            tokens_so_far = tuple(tokens_so_far) # Make it hashable
-            dec_out, dec_states = get_decoder_state(in_text, tokens_so_far)
+            dec_out, dec_states = get_decoder_state(
+                in_text, tokens_so_far, session=session)
             logits = model.generator.forward(dec_out).data
             vocab = tgt_vocab.itos
 
@@ -145,6 +306,38 @@ class ONMTModelWrapper:
             logits = logits[0]
             return logits, vocab
 
+        def generate_completions_batch(requests):
+            """generate_completions for a list of (in_text, tokens_so_far, session).
+
+            Requests that need decoder steps get them together, one batched step
+            per token, so this costs about as much as the longest request alone.
+            Returns logits with one row per request.
+            """
+            nodes = []
+            pending = []
+            for in_text, tokens_so_far, session in requests:
+                tokens_so_far = [onmt.io.BOS_WORD] + tokens_so_far
+                node, n_cached = decoder_cache.find(
+                    session, in_text, tokens_so_far,
+                    make_root=lambda: init_decoder_state(in_text))
+                nodes.append(node)
+                pending.append(tokens_so_far[n_cached:])
+
+            while any(pending):
+                todo = [i for i, tokens in enumerate(pending) if tokens]
+                results = decode_step_batch([
+                    (requests[i][0], nodes[i].value, pending[i][0]) for i in todo])
+                for i, value in zip(todo, results):
+                    nodes[i] = decoder_cache.add_child(
+                        requests[i][2], nodes[i], pending[i][0], value)
+                    pending[i] = pending[i][1:]
+
+            dec_out = torch.cat([node.value[0] for node in nodes], 0)
+            for (in_text, tokens_so_far, session), node in zip(requests, nodes):
+                decoder_cache.touch(session, node)
+            logits = model.generator.forward(dec_out).data
+            return logits, tgt_vocab.itos
+
         def eval_logprobs(in_text, tokens, *, use_eos):
             encoder_out = encode(in_text)
             enc_states = encoder_out['enc_states']
@@ -165,11 +358,35 @@ class ONMTModelWrapper:
         self.fields = fields
         self.translator = translator
         self.encode = encode
+        self.prewarm_encoder_cache = prewarm_encoder_cache
         self.get_decoder_state = get_decoder_state
+        self.decoder_cache = decoder_cache
         self.generate_completions = generate_completions
+        self.generate_completions_batch = generate_completions_batch
+        self.vocab_index = VocabIndex(tgt_vocab.itos)
         self.eval_logprobs = eval_logprobs
 
 
+def pad_memory_banks(memory_banks):
+    """Concatenate memory banks ([src_len x 1 x dim]) along the batch dimension.
+
+    Returns the batched memory bank and, if the banks had different lengths and
+    so needed padding, their lengths (for the decoder's attention mask).
+    """
+    lengths = [bank.size(0) for bank in memory_banks]
+    max_length = max(lengths)
+    if min(lengths) == max_length:
+        return torch.cat(memory_banks, 1), None
+    padded = []
+    for bank in memory_banks:
+        if bank.size(0) < max_length:
+            padding = bank.data.new(
+                max_length - bank.size(0), *bank.size()[1:]).zero_()
+            bank = torch.cat([bank, Variable(padding, volatile=True)], 0)
+        padded.append(bank)
+    return torch.cat(padded, 1), torch.LongTensor(lengths)
+
+
 def logsumexp(tensor: torch.Tensor,
               dim: int = -1,
               keepdim: bool = False) -> torch.Tensor:
@@ -199,21 +416,61 @@ def logsumexp(tensor: torch.Tensor,
 
 
 
-def get_top_k(logits, vocab, k, prefix=None):
-    if prefix is not None:
-        offset = torch.FloatTensor(
-            [1000.0 * (not x.startswith(prefix)) for x in vocab])
-        logits = logits - offset
+def is_banned_word(word):
+    """Tokens we never suggest: specials like <unk> and punctuation like '.'."""
+    return word[0] == '<' or word[0] == '.'
+
+
+class VocabIndex:
+    """
+    A target vocabulary, sorted so the words starting with a prefix are a range.
+
+    Built once per model, so prefix-constrained top-k only touches the logits of
+    the matching words instead of building a mask over the whole vocabulary.
+    """
+
+    def __init__(self, itos):
+        self.itos = itos
+        order = sorted(range(len(itos)), key=itos.__getitem__)
+        self.sorted_words = [itos[i] for i in order]
+        self.sorted_ids = torch.LongTensor(order)
+        self.banned = np.array([is_banned_word(word) for word in itos])
+        self.n_banned = int(self.banned.sum())
+        # Number of banned words before each position in sorted order.
+        self.banned_before = np.concatenate([[0], np.cumsum(self.banned[order])])
+        self.prefix_range = lru_cache(maxsize=4096)(self._prefix_range)
+
+    def _prefix_range(self, prefix):
+        """The [lo, hi) range of sorted positions of words starting with `prefix`."""
+        lo = bisect.bisect_left(self.sorted_words, prefix)
+        hi = bisect.bisect_left(self.sorted_words, prefix + '\U0010ffff', lo)
+        return lo, hi
+
+    def candidates(self, logits, k, prefix=None):
+        """Enough of the best (logit, word id) to find k non-banned words.
+
+        With a prefix, the logits are renormalized over the matching words.
+        """
+        if prefix is None:
+            return logits.topk(min(k + self.n_banned, len(self.itos)))
+        lo, hi = self.prefix_range(prefix)
+        if lo == hi:
+            return [], []
+        ids = self.sorted_ids[lo:hi]
+        logits = logits.index_select(0, ids)
         logits -= logsumexp(logits)
+        n_banned = int(self.banned_before[hi] - self.banned_before[lo])
+        values, positions = logits.topk(min(k + n_banned, hi - lo))
+        return values, ids.index_select(0, positions)
+
+
+def get_top_k(logits, vocab_index, k, prefix=None):
     result = []
-    for idx in logits.topk(k * 2)[1]:
-        word = vocab[idx]
-        # TODO: run this filter before the logsumexp
-        if word[0] == '<' or word[0] == '.':
+    for logit, idx in zip(*vocab_index.candidates(logits, k, prefix=prefix)):
+        if vocab_index.banned[idx]:
             continue
-        logit = logits[idx]
         if logit > -100.:
-            result.append((word, logit))
+            result.append((vocab_index.itos[idx], logit))
         else:
             break
         if len(result) == k:
@@ -251,7 +508,34 @@ for name, spec in model_specs.items():
 print("Ready.")
 
 
-def get_recs(model_name, in_text, tokens_so_far, *, prefix=None):
+def get_recs(model_name, in_text, tokens_so_far, *, prefix=None, session=None):
+    wrapper = models[model_name]
+    logits, vocab = wrapper.generate_completions(
+        in_text, tokens_so_far, session=session)
+    return get_top_k(logits, wrapper.vocab_index, k=3, prefix=prefix)
+
+
+def get_recs_batch(model_name, requests):
+    """get_recs for several requests (dicts of get_recs' arguments) at once.
+
+    Also returns this worker's decoder cache stats, since the caches live in
+    the worker processes.
+    """
     wrapper = models[model_name]
-    logits, vocab = wrapper.generate_completions(in_text, tokens_so_far)
-    return get_top_k(logits, vocab, k=3, prefix=prefix)
+    logits, vocab = wrapper.generate_completions_batch([
+        (request['in_text'], request['tokens_so_far'], request.get('session'))
+        for request in requests])
+    recs = [
+        get_top_k(
+            logits[i], wrapper.vocab_index, k=3, prefix=request.get('prefix'))
+        for i, request in enumerate(requests)]
+    return dict(
+        recs=recs, worker=os.getpid(),
+        cache_stats=wrapper.decoder_cache.get_stats())
+
+
+def prewarm_encoder_caches():
+    for name, wrapper in models.items():
+        n_encoded = wrapper.prewarm_encoder_cache()
+        if n_encoded:
+            print(f"Encoded {n_encoded} images for {name}")
@@ -1,33 +1,53 @@
 #!/usr/bin/env python
+"""
+Load-test the server by replaying logged rpc requests.
 
-import time
+Two ways to generate load:
+
+- closed loop (--mode closed): N connections each send a request, wait for the
+  reply, and send the next, for each N in --concurrency.
+- open loop (--mode open): N logged participant sessions are replayed at once,
+  each on its own connection, sending requests at the times the participant
+  originally did (sped up by --speedup), whether or not earlier replies are
+  back. This is what the server sees from real typists.
+
+Reports latency percentiles and error counts per rpc method, as JSON (--report)
+so runs of different builds can be diffed. With --local, starts the app
+in-process with a stand-in recommender that just sleeps, to measure the
+server's own overhead.
+"""
+
+import argparse
+import asyncio
+import collections
 import datetime
 import glob
-import zlib
-import json
 import random
+import time
+import zlib
 
+import numpy as np
 from tornado import websocket, ioloop, queues
 
-oldest_timestamp = datetime.datetime(2018, 6, 1).timestamp()
-lines = (json.loads(line.strip()) for logfile in glob.glob('logs/*.jsonl') for line in open(logfile))
-requests = [
-    line['request'] for line in lines
-    if line['type'] == 'rpc' and line.get('pyTimestamp', 0) > oldest_timestamp]
-requests.sort(key=lambda x: x['timestamp'])
-random.Random(0).shuffle(requests)
-    # (
-    # x['rpc']['request_id'],
-    # x['rpc']['sofar'],
-    # ''.join([ent['letter'] for ent in x['rpc']['cur_word']])))
-print(len(requests), 'requests')
-requests = requests[:1000]#[-10:]
-
-with open(f'requests', 'w') as f:
-    f.write('\n'.join(json.dumps(request) for request in requests))
-
-ws_url = "ws://localhost:5000/ws"
-concurrency = 10
+from textrec import serialization
+
+DEFAULT_SINCE = '2018-06-01'
+
+
+def load_sessions(log_glob, since):
+    """Logged rpc requests, grouped by participant and in the order sent."""
+    oldest_timestamp = datetime.datetime.strptime(since, '%Y-%m-%d').timestamp()
+    sessions = collections.defaultdict(list)
+    for logfile in glob.glob(log_glob):
+        with open(logfile, encoding='utf-8') as f:
+            for line in f:
+                entry = serialization.loads(line)
+                if entry['type'] == 'rpc' and entry.get('pyTimestamp', 0) > oldest_timestamp:
+                    sessions[entry['participant_id']].append(entry['request'])
+    for requests in sessions.values():
+        requests.sort(key=lambda x: x['timestamp'])
+    return dict(sessions)
+
 
 class ZWSConnection:
     def __init__(self):
@@ -40,7 +60,7 @@ class ZWSConnection:
         self.deflater = zlib.compressobj()
 
     def send_json(self, **kw):
-        message = json.dumps(kw)
+        message = serialization.dumps(kw)
         message = self.deflater.compress(message.encode('utf-8'))
         message += self.deflater.flush(zlib.Z_SYNC_FLUSH)
         return self.connection.write_message(message.decode('latin1'))
@@ -48,63 +68,234 @@ class ZWSConnection:
     async def read_message(self):
         zreply = await self.connection.read_message()
         if zreply is None:
-            print("CONNECTION CLOSED?!")
             return
         reply = self.inflater.decompress(zreply.encode('latin1'))
         reply += self.inflater.flush()
-        return json.loads(reply.decode('utf-8'))
+        return serialization.loads(reply.decode('utf-8'))
+
+    async def read_reply(self):
+        """The next rpc reply, skipping other messages (e.g., the backlog)."""
+        while True:
+            message = await self.read_message()
+            if message is None or message.get('type') == 'reply':
+                return message
+
+    def close(self):
+        self.connection.close()
+
+
+async def open_connection(ws_url, participant_id):
+    conn = ZWSConnection()
+    await conn.connect(ws_url)
+    await conn.send_json(type='init', kind='p', participantId=participant_id)
+    return conn
+
+
+class Recorder:
+    """Latencies and outcomes of requests, by rpc method."""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.defaultdict(collections.Counter)
+
+    def record(self, method, outcome, latency=None):
+        self.outcomes[method][outcome] += 1
+        if latency is not None:
+            self.latencies[method].append(latency)
 
+    def summary(self):
+        methods = {}
+        for method, outcomes in self.outcomes.items():
+            latencies = np.array(self.latencies[method]) * 1000
+            total = sum(outcomes.values())
+            summary = dict(
+                count=total,
+                outcomes=dict(outcomes),
+                error_rate=(outcomes['error'] + outcomes['timeout']) / total)
+            if len(latencies):
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+                summary.update(
+                    latency_ms=dict(
+                        p50=p50, p95=p95, p99=p99,
+                        mean=latencies.mean(), max=latencies.max()))
+            methods[method] = summary
+        return methods
 
 
+def method_of(request):
+    return request['rpc'].get('method', 'unknown')
 
-async def main():
+
+async def run_closed_loop(ws_url, requests, concurrency, timeout):
+    recorder = Recorder()
     q = queues.Queue()
+    for request in requests:
+        q.put(request)
+
+    async def worker(worker_idx):
+        conn = await open_connection(ws_url, f'demobench{worker_idx}')
+        try:
+            async for request in q:
+                try:
+                    start = time.perf_counter()
+                    await conn.send_json(**request)
+                    try:
+                        reply = await asyncio.wait_for(conn.read_reply(), timeout)
+                    except asyncio.TimeoutError:
+                        # The reply might still come; don't confuse it with the next.
+                        recorder.record(method_of(request), 'timeout')
+                        conn.close()
+                        conn = await open_connection(ws_url, f'demobench{worker_idx}')
+                        continue
+                    latency = time.perf_counter() - start
+                    ok = reply is not None and reply.get('result') is not None
+                    recorder.record(method_of(request), 'ok' if ok else 'error', latency)
+                finally:
+                    q.task_done()
+        finally:
+            conn.close()
 
-    for i, request in enumerate(requests):
-        q.put((i, request))
-    # print(q._unfinished_tasks)
-    start = time.time()
-
-    results = []
-
-    async def worker():
-        conn = ZWSConnection()
-        await conn.connect(ws_url)
-        await conn.send_json(
-            type='init',
-            kind='p',
-            participantId="demobench")
-        print(await conn.read_message())
-
-        async for i, request in q:
-            # print('consumer', q._unfinished_tasks)
-            try:
-                # Send a request
-                request = dict(request)
-                await conn.send_json(**request)
-
-                # Get the response.
-                reply = await conn.read_message()
-                # print(reply)
-                results.append((i, reply['result']))
-            finally:
-                q.task_done()
-
-    # Start workers, then wait for the work queue to be empty.
-    for _ in range(concurrency):
-        ioloop.IOLoop.current().spawn_callback(worker)
+    for worker_idx in range(concurrency):
+        ioloop.IOLoop.current().spawn_callback(worker, worker_idx)
     await q.join()
-    # print('joined', q._unfinished_tasks)
+    return recorder
+
+
+async def run_open_loop(ws_url, sessions, concurrency, speedup, timeout):
+    """Replay `concurrency` sessions at once, each at its logged pace."""
+    recorder = Recorder()
+
+    async def replay(session_idx, requests):
+        conn = await open_connection(ws_url, f'demobench{session_idx}')
+        sent = {}  # timestamp -> (method, send time)
+        superseded = set()
+
+        async def reader():
+            while True:
+                reply = await conn.read_reply()
+                if reply is None:
+                    return
+                method, start = sent.pop(reply['timestamp'], (None, None))
+                if method is None:
+                    continue
+                ok = reply.get('result') is not None
+                recorder.record(method, 'ok' if ok else 'error', time.perf_counter() - start)
+
+        reader_task = asyncio.ensure_future(reader())
+        # Start sessions spread over the first second, so they don't all type in lockstep.
+        await asyncio.sleep(random.random())
+        t0_log = requests[0]['timestamp'] / 1000
+        t0 = time.perf_counter()
+        for request in requests:
+            delay = t0 + (request['timestamp'] / 1000 - t0_log) / speedup - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            method = method_of(request)
+            if method == 'get_rec':
+                # The server drops the reply to a get_rec still pending when a newer
+                # one arrives, unless it's already on its way.
+                superseded.update(
+                    timestamp for timestamp, (other, _) in sent.items() if other == 'get_rec')
+            sent[request['timestamp']] = (method, time.perf_counter())
+            await conn.send_json(**request)
+
+        deadline = time.perf_counter() + timeout
+        while set(sent) - superseded and time.perf_counter() < deadline:
+            await asyncio.sleep(.01)
+        for timestamp, (method, start) in sent.items():
+            recorder.record(method, 'superseded' if timestamp in superseded else 'timeout')
+        reader_task.cancel()
+        conn.close()
+
+    await asyncio.gather(*[
+        replay(session_idx, requests)
+        for session_idx, requests in enumerate(sessions[:concurrency])])
+    return recorder
+
+
+def start_local_server(port, service_time):
+    """Serve the app in this process, with recs that just take `service_time` seconds."""
+    from textrec import app, rec_generator
+
+    async def stand_in_handle_request(executor, request, session=None):
+        await asyncio.sleep(service_time)
+        return dict(predictions=[dict(words=['stand-in'], meta=None)] * 3,
+                    request_id=request.get('request_id'))
+
+    rec_generator.handle_request_async = stand_in_handle_request
+    app.Application().listen(port, address='127.0.0.1')
+    return f'ws://127.0.0.1:{port}/ws'
+
+
+async def main(opts):
+    sessions = load_sessions(opts.logs, opts.since)
+    session_list = [requests for pid, requests in sorted(sessions.items()) if requests]
+    random.Random(0).shuffle(session_list)
+    requests = [request for requests in session_list for request in requests]
+    random.Random(0).shuffle(requests)
+    requests = requests[:opts.max_requests]
+    print(len(session_list), 'sessions,', len(requests), 'requests')
+
+    if opts.local:
+        ws_url = start_local_server(opts.port, opts.service_time)
+    else:
+        ws_url = opts.url
+
+    report = dict(
+        config=dict(vars(opts), ws_url=ws_url, json_backend=serialization.BACKEND),
+        runs=[])
+    for concurrency in opts.concurrency:
+        start = time.time()
+        if opts.mode == 'closed':
+            recorder = await run_closed_loop(ws_url, requests, concurrency, opts.timeout)
+        else:
+            recorder = await run_open_loop(
+                ws_url, session_list, concurrency, opts.speedup, opts.timeout)
+        duration = time.time() - start
+        methods = recorder.summary()
+        n_requests = sum(summary['count'] for summary in methods.values())
+        report['runs'].append(dict(
+            mode=opts.mode, concurrency=concurrency, duration=duration,
+            requests=n_requests, throughput=n_requests / duration, methods=methods))
+
+        print(f'{opts.mode} loop, concurrency {concurrency}: '
+              f'{n_requests} requests in {duration:.2f}s')
+        for method, summary in sorted(methods.items()):
+            latency = summary.get('latency_ms', {})
+            print('  {:<12} n={:<6} err={:.1%} p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms {}'.format(
+                method, summary['count'], summary['error_rate'],
+                latency.get('p50', float('nan')), latency.get('p95', float('nan')),
+                latency.get('p99', float('nan')), summary['outcomes']))
+
+    if opts.report:
+        with open(opts.report, 'w', encoding='utf-8') as f:
+            f.write(serialization.dumps(report))
+        print('Wrote', opts.report)
 
-    print('Done in %.2f seconds' % (
-        time.time() - start))
-    with open(f'results_{concurrency}', 'w') as f:
-        for i, result in sorted(results):
-            json.dump(result, f)
-            f.write('\n')
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='ws://localhost:5000/ws')
+    parser.add_argument('--logs', default='logs/*.jsonl', help='glob of logs to replay')
+    parser.add_argument('--since', default=DEFAULT_SINCE, help='only replay requests after this date')
+    parser.add_argument('--max-requests', type=int, default=1000, help='closed loop only')
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed')
+    parser.add_argument('--concurrency', type=lambda s: [int(x) for x in s.split(',')], default=[10],
+                        help='comma-separated: connections (closed) or sessions (open) per run')
+    parser.add_argument('--speedup', type=float, default=1.,
+                        help='open loop: replay sessions this many times faster than logged')
+    parser.add_argument('--timeout', type=float, default=10., help='seconds to wait for a reply')
+    parser.add_argument('--report', help='write a JSON report here')
+    parser.add_argument('--local', action='store_true',
+                        help='start the app in-process with a stand-in recommender')
+    parser.add_argument('--port', type=int, default=5099, help='port for --local')
+    parser.add_argument('--service-time', type=float, default=.005,
+                        help='seconds the stand-in recommender takes, for --local')
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
+    opts = parse_args()
     io_loop = ioloop.IOLoop.current()
-    io_loop.run_sync(main)
+    io_loop.run_sync(lambda: main(opts))
@@ -1,11 +1,17 @@
+import asyncio
+import collections
+import concurrent.futures
 import json
 import traceback
 
 import nltk
 import numpy as np
+import tornado.ioloop
+import tornado.locks
+import tornado.util
 import wordfreq
 
-from . import cueing
+from . import cueing, metrics
 
 try:
     from icecream import ic
@@ -30,6 +36,10 @@ PARTS_NEEDED = [
     "labels",
     "vectorizer",
     "projection_mat",
+    "clusterer",
+    "is_close",
+    "topic_w2v",
+    "overall_topic_distribution",
 ]
 
 
@@ -37,14 +47,80 @@ if False:
     cueing.preload_models(PRELOAD_MODELS, PARTS_NEEDED)
 
 
-async def handle_request_async(executor, request):
+class RPCMethod:
+    """
+    How to run one RPC method off the IOLoop thread.
+
+    `func` takes the request and does the work on `executor` ("thread" for
+    numpy/sklearn work, which releases the GIL; "process" for spaCy and kenlm,
+    which don't), with at most `max_concurrent` calls running or queued there.
+    If a call can't finish within `timeout` seconds, the client gets
+    `degraded(request)` instead; the work itself may still finish in the
+    background, and keeps its slot until it does.
+    """
+
+    def __init__(self, func, *, executor, max_concurrent, timeout, degraded):
+        self.func = func
+        self.executor = executor
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.degraded = degraded
+        self.semaphore = None
+        self.stats = dict(calls=0, timeouts=0, saturated=0)
+
+    def configure(self, executor=None, max_concurrent=None, timeout=None):
+        if executor is not None:
+            assert executor in ("thread", "process"), executor
+            self.executor = executor
+        if max_concurrent is not None:
+            self.max_concurrent = max_concurrent
+            self.semaphore = None
+        if timeout is not None:
+            self.timeout = timeout
+
+    async def __call__(self, process_pool, request):
+        if self.semaphore is None:
+            self.semaphore = tornado.locks.Semaphore(self.max_concurrent)
+        self.stats["calls"] += 1
+        deadline = tornado.ioloop.IOLoop.current().time() + self.timeout
+        try:
+            await self.semaphore.acquire(timeout=deadline)
+        except tornado.util.TimeoutError:
+            self.stats["saturated"] += 1
+            return self.degraded(request)
+
+        executor = thread_pool if self.executor == "thread" else process_pool
+        semaphore = self.semaphore
+        io_loop = tornado.ioloop.IOLoop.current()
+        future = metrics.submit_timed(
+            executor,
+            self.executor,
+            request["method"],
+            domain_to_model.get(request.get("domain"), ""),
+            self.func,
+            request,
+        )
+        # Done callbacks run on a pool thread, so hop back to the loop to release.
+        future.add_done_callback(lambda f: io_loop.add_callback(semaphore.release))
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), deadline - io_loop.time()
+            )
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            return self.degraded(request)
+
+
+async def handle_request_async(executor, request, session=None):
+    """Run an RPC. `session` (e.g., the participant id) keys per-session caches."""
     method = request["method"]
-    if method == "get_rec":
+    if method == "get_rec" and "stimulus" in request:
+        # Typing experiments ask for next-word predictions about a stimulus.
+        result = await get_keystroke_rec_onmt(executor, request, session=session)
+    elif method == "get_rec":
         result = await get_keystroke_rec(executor, request)
-    elif method == "get_cue":
-        result = await get_cue_API(executor, request)
-    elif method == "analyze_doc":
-        result = analyze_doc(request)
+    else:
+        result = await RPC_METHODS[method](executor, request)
     print("Result:", result)
     return result
 
@@ -60,7 +136,7 @@ domain_to_model["wiki-book"] = "wiki-book_128"
 domain_to_model["wiki-film"] = "wiki-film_128"
 
 
-async def get_cue_API(executor, request):
+def get_cue_API(request):
     rec_type = request["recType"]
     domain = request["domain"]
     n_cues = request.get("n_cues", 5)
@@ -139,34 +215,29 @@ def get_cue(text, *, model_name, n_cues, mode, method="w2v", randomize=False):
             return dict(text=phrase)
 
     elif mode == "example":
-        topic_labeled_sentences = cueing.get_model(model_name, "sentences")
-        is_close = cueing.get_model(model_name, "is_close")
-
-        # topic_labeled_sentences["close_to_cluster_center"] = is_close
-        topic_labeled_sentences = topic_labeled_sentences[is_close]
+        cue_index = cueing.get_cue_index(model_name)
 
         def get_cue_for_cluster(cluster_to_cue):
-            cluster_sentences = topic_labeled_sentences[
-                topic_labeled_sentences.topic == cluster_to_cue
-            ]
-            if len(cluster_sentences) > MIN_CLUSTER_SIZE:
-                idx = np.random.choice(len(cluster_sentences))
-                sentence = cluster_sentences.raw_sent.iloc[idx]
+            n_examples = cue_index.n_examples(cluster_to_cue)
+            if n_examples > MIN_CLUSTER_SIZE:
+                idx = np.random.choice(n_examples)
+                sentence = cue_index.example(cluster_to_cue, idx)
                 return dict(
                     text=sentence,
                     label=get_label_for_cluster(cluster_to_cue),
-                    # is_close=cluster_sentences.close_to_cluster_center.iloc[idx].item(),
                 )
 
     elif mode == "exampleHighlighted":
-        labels_and_sents = cueing.get_model(model_name, "labels_and_sents")
+        cue_index = cueing.get_cue_index(model_name)
 
         def get_cue_for_cluster(cluster_to_cue):
-            if cluster_to_cue not in labels_and_sents:
+            n_candidates = cue_index.n_highlighted(cluster_to_cue)
+            if n_candidates == 0:
                 return
-            label, candidates = labels_and_sents[cluster_to_cue]
-            candidate_idx = np.random.choice(len(candidates))
-            sentence, label_span = candidates[candidate_idx]
+            candidate_idx = np.random.choice(n_candidates)
+            sentence, label_span = cue_index.highlighted_example(
+                cluster_to_cue, candidate_idx
+            )
             return dict(
                 text=sentence,
                 highlightSpan=label_span,
@@ -196,7 +267,7 @@ def get_cue(text, *, model_name, n_cues, mode, method="w2v", randomize=False):
         cue = get_cue_for_cluster(cluster_to_cue)
         if cue is None:
             continue
-        cue["cluster"] = int(cluster_to_cue)
+        cue["cluster"] = cluster_to_cue
 
         cues.append(cue)
         if len(cues) == n_clusters_to_cue:
@@ -289,7 +360,7 @@ def analyze_doc(request):
     cluster_labels = cueing.get_model(model_name, "labels")
 
     clusters_with_labels = [
-        dict(cluster_id=int(cluster_id), label=" / ".join(cluster_labels[cluster_id]))
+        dict(cluster_id=cluster_id, label=" / ".join(cluster_labels[cluster_id]))
         for cluster_id in clusters
     ]
 
@@ -316,6 +387,37 @@ def next_cluster_distribution(text, model_name, method, existing_clusters_weight
     return existing_clusters, cluster_probs
 
 
+thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+RPC_METHODS = dict(
+    get_cue=RPCMethod(
+        get_cue_API,
+        executor="thread",
+        max_concurrent=4,
+        timeout=2.0,
+        degraded=lambda request: dict(cues=[], degraded=True),
+    ),
+    analyze_doc=RPCMethod(
+        analyze_doc,
+        executor="process",
+        max_concurrent=2,
+        timeout=5.0,
+        degraded=lambda request: dict(
+            raw_sents=[], tokenized_sents=[], clusters=[], degraded=True
+        ),
+    ),
+)
+
+
+def configure_rpc(config, n_threads=None):
+    """Override RPC_METHODS settings, e.g., {"analyze_doc": {"timeout": 10}}."""
+    global thread_pool
+    if n_threads is not None:
+        thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=n_threads)
+    for method, settings in config.items():
+        RPC_METHODS[method].configure(**settings)
+
+
 async def get_keystroke_rec(executor, request):
     """
     Generate keystorke recs, with cues at transition points.
@@ -339,7 +441,164 @@ async def get_keystroke_rec(executor, request):
     return {}
 
 
-async def get_keystroke_rec_onmt(executor, request):
+class RecBatcher:
+    """
+    Coalesces get_recs requests for the same model that arrive close together.
+
+    The first request for a model starts a short timer; everything that arrives
+    for that model before it fires (or until the batch is full) goes to a worker
+    as one get_recs_batch call, which runs the decoder once for all of them.
+
+    Each worker process has its own decoder state cache, so given `executors`
+    (single-worker executors, one per worker) a session's requests always go to
+    the same worker, like ClusterLMPool's shards, and requests are batched per
+    model and worker. Without them, batches go to the shared executor.
+    """
+
+    def __init__(self, window=0.003, max_batch_size=64, executors=()):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.executors = list(executors)
+        self.pending = {}
+        self.stats = dict(requests=0, batches=0, cancelled=0)
+        # (model name, worker pid) -> that worker's latest decoder cache stats
+        self.decoder_cache_stats = {}
+
+    def _executor_for(self, executor, session):
+        if not self.executors:
+            return None, executor
+        worker = hash(session) % len(self.executors)
+        return worker, self.executors[worker]
+
+    async def get_recs(self, executor, model_name, **request):
+        future = asyncio.get_event_loop().create_future()
+        worker, executor = self._executor_for(executor, request.get("session"))
+        key = (model_name, worker)
+        batch = self.pending.setdefault(key, [])
+        batch.append((request, future))
+        if len(batch) >= self.max_batch_size:
+            tornado.ioloop.IOLoop.current().add_callback(
+                self._flush, executor, key, batch
+            )
+        elif len(batch) == 1:
+            tornado.ioloop.IOLoop.current().call_later(
+                self.window, self._flush, executor, key, batch
+            )
+        return await future
+
+    async def _flush(self, executor, key, batch):
+        if self.pending.get(key) is not batch:
+            # Already flushed because it filled up.
+            return
+        del self.pending[key]
+        model_name, worker = key
+        from . import onmt_model_2
+
+        # Requests superseded while waiting don't need any work.
+        live = [(request, future) for request, future in batch if not future.done()]
+        self.stats["cancelled"] += len(batch) - len(live)
+        batch = live
+        if not batch:
+            return
+        self.stats["requests"] += len(batch)
+        self.stats["batches"] += 1
+        try:
+            reply = await asyncio.wrap_future(
+                metrics.submit_timed(
+                    executor,
+                    "process",
+                    "get_recs",
+                    model_name,
+                    onmt_model_2.get_recs_batch,
+                    model_name,
+                    [request for request, future in batch],
+                )
+            )
+        except asyncio.CancelledError:
+            # (On Python < 3.8, CancelledError is an Exception.)
+            for request, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for request, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.decoder_cache_stats[model_name, reply["worker"]] = reply["cache_stats"]
+        for (request, future), result in zip(batch, reply["recs"]):
+            if not future.done():
+                future.set_result(result)
+
+
+rec_batcher = RecBatcher()
+
+
+DECODER_CACHE_EVENTS = {"hits", "misses", "decoder_steps", "evictions"}
+
+
+def collect_stats():
+    """RPC_METHODS, rec_batcher, and decoder cache stats, for /metrics."""
+    rpc_samples = [
+        (dict(method=method, event=event), count)
+        for method, rpc_method in sorted(RPC_METHODS.items())
+        for event, count in sorted(rpc_method.stats.items())
+    ]
+    batcher_samples = [
+        (dict(event=event), count) for event, count in sorted(rec_batcher.stats.items())
+    ]
+    # Each worker has its own decoder caches; add them up by model.
+    decoder_cache_totals = collections.Counter()
+    for (model_name, worker), stats in rec_batcher.decoder_cache_stats.items():
+        for key, value in stats.items():
+            decoder_cache_totals[model_name, key] += value
+    decoder_cache_events = [
+        (dict(model=model_name, event=key), value)
+        for (model_name, key), value in sorted(decoder_cache_totals.items())
+        if key in DECODER_CACHE_EVENTS
+    ]
+    decoder_cache_sizes = [
+        (dict(model=model_name, measure=key), value)
+        for (model_name, key), value in sorted(decoder_cache_totals.items())
+        if key not in DECODER_CACHE_EVENTS
+    ]
+    return [
+        (
+            "textrec_rpc_method_events_total",
+            "counter",
+            "RPCMethod calls, and calls that were degraded by timeouts or saturation.",
+            rpc_samples,
+        ),
+        (
+            "textrec_rec_batcher_events_total",
+            "counter",
+            "get_recs requests, batches, and requests cancelled before batching.",
+            batcher_samples,
+        ),
+        (
+            "textrec_decoder_cache_events_total",
+            "counter",
+            "ONMT decoder state cache hits, misses, decoder steps, and evictions.",
+            decoder_cache_events,
+        ),
+        (
+            "textrec_decoder_cache_size",
+            "gauge",
+            "Sessions, trie nodes, and bytes in the ONMT decoder state caches.",
+            decoder_cache_sizes,
+        ),
+    ]
+
+
+metrics.register_collector(collect_stats)
+
+
+async def get_keystroke_rec_onmt(executor, request, session=None):
+    """
+    Generate next-word recs using an ONMT model.
+
+    `session` (e.g., the participant id) keys the decoder state cache, so each
+    participant's typing reuses the states of their own earlier prefixes.
+    """
     from . import onmt_model_2
 
     request_id = request.get("request_id")
@@ -366,9 +625,17 @@ async def get_keystroke_rec_onmt(executor, request):
     in_text = onmt_model_2.tokenize_stimulus(stimulus_content)
     tokens = onmt_model_2.tokenize(request["sofar"])
     try:
-        recs = await executor.submit(
-            onmt_model_2.get_recs, model_name, in_text, tokens, prefix=prefix
+        recs = await rec_batcher.get_recs(
+            executor,
+            model_name,
+            in_text=in_text,
+            tokens_so_far=tokens,
+            prefix=prefix,
+            session=session,
         )
+    except asyncio.CancelledError:
+        # Superseded by a newer request; on Python < 3.8 this is an Exception.
+        raise
     except Exception:
         traceback.print_exc()
         print("Failing request:", json.dumps(request))
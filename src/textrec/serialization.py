@@ -0,0 +1,80 @@
+"""
+JSON encoding and decoding for the websocket and log hot paths.
+
+Uses the fastest library available: orjson, then ujson, then the standard
+library. Whichever it is, numpy scalars and arrays (e.g., cluster ids from
+rec_generator) serialize as plain numbers and lists, so callers don't need to
+convert them first.
+
+Output is compact and, except with the standard library, not ASCII-escaped;
+anything that cares about byte lengths should encode the string as UTF-8.
+"""
+import json
+
+import numpy as np
+
+
+def _numpy_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, default=_numpy_default)
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _make_orjson_dumps():
+    options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_numpy_default, option=options).decode(
+            "utf-8"
+        )
+
+    return dumps
+
+
+def _make_ujson_dumps():
+    def dumps(obj):
+        return ujson.dumps(obj, default=_numpy_default, ensure_ascii=False)
+
+    return dumps
+
+
+def get_backends():
+    """The available (name, dumps, loads), fastest first."""
+    backends = []
+    if orjson is not None:
+        backends.append(("orjson", _make_orjson_dumps(), orjson.loads))
+    if ujson is not None:
+        backends.append(("ujson", _make_ujson_dumps(), ujson.loads))
+    backends.append(("json", _stdlib_dumps, json.loads))
+    return backends
+
+
+def _works(dumps, loads):
+    # Old versions of ujson lack `default`, and mangle numpy scalars.
+    probe = dict(a=np.int64(3), b=np.float32(0.5), c=[np.arange(2)], d="é")
+    try:
+        return loads(dumps(probe)) == dict(a=3, b=0.5, c=[[0, 1]], d="é")
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+
+BACKEND, dumps, loads = next(
+    (name, dumps, loads) for name, dumps, loads in get_backends() if _works(dumps, loads)
+)
@@ -0,0 +1,203 @@
+"""
+Binary sidecar caches for data derived from model files.
+
+Parsing a big ARPA file takes minutes, and every process that loads a model used
+to do it again. A sidecar is a directory next to the model holding what we
+derived from it (numpy arrays, plus any other files) and a meta.json recording:
+
+- the sidecar format version,
+- the size, mtime, and SHA-1 of each source file it was derived from,
+- the size and SHA-1 of each file in the sidecar.
+
+If anything doesn't match, the sidecar is ignored and the caller rebuilds it.
+Arrays are memory-mapped, so processes that load the same model share pages.
+Reading a file only checks its size, so loading doesn't read the whole file;
+Sidecar.verify (or `python -m textrec.sidecar foo.sidecar`, which also makes
+the next load rebuild a bad one) checks the hashes.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_VERSION = 2
+
+
+class SidecarMissing(Exception):
+    """The sidecar doesn't have the requested data, or it can't be trusted."""
+
+
+def sha1_file(filename, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def describe_source(filename):
+    stat = os.stat(filename)
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha1=sha1_file(filename))
+
+
+def source_matches(filename, recorded):
+    """Whether a source file is unchanged. Only hashes it if the mtime changed."""
+    stat = os.stat(filename)
+    if recorded is None or recorded["size"] != stat.st_size:
+        return False
+    if recorded["mtime_ns"] == stat.st_mtime_ns:
+        return True
+    return recorded["sha1"] == sha1_file(filename)
+
+
+class Sidecar:
+    def __init__(self, basename, sources):
+        self.path = f"{basename}.sidecar"
+        self.sources = [str(source) for source in sources]
+        self.meta = self._read_meta()
+
+    @property
+    def meta_file(self):
+        return os.path.join(self.path, "meta.json")
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != SIDECAR_VERSION:
+            logger.info(f"Ignoring {self.path}: version {meta.get('version')}")
+            return None
+        for source in self.sources:
+            recorded = meta["sources"].get(os.path.basename(source))
+            if not source_matches(source, recorded):
+                logger.info(f"Ignoring {self.path}: {source} changed")
+                return None
+        return meta
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def has(self, *names):
+        return self.meta is not None and all(
+            name in self.meta["files"] for name in names
+        )
+
+    def _checked_filename(self, name):
+        if not self.has(name):
+            raise SidecarMissing(name)
+        filename = self.filename(name)
+        if not os.path.exists(filename) or (
+            os.path.getsize(filename) != self.meta["files"][name]["size"]
+        ):
+            logger.warning(f"Sidecar file {filename} is missing or the wrong size")
+            self.meta = None
+            raise SidecarMissing(name)
+        return filename
+
+    def verify(self):
+        """Check the SHA-1 of every file; return the names of any that are wrong.
+
+        If any are, forgets all of them, so the caller rebuilds the sidecar.
+        """
+        if self.meta is None:
+            return []
+        bad = [
+            name
+            for name, recorded in self.meta["files"].items()
+            if not os.path.exists(self.filename(name))
+            or sha1_file(self.filename(name)) != recorded["sha1"]
+        ]
+        if bad:
+            logger.warning(f"Sidecar {self.path} has bad files: {bad}")
+            self.meta = None
+        return bad
+
+    def read_array(self, name):
+        return np.load(self._checked_filename(name + ".npy"), mmap_mode="r")
+
+    def read_arrays(self, names):
+        return {name: self.read_array(name) for name in names}
+
+    def read_lines(self, name):
+        with open(self._checked_filename(name + ".txt"), encoding="utf-8") as f:
+            return f.read().split("\n")
+
+    def read_with(self, name, loader):
+        """Load a file that some library knows how to read, e.g., a saved trie."""
+        return loader(self._checked_filename(name))
+
+    def write(self, arrays={}, lines={}, savers={}):
+        """Save files to the sidecar, then record them in meta.json.
+
+        `savers` maps names to functions that write to a file object.
+        Each file is written under a temporary name and moved into place, so
+        concurrent readers never see a half-written file.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if self.meta is None:
+            self.meta = dict(
+                version=SIDECAR_VERSION,
+                sources={
+                    os.path.basename(source): describe_source(source)
+                    for source in self.sources
+                },
+                files={},
+            )
+        to_write = dict(savers)
+        for name, array in arrays.items():
+            to_write[name + ".npy"] = lambda f, array=array: np.save(f, array)
+        for name, text_lines in lines.items():
+            to_write[name + ".txt"] = lambda f, text_lines=text_lines: _write_lines(
+                f, text_lines
+            )
+        pid = os.getpid()
+        for name, saver in to_write.items():
+            filename = self.filename(name)
+            tmp_filename = f"{filename}.{pid}.tmp"
+            with open(tmp_filename, "wb") as f:
+                saver(f)
+            self.meta["files"][name] = dict(
+                size=os.path.getsize(tmp_filename), sha1=sha1_file(tmp_filename)
+            )
+            os.replace(tmp_filename, filename)
+        tmp_meta_file = f"{self.meta_file}.{pid}.tmp"
+        with open(tmp_meta_file, "w") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp_meta_file, self.meta_file)
+
+
+def _write_lines(f, lines):
+    for i, line in enumerate(lines):
+        assert "\n" not in line
+        if i:
+            f.write(b"\n")
+        f.write(line.encode("utf-8"))
+
+
+if __name__ == "__main__":
+    import sys
+
+    failed = False
+    for path in sys.argv[1:]:
+        if path.endswith(".sidecar"):
+            path = path[: -len(".sidecar")]
+        sidecar = Sidecar(path, [])
+        if sidecar.meta is None:
+            print(f"{sidecar.path}: missing, or an old version")
+            failed = True
+            continue
+        bad = sidecar.verify()
+        if bad:
+            # Without its meta.json, the next load rebuilds the sidecar.
+            os.remove(sidecar.meta_file)
+            print(f"{sidecar.path}: bad files {bad}; removed meta.json")
+            failed = True
+        else:
+            print(f"{sidecar.path}: ok")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,137 @@
+"""
+How websocket messages are compressed.
+
+The client picks a mode with the `compression` query argument of the websocket
+URL (see frontend/src/wsclient.js):
+
+- "zlib-text" (the default, and the only mode older clients know): one zlib
+  stream per direction, flushed after each message, with the compressed bytes
+  sent as latin1 text frames. Simple, but every byte over 127 costs two on the
+  wire once the browser encodes the frame as UTF-8.
+- "permessage-deflate": plain JSON text frames, compressed by the websocket
+  protocol's own extension, if the browser negotiates it.
+- "zlib-dict": like zlib-text, but sent as binary frames, with both streams
+  primed with a preset dictionary of strings common in our messages, so even
+  the first messages on a connection (notably the backlog) compress well.
+
+The dictionary is built from logs by scripts/train_ws_dictionary.py and served
+to clients at /ws_dictionary, so both sides use the same bytes. Since it can be
+retrained while a page stays open, it's versioned by a hash of its bytes: the
+client gets the version with the dictionary and passes it as the `dictionary`
+argument, and a connection with any other version is closed with
+STALE_DICTIONARY_CODE, so the client fetches the dictionary again.
+"""
+import collections
+import hashlib
+import re
+import zlib
+
+from .paths import paths
+
+DEFAULT_MODE = "zlib-text"
+DICTIONARY_FILE = paths.models / "ws_dictionary.bin"
+# zlib can only use the last 32K of a dictionary.
+MAX_DICTIONARY_SIZE = 32 * 1024
+DICTIONARY_VERSION_HEADER = "X-Dictionary-Version"
+# A websocket close code (4000-4999 are for applications).
+STALE_DICTIONARY_CODE = 4001
+
+
+class ZlibTextCodec:
+    binary = False
+
+    def __init__(self, zdict=None):
+        if zdict is None:
+            self.deflater = zlib.compressobj()
+            self.inflater = zlib.decompressobj()
+        else:
+            self.deflater = zlib.compressobj(zdict=zdict)
+            self.inflater = zlib.decompressobj(zdict=zdict)
+
+    def _compress(self, message):
+        compressed = self.deflater.compress(message.encode("utf-8"))
+        return compressed + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+
+    def _decompress(self, data):
+        message = self.inflater.decompress(data)
+        message += self.inflater.flush()
+        return message.decode("utf-8")
+
+    def encode(self, message):
+        return self._compress(message).decode("latin1")
+
+    def decode(self, frame):
+        return self._decompress(frame.encode("latin1"))
+
+
+class ZlibDictCodec(ZlibTextCodec):
+    binary = True
+
+    def __init__(self):
+        super().__init__(zdict=get_dictionary())
+
+    def encode(self, message):
+        return self._compress(message)
+
+    def decode(self, frame):
+        return self._decompress(frame)
+
+
+class PlainCodec:
+    """For permessage-deflate, where the websocket layer does the compressing."""
+
+    binary = False
+
+    def encode(self, message):
+        return message
+
+    def decode(self, frame):
+        return frame
+
+
+CODECS = {
+    "zlib-text": ZlibTextCodec,
+    "zlib-dict": ZlibDictCodec,
+    "permessage-deflate": PlainCodec,
+}
+
+
+_dictionary = None
+
+
+def get_dictionary():
+    global _dictionary
+    if _dictionary is None:
+        _dictionary = DICTIONARY_FILE.read_bytes()[-MAX_DICTIONARY_SIZE:]
+    return _dictionary
+
+
+def get_dictionary_version():
+    return hashlib.sha1(get_dictionary()).hexdigest()[:16]
+
+
+def train_dictionary(messages, size=MAX_DICTIONARY_SIZE, min_count=4):
+    """Build a preset dictionary from sample messages (JSON strings).
+
+    Picks the JSON strings, keys, and literals that would save the most bytes
+    (count x length), and puts the most valuable last, since zlib finds nearer
+    matches with shorter codes.
+    """
+    token_re = re.compile(r'"(?:[^"\\]|\\.){0,64}"\s*:?\s*|-?\d+\.?\d*|true|false|null')
+    counts = collections.Counter()
+    for message in messages:
+        counts.update(token_re.findall(message))
+    scored = sorted(
+        (count * len(token), token)
+        for token, count in counts.items()
+        if count >= min_count
+    )
+    chosen = []
+    total = 0
+    for score, token in reversed(scored):
+        encoded = token.encode("utf-8")
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+    return b"".join(reversed(chosen))